@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -50,7 +51,119 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10
 }
 
+# Метрики в формате Prometheus на /metrics: задержки запросов, SQL-запросы, вызовы Outline API.
+# Счетчики хранятся в памяти процесса — каждый воркер gunicorn отдает свои
+METRICS_ENABLED = True
+
+# Через сколько секунд снимок трафика ключа считается устаревшим (для ?fresh=1)
+TRAFFIC_SNAPSHOT_MAX_AGE = 300
+
+# Клиенты Outline API: таймауты в секундах и размер пула keep-alive соединений на сервер
+OUTLINE_CONNECT_TIMEOUT = 5
+OUTLINE_READ_TIMEOUT = 30
+OUTLINE_POOL_MAXSIZE = 10
+# Сколько серверов опрашивается одновременно в операциях по всему парку
+OUTLINE_FANOUT_CONCURRENCY = 10
+
+# /servers/stats/: сколько секунд статистика сервера считается свежей, таймаут опроса
+# и сколько хранится последнее известное значение для ответа со stale=True
+SERVER_STATS_TTL = 30
+SERVER_STATS_TIMEOUT = 3
+SERVER_STATS_STALE_TTL = 3600
+
+# Circuit breaker: после скольких ошибок подряд сервер считается недоступным
+# и через сколько секунд к нему снова пропускается пробный запрос
+OUTLINE_BREAKER_FAILURE_THRESHOLD = 3
+OUTLINE_BREAKER_COOLDOWN = 30
+# Как часто (в секундах) breaker перечитывает результаты пробника из БД
+OUTLINE_HEALTH_REFRESH_INTERVAL = 10
+
+# Фоновый пробник серверов (manage.py probe_servers --loop)
+HEALTH_PROBE_INTERVAL = 30
+HEALTH_PROBE_TIMEOUT = 5
+
+# Как часто (в секундах) обновляется кэш нагрузки серверов для автоматического выбора
+SERVER_RANKING_REFRESH_INTERVAL = 60
+
+# Пул заранее созданных ключей Outline (manage.py refill_key_pool --loop); имя и лимит
+# выданного ключа выставляют задачи process_jobs
+KEY_POOL_ENABLED = True
+KEY_POOL_LOW_WATER = 20
+KEY_POOL_TARGET = 50
+KEY_POOL_REFILL_INTERVAL = 30
+KEY_POOL_REFILL_CONCURRENCY = 5
+# Окно (в секундах) для метрик пополнения и выдачи ключей
+KEY_POOL_METRICS_WINDOW = 3600
+
+# Массовое создание ключей (POST /api/keys/bulk_create/)
+BULK_CREATE_MAX_ITEMS = 1000
+BULK_CREATE_SERVER_CONCURRENCY = 20
+
+# Массовая регистрация пользователей (POST /api/users/bulk_upsert/): один INSERT ... ON CONFLICT на пачку
+BULK_UPSERT_MAX_ITEMS = 10000
+BULK_UPSERT_CHUNK_SIZE = 2000
+
+# Потоковая выгрузка /api/keys/export/ и /api/users/export/: строк на одно чтение из курсора БД
+EXPORT_CHUNK_SIZE = 2000
+
+# Отзыв истекших и превысивших лимит ключей (manage.py enforce_keys --loop)
+ENFORCE_BATCH_SIZE = 5000
+ENFORCE_SERVER_CONCURRENCY = 20
+ENFORCE_INTERVAL = 300
+
+# Очередь операций с Outline (process_jobs): create_key без ключа в пуле, revoke и set_limit
+# отвечают 202 с id задачи вместо синхронного запроса к серверу
+OUTLINE_JOBS_ENABLED = True
+JOB_BATCH_SIZE = 100
+# Сколько задач одного сервера выполняется одновременно (по всем воркерам)
+JOB_SERVER_CONCURRENCY = 5
+JOB_MAX_ATTEMPTS = 8
+# Задержка перед повтором: JOB_BACKOFF_BASE * 2^(попытка-1), не больше JOB_BACKOFF_MAX секунд
+JOB_BACKOFF_BASE = 2
+JOB_BACKOFF_MAX = 300
+# Через сколько секунд задача в running считается брошенной упавшим воркером
+JOB_LOCK_TIMEOUT = 120
+JOB_POLL_INTERVAL = 1
+
+# reconcile: сколько исправлений отправляется на один сервер одновременно
+RECONCILE_SERVER_CONCURRENCY = 20
+
+# Перенос ключей между серверами (manage.py rebalance): ключей в пачке, запросов к одному
+# серверу одновременно и в секунду (0 — без ограничения) и допустимое превышение среднего числа ключей
+REBALANCE_BATCH_SIZE = 200
+REBALANCE_SERVER_CONCURRENCY = 10
+REBALANCE_SERVER_RATE = 20
+REBALANCE_TOLERANCE = 0.1
+
+# Импорт ключей, созданных в Outline в обход бэкенда (POST /servers/{id}/import_keys/, manage.py import_outline_keys):
+# разбор имени ключа (группы user — username или telegram_id, name — название ключа; формат outline_key_name)
+# и сколько строк ищется и вставляется одним запросом
+OUTLINE_KEY_IMPORT_PATTERN = r'(?P<user>\S+) - (?P<name>.*)'
+KEY_IMPORT_BATCH_SIZE = 5000
+
+# Кэш поиска пользователя по telegram_id: LRU в памяти процесса перед Django cache (CACHES)
+USER_CACHE_LOCAL_MAXSIZE = 10000
+USER_CACHE_LOCAL_TTL = 5
+USER_CACHE_SHARED_TTL = 300
+
+# Отметки активности POST /users/touch/ копятся в памяти процесса и пишутся в User.last_login
+# пачкой раз в ACTIVITY_FLUSH_INTERVAL секунд или сразу при ACTIVITY_BUFFER_MAX_SIZE пользователей
+ACTIVITY_FLUSH_INTERVAL = 10
+ACTIVITY_BUFFER_MAX_SIZE = 50000
+
+# Сколько секунд тело каталога (/catalog/) хранится в Django cache; версия меняется только сигналами
+CATALOG_CACHE_TIMEOUT = 86400
+
+# История трафика: сколько сэмплов сворачивается за транзакцию и сроки хранения
+TRAFFIC_ROLLUP_BATCH_SIZE = 10000
+TRAFFIC_ROLLUP_INTERVAL = 300
+# Сэмплы моложе TRAFFIC_ROLLUP_LAG секунд в сводки не попадают: транзакция, записавшая их, могла еще не закоммититься
+TRAFFIC_ROLLUP_LAG = 120
+TRAFFIC_SAMPLE_RETENTION_DAYS = 14
+TRAFFIC_HOURLY_RETENTION_DAYS = 90
+
 MIDDLEWARE = [
+    'vpn_service.utils.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -101,6 +214,24 @@ DATABASES = {
     }
 }
 
+# Общий для всех процессов кэш (REDIS_URL, в docker-compose — сервис redis): версия каталога,
+# кэш пользователей и статистика серверов сбрасываются сразу во всех воркерах, а не только
+# в процессе, где сработал сигнал. Без REDIS_URL — кэш в памяти процесса для разработки и тестов
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
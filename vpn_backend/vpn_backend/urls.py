@@ -1,7 +1,9 @@
 from django.contrib import admin
 from django.urls import path, include
+from vpn_service.views import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('vpn_service.urls')),
+    path('metrics', metrics, name='metrics'),
 ]
\ No newline at end of file
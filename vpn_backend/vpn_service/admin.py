@@ -1,5 +1,6 @@
-from django.contrib import admin
-from .models import Country, City, VPNServer, User, VPNKey, TelegramBot
+from django.contrib import admin, messages
+from .models import Country, City, VPNServer, User, VPNKey, TelegramBot, ServerHealth, PooledKey, OutlineJob
+from .utils.rebalance import plan_moves, deactivate_servers
 
 @admin.register(Country)
 class CountryAdmin(admin.ModelAdmin):
@@ -18,6 +19,45 @@ class VPNServerAdmin(admin.ModelAdmin):
     list_filter = ('active', 'city__country')
     search_fields = ('server_name', 'server_location')
     readonly_fields = ('created_at', 'updated_at')
+    actions = ('drain', 'rebalance')
+
+    # Перенос ключей — тысячи запросов к Outline, дольше таймаутов воркера и прокси. Действия
+    # только снимают серверы с выдачи и считают план, а переносит ключи команда rebalance
+
+    @admin.action(description='Drain selected servers (deactivate them, keys are moved by manage.py rebalance)')
+    def drain(self, request, queryset):
+        server_ids = list(queryset.values_list('id', flat=True))
+        deactivate_servers(server_ids)
+        keys = VPNKey.objects.filter(vpn_server_id__in=server_ids, is_active=True).count()
+        command = 'rebalance ' + ' '.join(f'--drain {server_id}' for server_id in server_ids)
+        self.message_user(
+            request,
+            f"{len(server_ids)} servers no longer issue keys; to move their {keys} active keys "
+            f"run manage.py {command}",
+            messages.WARNING if keys else messages.SUCCESS,
+        )
+
+    @admin.action(description='Plan moving excess keys off selected overloaded servers')
+    def rebalance(self, request, queryset):
+        server_ids = set(queryset.values_list('id', flat=True))
+        moves, unplaced = plan_moves(sources=server_ids)
+        if not moves:
+            self.message_user(request, f"Nothing to move, {unplaced} keys without a target server",
+                              messages.WARNING if unplaced else messages.SUCCESS)
+            return
+        command = 'rebalance ' + ' '.join(f'--server {server_id}' for server_id in sorted(server_ids))
+        self.message_user(
+            request,
+            f"{len(moves)} keys can be moved ({unplaced} without a target server); run manage.py {command}",
+            messages.WARNING,
+        )
+
+@admin.register(ServerHealth)
+class ServerHealthAdmin(admin.ModelAdmin):
+    list_display = ('id', 'vpn_server', 'latency_ms', 'keys_with_traffic', 'consecutive_failures', 'last_success_at',
+                    'last_checked_at')
+    list_filter = ('vpn_server__city__country',)
+    readonly_fields = ('last_checked_at', 'last_success_at', 'last_failure_at')
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
@@ -33,6 +73,19 @@ class VPNKeyAdmin(admin.ModelAdmin):
     search_fields = ('name', 'user__username', 'user__telegram_id')
     readonly_fields = ('created_at', 'updated_at', 'outline_id', 'access_url')
 
+@admin.register(PooledKey)
+class PooledKeyAdmin(admin.ModelAdmin):
+    list_display = ('id', 'outline_id', 'vpn_server', 'created_at', 'claimed_at')
+    list_filter = ('vpn_server',)
+    readonly_fields = ('created_at', 'claimed_at', 'outline_id', 'access_url')
+
+@admin.register(OutlineJob)
+class OutlineJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'vpn_server', 'vpn_key', 'attempts', 'run_after', 'created_at')
+    list_filter = ('status', 'kind', 'vpn_server')
+    search_fields = ('idempotency_key',)
+    readonly_fields = ('created_at', 'updated_at', 'finished_at', 'locked_at')
+
 @admin.register(TelegramBot)
 class TelegramBotAdmin(admin.ModelAdmin):
     list_display = ('id', 'bot_username', 'is_active', 'created_at')
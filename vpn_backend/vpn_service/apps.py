@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class VpnServiceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'vpn_service'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from . import signals  # noqa: F401
+        from .utils.metrics import install_query_counter
+        connection_created.connect(install_query_counter, dispatch_uid='metrics-query-counter')
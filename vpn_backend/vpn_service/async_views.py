@@ -0,0 +1,226 @@
+"""
+Асинхронные версии view, которые ждут Outline API.
+
+Под ASGI (uvicorn/daphne) запрос, ожидающий ответа Outline, не занимает
+поток воркера: ORM вызывается через async-интерфейс Django, а Outline —
+через AsyncOutlineVPNClient из async_client_pool. Поэтому здесь нет очереди
+OutlineJob — ждать Outline прямо в запросе дешево; пул заранее созданных
+ключей используется как и в sync view. Код, которому нужны транзакции,
+выполняется через sync_to_async. Ответы совпадают с ответами VPNKeyViewSet
+и VPNServerViewSet.
+"""
+import datetime
+import functools
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils import timezone
+
+from .models import VPNServer, User, VPNKey, OutlineJob
+from .serializers import VPNKeySerializer, OutlineJobSerializer
+from .utils.jobs import record_completed_job
+from .utils.key_pool import claim_key
+from .utils.outline import outline_key_name, ServerUnavailable
+from .utils.outline_async import async_client_pool
+from .utils.selection import server_ranking
+from .utils.traffic import fetch_used_bytes_async, stale_traffic_keys, store_keys_traffic
+
+logger = logging.getLogger(__name__)
+
+
+def async_api_view(*methods):
+    """Разрешенные HTTP методы и освобождение от CSRF, как у DRF APIView"""
+
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+            return await view(request, *args, **kwargs)
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+def error_response(message, status):
+    return JsonResponse({'status': 'error', 'message': message}, status=status)
+
+
+def not_found():
+    return JsonResponse({'detail': 'Not found.'}, status=404)
+
+
+def outline_error(e):
+    return error_response(str(e), 503 if isinstance(e, ServerUnavailable) else 500)
+
+
+def request_data(request):
+    """Тело запроса как dict; пустое тело — пустой dict"""
+    if not request.body:
+        return {}
+    data = json.loads(request.body)
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    return data
+
+
+def job_json(job):
+    code = 202 if job.status in (OutlineJob.PENDING, OutlineJob.RUNNING) else 200
+    return JsonResponse(OutlineJobSerializer(job).data, status=code)
+
+
+async def get_vpn_key(pk):
+    try:
+        return await VPNKey.objects.select_related('vpn_server', 'user').aget(pk=pk)
+    except (VPNKey.DoesNotExist, ValueError):
+        return None
+
+
+@async_api_view('POST')
+async def create_key(request):
+    try:
+        data = request_data(request)
+    except ValueError:
+        return error_response('Request body must be a JSON object', 400)
+    user_id = data.get('user_id')
+    server_id = data.get('server_id')
+    name = data.get('name', 'VPN Key')
+    traffic_limit = data.get('traffic_limit', 0)  # в байтах
+    expiration_days = data.get('expiration_days')
+
+    request_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    request_key = str(request_key)[:100] if request_key else None
+    if request_key:
+        job = await OutlineJob.objects.filter(idempotency_key=request_key).afirst()
+        if job is not None:
+            return job_json(job)
+
+    try:
+        user = await User.objects.aget(id=user_id)
+        server = await VPNServer.objects.aget(id=server_id) if server_id is not None else None
+    except (User.DoesNotExist, VPNServer.DoesNotExist, ValueError):
+        return not_found()
+    if server is None:
+        # Выбор сервера читает рейтинг из БД при обновлении — выполняем его в потоке
+        try:
+            server = await sync_to_async(server_ranking.select)(
+                country_id=data.get('country_id'), city_id=data.get('city_id'),
+            )
+        except (TypeError, ValueError):
+            return error_response('country_id and city_id must be integers', 400)
+        if server is None:
+            return error_response('No available VPN server for the requested location', 503)
+
+    try:
+        expiration_date = None
+        if expiration_days:
+            expiration_date = timezone.now() + datetime.timedelta(days=int(expiration_days))
+
+        vpn_key = None
+        if settings.KEY_POOL_ENABLED:
+            vpn_key = await sync_to_async(claim_key)(server, user, name, traffic_limit=traffic_limit,
+                                                     expiration_date=expiration_date)
+
+        if vpn_key is None:
+            client = async_client_pool.get(server)
+            key_data = await client.create_key(name=outline_key_name(user, name))
+            if traffic_limit > 0:
+                try:
+                    limited = await client.add_data_limit(key_data.key_id, traffic_limit)
+                except Exception:
+                    limited = False
+                if not limited:
+                    # Ключ без лимита оставлять нельзя — удаляем его и отвечаем ошибкой
+                    await client.delete_key(key_data.key_id)
+                    return error_response('Unable to set data limit', 500)
+            vpn_key = await VPNKey.objects.acreate(
+                user=user,
+                vpn_server=server,
+                outline_id=key_data.key_id,
+                access_url=key_data.access_url,
+                name=name,
+                expiration_date=expiration_date,
+                traffic_limit=traffic_limit,
+            )
+        server_ranking.record_key_created(server.id)
+        if request_key:
+            await sync_to_async(record_completed_job)(OutlineJob.CREATE_KEY, server, vpn_key, request_key)
+        return JsonResponse(VPNKeySerializer(vpn_key).data, status=201)
+
+    except Exception as e:
+        return outline_error(e)
+
+
+@async_api_view('POST')
+async def revoke(request, pk):
+    vpn_key = await get_vpn_key(pk)
+    if vpn_key is None:
+        return not_found()
+
+    try:
+        await async_client_pool.get(vpn_key.vpn_server).delete_key(vpn_key.outline_id)
+        vpn_key.is_active = False
+        await vpn_key.asave()
+        return JsonResponse({'status': 'success', 'message': 'Key revoked successfully'})
+    except Exception as e:
+        return outline_error(e)
+
+
+@async_api_view('POST')
+async def update_traffic(request, pk):
+    vpn_key = await get_vpn_key(pk)
+    if vpn_key is None:
+        return not_found()
+
+    try:
+        key_info = await async_client_pool.get(vpn_key.vpn_server).get_key(vpn_key.outline_id)
+        await sync_to_async(store_keys_traffic)([vpn_key], {vpn_key.outline_id: key_info.used_bytes or 0})
+        return JsonResponse(VPNKeySerializer(vpn_key).data)
+    except Exception as e:
+        return outline_error(e)
+
+
+@async_api_view('POST')
+async def test_connection(request, pk):
+    try:
+        server = await VPNServer.objects.aget(pk=pk)
+    except (VPNServer.DoesNotExist, ValueError):
+        return not_found()
+
+    try:
+        server_info = await async_client_pool.get(server).get_server_information()
+        return JsonResponse({
+            'status': 'success',
+            'message': 'Connection successful',
+            'server_info': server_info
+        })
+    except Exception as e:
+        return outline_error(e)
+
+
+@async_api_view('GET')
+async def server_keys(request, pk):
+    try:
+        server = await VPNServer.objects.aget(pk=pk)
+    except (VPNServer.DoesNotExist, ValueError):
+        return not_found()
+
+    keys = [
+        vpn_key async for vpn_key in
+        VPNKey.objects.filter(vpn_server=server).select_related('vpn_server', 'user')
+    ]
+    # Как и в sync view: с ?fresh=1 обновляем устаревшие снимки одним get_keys(),
+    # ошибка Outline не прерывает ответ — остается прежний снимок
+    stale = stale_traffic_keys(keys) if request.GET.get('fresh') in ('1', 'true', 'yes') else []
+    if stale:
+        try:
+            used_bytes = await fetch_used_bytes_async(async_client_pool.get(server), server)
+        except Exception as e:
+            logger.warning('Traffic refresh failed for server %s: %r', server.id, e)
+            used_bytes = None
+        if used_bytes is not None:
+            await sync_to_async(store_keys_traffic)(stale, used_bytes)
+    return JsonResponse(VPNKeySerializer(keys, many=True).data, safe=False)
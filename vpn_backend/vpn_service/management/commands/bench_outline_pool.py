@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from vpn_service.models import VPNServer
+from vpn_service.utils.fake_outline import FakeOutlineServer
+from vpn_service.utils.outline import OutlineVPNClient, OutlineClientPool
+import statistics
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compare cold and pooled Outline client latency against a local fake Outline server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Requests per mode')
+        parser.add_argument('--latency', type=float, default=0, help='Fake server latency in seconds')
+        parser.add_argument('--certfile', help='PEM certificate to serve HTTPS (measures TLS handshakes)')
+        parser.add_argument('--keyfile', help='PEM private key for --certfile')
+
+    def handle(self, *args, **options):
+        fake = FakeOutlineServer(
+            latency=options['latency'],
+            certfile=options.get('certfile'),
+            keyfile=options.get('keyfile'),
+        )
+        with fake:
+            server = VPNServer(id=0, api_url=fake.api_url, cert_sha=fake.cert_sha256)
+            self.stdout.write(self.style.NOTICE(f"Fake Outline server at {fake.api_url}"))
+
+            def cold():
+                client = OutlineVPNClient(api_url=server.api_url, cert_sha256=server.cert_sha)
+                client.get_server_information()
+                client.close()
+
+            pool = OutlineClientPool(connect_timeout=5, read_timeout=30, pool_maxsize=10)
+
+            def pooled():
+                pool.get(server).get_server_information()
+
+            for label, call in (('cold', cold), ('pooled', pooled)):
+                self._report(label, self._measure(call, options['requests']))
+            pool.clear()
+
+    def _measure(self, call, count):
+        call()  # прогрев
+        timings = []
+        for _ in range(count):
+            started = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - started) * 1000)
+        return sorted(timings)
+
+    def _report(self, label, timings):
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        self.stdout.write(
+            f"{label:>6}: n={len(timings)} mean={statistics.mean(timings):.2f}ms "
+            f"p50={statistics.median(timings):.2f}ms p95={p95:.2f}ms"
+        )
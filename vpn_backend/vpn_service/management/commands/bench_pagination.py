@@ -0,0 +1,96 @@
+from base64 import b64encode
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from urllib.parse import urlencode
+from vpn_service.models import Country, City, VPNServer, User, VPNKey
+import datetime
+import statistics
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compare cursor and offset page latency at several depths on a synthetic large dataset'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='Synthetic keys and users to create')
+        parser.add_argument('--page-size', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=5, help='Requests per depth')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        if rows < options['page_size'] * 2:
+            raise CommandError('--rows must be at least twice --page-size')
+
+        # Данные создаются в транзакции и откатываются после замеров
+        with transaction.atomic():
+            started = time.monotonic()
+            self._create_data(rows)
+            self.stdout.write(self.style.NOTICE(f"Created {rows} keys and users in {time.monotonic() - started:.1f}s"))
+
+            depths = [0, rows // 2, rows - options['page_size']]
+            for label, model, url in (('keys', VPNKey, '/api/keys/'), ('users', User, '/api/users/')):
+                for depth in depths:
+                    self._compare(label, model, url, depth, options['page_size'], options['repeat'])
+            transaction.set_rollback(True)
+
+    def _create_data(self, rows, batch_size=10000):
+        country = Country.objects.create(country_name='Bench pagination')
+        city = City.objects.create(city_name='Bench pagination', country=country)
+        server = VPNServer.objects.create(server_name='bench', city=city, server_location='bench', api_key='bench',
+                                          cert_sha='bench', api_url='https://127.0.0.1:1/bench')
+        base = timezone.now() - datetime.timedelta(days=365)
+        telegram_base = -10 ** 12
+
+        # created_at проставляется вручную, чтобы получить реалистичный разброс значений
+        fields = [VPNKey._meta.get_field('created_at'), User._meta.get_field('created_at')]
+        for field in fields:
+            field.auto_now_add = False
+        try:
+            for start in range(0, rows, batch_size):
+                stop = min(start + batch_size, rows)
+                users = User.objects.bulk_create(
+                    User(telegram_id=telegram_base - i, username=f'bench{i}',
+                         created_at=base + datetime.timedelta(seconds=i))
+                    for i in range(start, stop)
+                )
+                VPNKey.objects.bulk_create(
+                    VPNKey(user=user, vpn_server=server, outline_id=str(i), access_url='ss://bench',
+                           name='bench', created_at=base + datetime.timedelta(seconds=i))
+                    for i, user in zip(range(start, stop), users)
+                )
+        finally:
+            for field in fields:
+                field.auto_now_add = True
+
+    def _compare(self, label, model, url, depth, page_size, repeat):
+        client = APIClient()
+        cursor_url = f"{url}?page_size={page_size}"
+        if depth:
+            # Курсор на позицию depth, как если бы клиент дошел туда по ссылкам next
+            position = model.objects.order_by('created_at', 'id').values_list('created_at', flat=True)[depth - 1]
+            cursor = b64encode(urlencode({'p': str(position)}).encode('ascii')).decode('ascii')
+            cursor_url += f"&cursor={cursor}"
+
+        cursor_timings, offset_timings = [], []
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = client.get(cursor_url)
+                cursor_timings.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise CommandError(f"{cursor_url} returned {response.status_code}")
+
+            # То же, что делала PageNumberPagination: COUNT(*) и OFFSET
+            started = time.perf_counter()
+            queryset = model.objects.order_by('created_at', 'id')
+            queryset.count()
+            list(queryset[depth:depth + page_size])
+            offset_timings.append((time.perf_counter() - started) * 1000)
+
+        self.stdout.write(
+            f"{label:>5} depth={depth:<8} cursor={statistics.median(cursor_timings):8.2f}ms "
+            f"(queries={len(queries)})  offset+count={statistics.median(offset_timings):8.2f}ms"
+        )
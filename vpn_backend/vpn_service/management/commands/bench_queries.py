@@ -0,0 +1,87 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from vpn_service.models import Country, City, VPNServer, User, VPNKey
+import statistics
+import time
+
+# Эндпоинт и ожидаемое число SQL-запросов (пагинация: COUNT + SELECT, курсорная пагинация — только SELECT;
+# detail-действия: объект + SELECT)
+ENDPOINTS = [
+    ('/api/keys/', 1),
+    ('/api/servers/', 2),
+    ('/api/cities/', 2),
+    ('/api/users/{user_id}/keys/', 2),
+    ('/api/servers/{server_id}/keys/', 2),
+]
+
+
+class Command(BaseCommand):
+    help = 'Check that list endpoints run a fixed number of queries and time them at several table sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[10, 100, 1000],
+            help='Number of synthetic rows (keys, servers, cities) per run',
+        )
+        parser.add_argument('--repeat', type=int, default=5, help='Requests per endpoint and size')
+
+    def handle(self, *args, **options):
+        failures = []
+        for size in options['sizes']:
+            # Синтетические данные создаются в транзакции и откатываются после замеров
+            with transaction.atomic():
+                context = self._create_data(size)
+                failures.extend(self._measure(size, context, options['repeat']))
+                transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError('Unexpected query counts: ' + '; '.join(failures))
+        self.stdout.write(self.style.SUCCESS('All endpoints ran a fixed number of queries'))
+
+    def _create_data(self, size):
+        country = Country.objects.create(country_name=f'Bench country {size}')
+        cities = City.objects.bulk_create(
+            City(city_name=f'Bench city {i}', country=country) for i in range(size)
+        )
+        servers = VPNServer.objects.bulk_create(
+            VPNServer(server_name=f'bench-{i}', city=cities[i % len(cities)], server_location='bench',
+                      api_key='bench', cert_sha='bench', api_url='https://127.0.0.1:1/bench')
+            for i in range(size)
+        )
+        user = User.objects.create(telegram_id=-size, username=f'bench{size}')
+        VPNKey.objects.bulk_create(
+            VPNKey(user=user, vpn_server=servers[0], outline_id=str(i), access_url='ss://bench',
+                   name=f'bench key {i}')
+            for i in range(size)
+        )
+        return {'user_id': user.id, 'server_id': servers[0].id}
+
+    def _measure(self, size, context, repeat):
+        client = APIClient()
+        failures = []
+        for template, expected in ENDPOINTS:
+            url = template.format(**context)
+            timings = []
+            for _ in range(repeat):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = client.get(url)
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(f"{url} returned {response.status_code}")
+
+            line = (
+                f"{size:>5} rows {template:<32} queries={len(queries)} "
+                f"median={statistics.median(timings):.2f}ms max={max(timings):.2f}ms"
+            )
+            if len(queries) != expected:
+                failures.append(f"{template} at {size} rows: {len(queries)} != {expected}")
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+        return failures
@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from vpn_service.utils.enforcement import enforce_keys
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Revoke active keys that are expired or over their traffic limit'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count keys that would be revoked',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.ENFORCE_BATCH_SIZE,
+            help='Number of keys revoked per batch',
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep sweeping every --interval seconds',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.ENFORCE_INTERVAL,
+            help='Seconds between sweeps in --loop mode',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            try:
+                self._sweep(options['batch_size'], options['dry_run'])
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('Key enforcement sweep failed')
+
+            if not options['loop']:
+                break
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def _sweep(self, batch_size, dry_run):
+        report = enforce_keys(batch_size=batch_size, dry_run=dry_run)
+        for server_name, stats in report['servers'].items():
+            line = f"{server_name}: {stats['revoked']} revoked, {stats['failed']} failed ({stats['seconds']:.3f}s)"
+            self.stdout.write(self.style.WARNING(line) if stats['failed'] else line)
+
+        summary = (
+            f"{report['expired']} expired, {report['over_limit']} over limit; "
+            f"{report['revoked']} revoked, {report['failed']} failed in {report['seconds']:.3f}s"
+        )
+        if dry_run:
+            self.stdout.write(self.style.NOTICE(f"Dry run: {report['expired']} expired, "
+                                                f"{report['over_limit']} over limit"))
+        elif report['failed']:
+            self.stdout.write(self.style.WARNING(summary))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
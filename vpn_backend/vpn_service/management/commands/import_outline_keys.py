@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+from vpn_service.models import VPNServer
+from vpn_service.utils.key_import import import_servers_keys
+
+
+class Command(BaseCommand):
+    help = 'Create VPNKey rows for Outline keys created outside the backend, matching owners by key name'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--server',
+            type=int,
+            action='append',
+            help='ID of VPN server to import keys from (can be repeated, default: all active)',
+        )
+        parser.add_argument(
+            '--pattern',
+            help='Regex for Outline key names with named groups "user" (username or telegram_id) and "name" '
+                 '(default: OUTLINE_KEY_IMPORT_PATTERN)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report what would be imported',
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=None,
+            help='Per-server timeout in seconds for fetching keys',
+        )
+
+    def handle(self, *args, **options):
+        servers = VPNServer.objects.filter(active=True)
+        if options['server']:
+            servers = VPNServer.objects.filter(id__in=options['server'])
+
+        try:
+            results = import_servers_keys(servers, pattern=options['pattern'], dry_run=options['dry_run'],
+                                          timeout=options['timeout'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        imported = 0
+        for result in results:
+            if 'error' in result:
+                self.stdout.write(self.style.ERROR(f"{result['server_name']}: {result['error']}"))
+                continue
+            imported += result['imported']
+            line = (
+                f"{result['server_name']}: {result['remote_keys']} in Outline, {result['known']} already known, "
+                f"{result['imported']} imported, {result['unmatched']} unmatched names, "
+                f"{result['unknown_users']} unknown users, {result['ambiguous']} ambiguous users "
+                f"(fetch {result['fetch_seconds']:.3f}s, db {result['seconds']:.3f}s)"
+            )
+            if result['unmatched'] or result['unknown_users'] or result['ambiguous']:
+                self.stdout.write(self.style.WARNING(line))
+                if result['unmatched_names']:
+                    self.stdout.write(f"  unmatched: {', '.join(map(repr, result['unmatched_names']))}")
+                if result['unknown_user_tokens']:
+                    self.stdout.write(f"  unknown users: {', '.join(result['unknown_user_tokens'])}")
+                if result['ambiguous_users']:
+                    self.stdout.write(f"  usernames of several users: {', '.join(result['ambiguous_users'])}")
+            else:
+                self.stdout.write(line)
+
+        if options['dry_run']:
+            self.stdout.write(self.style.NOTICE(f"Dry run: {imported} keys would be imported"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{imported} keys imported"))
@@ -0,0 +1,216 @@
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from vpn_service.models import Country, City, VPNServer, User, VPNKey
+from vpn_service.utils.fake_outline import FakeOutlineServer, FakeOutlineProcess
+from vpn_service.utils.outline import client_pool
+from vpn_service.utils.outline_async import async_client_pool
+import asyncio
+import itertools
+import statistics
+import threading
+import time
+
+SCENARIOS = ['list_keys', 'update_traffic', 'create_key', 'revoke', 'test_connection']
+STACKS = ['wsgi', 'asgi']
+# Сценарии, у которых есть async версия view (/api/async/...)
+ASYNC_SCENARIOS = {'update_traffic', 'create_key', 'revoke', 'test_connection'}
+
+
+class Command(BaseCommand):
+    help = 'Load-test key endpoints against local fake Outline servers in a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', type=int, default=3, help='Number of fake Outline servers')
+        parser.add_argument('--keys', type=int, default=1000, help='Existing keys per server')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario and concurrency level')
+        parser.add_argument('--concurrency', default='1,8,32', help='Comma-separated concurrency levels')
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f"Comma-separated subset of: {', '.join(SCENARIOS)}")
+        parser.add_argument('--latency', type=float, default=0.02, help='Fake server latency in seconds')
+        parser.add_argument('--latency-jitter', type=float, default=0, help='Extra random latency in seconds')
+        parser.add_argument('--error-rate', type=float, default=0, help='Share of fake server requests answered 500')
+        parser.add_argument('--subprocess', action='store_true',
+                            help='Run fake servers as separate processes instead of threads')
+        parser.add_argument('--sync', action='store_true',
+                            help='Disable the key pool and job queue so mutations call Outline in the request')
+        parser.add_argument('--pool-maxsize', type=int,
+                            help='Override OUTLINE_POOL_MAXSIZE (connections per Outline server) for both stacks')
+        parser.add_argument('--stack', default='wsgi',
+                            help='Comma-separated stacks to compare: wsgi (threads, DRF views) '
+                                 'and/or asgi (event loop tasks, async views)')
+
+    def handle(self, *args, **options):
+        levels = [int(level) for level in options['concurrency'].split(',') if level]
+        scenarios = [name for name in options['scenarios'].split(',') if name]
+        stacks = [name for name in options['stack'].split(',') if name]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        if set(stacks) - set(STACKS):
+            raise CommandError(f"Unknown stacks: {', '.join(sorted(set(stacks) - set(STACKS)))}")
+        if 'revoke' in scenarios and \
+                options['requests'] * len(levels) * len(stacks) > options['servers'] * options['keys']:
+            raise CommandError('Not enough keys for revoke: increase --keys or lower --requests')
+
+        fakes = [self._fake_server(options) for _ in range(options['servers'])]
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            for fake in fakes:
+                fake.start()
+            user, key_ids = self._populate(fakes, options['keys'])
+            overrides = {'KEY_POOL_ENABLED': False, 'OUTLINE_JOBS_ENABLED': False} if options['sync'] else {}
+            if options['pool_maxsize']:
+                overrides['OUTLINE_POOL_MAXSIZE'] = options['pool_maxsize']
+            with override_settings(**overrides):
+                self.stdout.write(
+                    f"{'scenario':<16}{'stack':<6}{'conc':>5}{'n':>6}{'err':>5}{'rps':>9}"
+                    f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+                )
+                for name in scenarios:
+                    # Один сценарий на все уровни и стеки: revoke не должен отзывать уже отозванные ключи
+                    calls = self._scenario(name, user, key_ids)
+                    for stack in stacks:
+                        for level in levels:
+                            if stack == 'asgi':
+                                result = asyncio.run(self._run_async(calls[stack], options['requests'], level))
+                            else:
+                                result = self._run(calls[stack], options['requests'], level)
+                            self._report(name, stack, level, *result)
+        finally:
+            for fake in fakes:
+                fake.stop()
+            client_pool.clear()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def _fake_server(self, options):
+        params = {
+            'latency': options['latency'],
+            'latency_jitter': options['latency_jitter'],
+            'error_rate': options['error_rate'],
+        }
+        if options['subprocess']:
+            return FakeOutlineProcess(keys=options['keys'], **params)
+        fake = FakeOutlineServer(**params)
+        for index in range(options['keys']):
+            fake.state.create_key(name=f'Key {index}')
+        return fake
+
+    def _populate(self, fakes, keys_per_server):
+        country = Country.objects.create(country_name='Loadtest')
+        city = City.objects.create(city_name='Loadtest', country=country)
+        user = User.objects.create(telegram_id=1, username='loadtest')
+        rows = []
+        for index, fake in enumerate(fakes):
+            server = VPNServer.objects.create(
+                server_name=f'loadtest-{index}', city=city, server_location='local',
+                api_key='', cert_sha=fake.cert_sha256, api_url=fake.api_url,
+            )
+            # Фейковый сервер нумерует ключи с нуля — строки БД ссылаются на них напрямую
+            rows.extend(
+                VPNKey(user=user, vpn_server=server, outline_id=str(key_index), access_url='',
+                       name=f'Key {key_index}')
+                for key_index in range(keys_per_server)
+            )
+        VPNKey.objects.bulk_create(rows, batch_size=1000)
+        # Чередуем серверы, чтобы нагрузка распределялась по всем
+        key_ids = list(VPNKey.objects.order_by('outline_id', 'vpn_server_id').values_list('id', flat=True))
+        return user, key_ids
+
+    def _scenario(self, name, user, key_ids):
+        """
+        Возвращает {stack: call(client)}. Под asgi вызываются async версии view
+        там, где они есть; AsyncClient принимает те же аргументы, что и Client.
+        """
+        server_ids = list(VPNServer.objects.values_list('id', flat=True))
+        servers = itertools.cycle(server_ids)
+        # Ключи для revoke берем с конца списка, для update_traffic — с начала, чтобы они не пересекались
+        revoke_keys = iter(reversed(key_ids))
+        traffic_keys = itertools.cycle(key_ids[:max(1, len(key_ids) // 2)])
+        lock = threading.Lock()
+
+        def take(iterator):
+            with lock:
+                return next(iterator)
+
+        def build(prefix):
+            if name == 'list_keys':
+                return lambda client: client.get('/api/keys/', {'page_size': 50})
+            if name == 'update_traffic':
+                return lambda client: client.post(f'{prefix}/keys/{take(traffic_keys)}/update_traffic/')
+            if name == 'create_key':
+                return lambda client: client.post(f'{prefix}/keys/create_key/', {
+                    'user_id': user.id, 'server_id': take(servers), 'name': 'Load key',
+                }, content_type='application/json')
+            if name == 'test_connection':
+                return lambda client: client.post(f'{prefix}/servers/{take(servers)}/test_connection/')
+            return lambda client: client.post(f'{prefix}/keys/{take(revoke_keys)}/revoke/')
+
+        return {'wsgi': build('/api'), 'asgi': build('/api/async' if name in ASYNC_SCENARIOS else '/api')}
+
+    def _run(self, call, count, concurrency):
+        remaining = itertools.count()
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            client = Client(raise_request_exception=False)
+            try:
+                while next(remaining) < count:
+                    started = time.perf_counter()
+                    try:
+                        ok = call(client).status_code < 400
+                    except Exception:
+                        ok = False
+                    timing = (time.perf_counter() - started) * 1000
+                    with lock:
+                        results.append((timing, ok))
+            finally:
+                # Соединения потоков закрываем, иначе тестовую БД не удастся удалить
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return [timing for timing, _ in results], sum(1 for _, ok in results if not ok), elapsed
+
+    async def _run_async(self, call, count, concurrency):
+        """Как _run, но concurrency задач в одном event loop через ASGI обработчик Django"""
+        remaining = itertools.count()
+        results = []
+
+        async def worker():
+            client = AsyncClient(raise_request_exception=False)
+            while next(remaining) < count:
+                started = time.perf_counter()
+                try:
+                    ok = (await call(client)).status_code < 400
+                except Exception:
+                    ok = False
+                results.append(((time.perf_counter() - started) * 1000, ok))
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        finally:
+            elapsed = time.perf_counter() - started
+            # Клиенты Outline привязаны к этому loop, соединение с БД — к потоку sync_to_async
+            await async_client_pool.aclose()
+            await sync_to_async(connections.close_all)()
+        return [timing for timing, _ in results], sum(1 for _, ok in results if not ok), elapsed
+
+    def _report(self, name, stack, level, timings, errors, elapsed):
+        percentiles = statistics.quantiles(timings, n=100, method='inclusive') if len(timings) > 1 else timings * 99
+        line = (
+            f"{name:<16}{stack:<6}{level:>5}{len(timings):>6}{errors:>5}{len(timings) / elapsed:>9.1f}"
+            f"{percentiles[49]:>9.2f}{percentiles[94]:>9.2f}{percentiles[98]:>9.2f}{max(timings):>9.2f}"
+        )
+        self.stdout.write(self.style.WARNING(line) if errors else line)
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from vpn_service.models import VPNServer
+from vpn_service.utils.health import probe_servers
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Probe all active Outline servers and record their health'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep probing every --interval seconds',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.HEALTH_PROBE_INTERVAL,
+            help='Seconds between probes in --loop mode',
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=settings.HEALTH_PROBE_TIMEOUT,
+            help='Per-server probe timeout in seconds',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            try:
+                self._probe_once(options['timeout'])
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('Health probe failed')
+
+            if not options['loop']:
+                break
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def _probe_once(self, timeout):
+        results = probe_servers(VPNServer.objects.filter(active=True), timeout=timeout)
+        for result in results:
+            if result.error is None:
+                self.stdout.write(f"{result.server.server_name}: ok ({result.elapsed * 1000:.1f}ms)")
+            else:
+                self.stdout.write(self.style.ERROR(
+                    f"{result.server.server_name}: {str(result.error) or result.error.__class__.__name__}"
+                ))
+        failed = sum(1 for result in results if result.error is not None)
+        style = self.style.SUCCESS if not failed else self.style.WARNING
+        self.stdout.write(style(f"Probed {len(results)} servers, {failed} failed"))
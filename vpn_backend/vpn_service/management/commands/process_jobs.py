@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from vpn_service.utils.jobs import process_jobs
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Run queued Outline operations (key creation, revocation, limit changes)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.JOB_BATCH_SIZE,
+            help='Maximum number of jobs claimed per iteration',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Process one batch and exit instead of polling the queue',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.JOB_POLL_INTERVAL,
+            help='Seconds to wait when the queue is empty',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                report = process_jobs(batch_size=options['batch_size'])
+            except Exception:
+                if options['once']:
+                    raise
+                logger.exception('Job processing failed')
+                report = {'claimed': 0}
+
+            if report['claimed']:
+                line = (
+                    f"{report['claimed']} jobs: {report['succeeded']} succeeded, "
+                    f"{report['retried']} retried, {report['deferred']} deferred (circuit open), "
+                    f"{report['failed']} failed in {report['seconds']:.3f}s"
+                )
+                self.stdout.write(self.style.WARNING(line) if report['failed'] else self.style.SUCCESS(line))
+
+            if options['once']:
+                break
+            if not report['claimed']:
+                time.sleep(options['interval'])
@@ -0,0 +1,98 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from vpn_service.models import VPNServer
+from vpn_service.utils.rebalance import plan_moves, execute_moves, drain_servers
+
+
+class Command(BaseCommand):
+    help = 'Move active keys off drained or overloaded servers to the least loaded healthy servers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--drain',
+            type=int,
+            action='append',
+            help='ID of VPN server to drain: deactivate it and move all its active keys (can be repeated)',
+        )
+        parser.add_argument(
+            '--server',
+            type=int,
+            action='append',
+            help='Only rebalance keys from these overloaded servers (can be repeated, default: all)',
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=settings.REBALANCE_TOLERANCE,
+            help='Allowed share above the average key count before a server counts as overloaded',
+        )
+        parser.add_argument('--limit', type=int, default=None, help='Move at most this many keys')
+        parser.add_argument(
+            '--any-country',
+            action='store_true',
+            help='Allow moving keys to servers in other countries',
+        )
+        parser.add_argument('--batch-size', type=int, default=settings.REBALANCE_BATCH_SIZE,
+                            help='Keys per create/swap/delete batch')
+        parser.add_argument('--concurrency', type=int, default=settings.REBALANCE_SERVER_CONCURRENCY,
+                            help='Concurrent Outline requests per server')
+        parser.add_argument('--rate', type=float, default=settings.REBALANCE_SERVER_RATE,
+                            help='Outline requests per second per server (0 for no limit)')
+        parser.add_argument('--dry-run', action='store_true', help='Only print the plan')
+
+    def handle(self, *args, **options):
+        same_country = not options['any_country']
+        execute_options = {
+            'batch_size': options['batch_size'],
+            'concurrency': options['concurrency'],
+            'rate': options['rate'],
+        }
+
+        if options['dry_run'] or not options['drain']:
+            moves, unplaced = plan_moves(
+                drain=options['drain'] or (),
+                sources=set(options['server']) if options['server'] else None,
+                tolerance=options['tolerance'],
+                limit=options['limit'],
+                same_country=same_country,
+            )
+            routes = Counter((move.source.server_name, move.target.server_name) for move in moves)
+            for (source, target), count in sorted(routes.items()):
+                self.stdout.write(f"{source} -> {target}: {count} keys")
+            if unplaced:
+                self.stdout.write(self.style.WARNING(f"{unplaced} keys have no suitable target server"))
+            if options['dry_run']:
+                self.stdout.write(self.style.NOTICE(f"Dry run: {len(moves)} keys planned"))
+                return
+            if not moves:
+                self.stdout.write(self.style.SUCCESS('Servers are balanced, nothing to move'))
+                return
+            report = execute_moves(moves, **execute_options)
+            report['unplaced'] = unplaced
+        else:
+            names = ', '.join(VPNServer.objects.filter(id__in=options['drain']).values_list('server_name', flat=True))
+            self.stdout.write(f"Draining {names}")
+            report = drain_servers(options['drain'], limit=options['limit'], same_country=same_country,
+                                   **execute_options)
+
+        for server_name, stats in sorted(report['servers'].items()):
+            self.stdout.write(f"{server_name}: {stats['out']} out, {stats['in']} in")
+        summary = (
+            f"{report['moved']} of {report['planned']} keys moved in {report['seconds']:.3f}s; "
+            f"{report['deleted']} old keys deleted"
+        )
+        problems = []
+        if report['failed']:
+            problems.append(f"{report['failed']} creates failed")
+        if report['skipped']:
+            problems.append(f"{report['skipped']} keys changed or got queued jobs during the move")
+        if report['delete_failed']:
+            problems.append(f"{report['delete_failed']} deletes failed (run reconcile --delete-unknown)")
+        if report['unplaced']:
+            problems.append(f"{report['unplaced']} keys without a target")
+        if problems:
+            self.stdout.write(self.style.WARNING(f"{summary}; {', '.join(problems)}"))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from vpn_service.models import VPNServer
+from vpn_service.utils.reconcile import reconcile_servers
+
+
+class Command(BaseCommand):
+    help = 'Compare Outline keys with VPNKey rows and fix orphans, ghosts and name/limit mismatches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--server',
+            type=int,
+            action='append',
+            help='ID of VPN server to reconcile (can be repeated, default: all active)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report differences without changing Outline or the database',
+        )
+        parser.add_argument(
+            '--delete-unknown',
+            action='store_true',
+            help='Also delete Outline keys the database has no rows for at all (by default they are only reported)',
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=None,
+            help='Per-server timeout in seconds for fetching keys',
+        )
+
+    def handle(self, *args, **options):
+        servers = VPNServer.objects.filter(active=True)
+        if options['server']:
+            servers = VPNServer.objects.filter(id__in=options['server'])
+
+        report = reconcile_servers(servers, dry_run=options['dry_run'], timeout=options['timeout'],
+                                   delete_unknown=options['delete_unknown'])
+        for server_name, stats in report['servers'].items():
+            if 'error' in stats:
+                self.stdout.write(self.style.ERROR(f"{server_name}: {stats['error']}"))
+                continue
+            line = (
+                f"{server_name}: {stats['remote_keys']} in Outline, {stats['active_keys']} active in DB; "
+                f"{stats['orphans']} orphans, {stats['unknown']} unknown, {stats['ghosts']} ghosts, "
+                f"{stats['names']} name and {stats['limits']} limit mismatches"
+            )
+            if stats.get('failed'):
+                line += f", {stats['failed']} fixes failed"
+            differs = stats['orphans'] or stats['unknown'] or stats['ghosts'] or stats['names'] or stats['limits']
+            self.stdout.write(self.style.WARNING(line) if differs else line)
+
+        summary = (
+            f"{report['orphans']} orphans, {report['unknown']} unknown, {report['ghosts']} ghosts, "
+            f"{report['names']} name and {report['limits']} limit mismatches in {report['seconds']:.3f}s"
+        )
+        if options['dry_run']:
+            self.stdout.write(self.style.NOTICE(f"Dry run: {summary}"))
+        elif report['failed']:
+            self.stdout.write(self.style.WARNING(f"{summary}; {report['fixed']} fixed, {report['failed']} failed"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{summary}; {report['fixed']} fixed"))
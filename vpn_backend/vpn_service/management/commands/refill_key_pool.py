@@ -0,0 +1,77 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from vpn_service.models import VPNServer
+from vpn_service.utils.key_pool import refill_pools, prune_claimed
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Pre-create unassigned Outline keys so key issuance is a single DB claim'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--low-water',
+            type=int,
+            default=settings.KEY_POOL_LOW_WATER,
+            help='Refill a server pool when it has fewer free keys than this',
+        )
+        parser.add_argument(
+            '--target',
+            type=int,
+            default=settings.KEY_POOL_TARGET,
+            help='Number of free keys to refill each pool up to',
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep refilling every --interval seconds',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.KEY_POOL_REFILL_INTERVAL,
+            help='Seconds between refills in --loop mode',
+        )
+
+    def handle(self, *args, **options):
+        if options['target'] < options['low_water']:
+            self.stdout.write(self.style.ERROR('--target must not be lower than --low-water'))
+            return
+
+        while True:
+            started = time.monotonic()
+            try:
+                self._refill_once(options['low_water'], options['target'])
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('Key pool refill failed')
+
+            if not options['loop']:
+                break
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def _refill_once(self, low_water, target):
+        started = time.monotonic()
+        report = refill_pools(VPNServer.objects.filter(active=True), low_water=low_water, target=target)
+        for row in report:
+            line = (
+                f"{row['server_name']}: {row['created']}/{row['requested']} keys created, {row['failed']} failed "
+                f"(depth {row['depth_before']}, {row['seconds']:.3f}s)"
+            )
+            if row['error'] or row['created'] < row['requested']:
+                self.stdout.write(self.style.WARNING(f"{line} {row['error'] or ''}".rstrip()))
+            else:
+                self.stdout.write(line)
+
+        pruned = prune_claimed()
+        created = sum(row['created'] for row in report)
+        failed = sum(row['failed'] for row in report)
+        style = self.style.WARNING if failed else self.style.SUCCESS
+        self.stdout.write(style(
+            f"Refilled {len(report)} pools with {created} keys ({failed} failed), pruned {pruned} claimed "
+            f"records in {time.monotonic() - started:.3f}s"
+        ))
@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from vpn_service.utils.traffic_rollup import rollup_traffic, prune_traffic
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Roll up new traffic samples into hourly and daily tables and prune old history'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.TRAFFIC_ROLLUP_BATCH_SIZE,
+            help='Number of samples rolled up per transaction',
+        )
+        parser.add_argument(
+            '--no-prune',
+            action='store_true',
+            help='Do not delete samples and hourly rows past their retention',
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Keep rolling up every --interval seconds',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.TRAFFIC_ROLLUP_INTERVAL,
+            help='Seconds between runs in --loop mode',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            try:
+                self._run(options['batch_size'], not options['no_prune'])
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('Traffic rollup failed')
+
+            if not options['loop']:
+                break
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def _run(self, batch_size, prune):
+        report = rollup_traffic(batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['samples']} samples -> {report['hourly']} hourly, "
+            f"{report['daily']} daily rows in {report['seconds']:.3f}s"
+        ))
+        if prune:
+            pruned = prune_traffic()
+            self.stdout.write(f"Pruned {pruned['samples']} samples, {pruned['hourly']} hourly rows")
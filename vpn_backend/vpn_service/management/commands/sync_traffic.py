@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from vpn_service.models import VPNServer
+from vpn_service.utils.traffic import sync_servers_traffic
+import time
+
+
+class Command(BaseCommand):
+    help = 'Sync traffic usage of all keys with one Outline get_keys() call per server'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--server',
+            type=int,
+            action='append',
+            dest='server_ids',
+            help='Only sync the given server id (can be repeated)',
+        )
+        parser.add_argument(
+            '--include-inactive',
+            action='store_true',
+            help='Also sync servers marked as inactive',
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            help='Per-server timeout in seconds for fetching keys',
+        )
+
+    def handle(self, *args, **options):
+        servers = VPNServer.objects.all()
+        if not options.get('include_inactive'):
+            servers = servers.filter(active=True)
+        if options.get('server_ids'):
+            servers = servers.filter(id__in=options['server_ids'])
+
+        started = time.monotonic()
+        synced = failed = 0
+        for result in sync_servers_traffic(servers, timeout=options.get('timeout')):
+            if 'error' in result:
+                failed += 1
+                self.stdout.write(self.style.ERROR(
+                    f"{result['server_name']}: {result['error']} (after {result['fetch_seconds']:.3f}s)"
+                ))
+                continue
+
+            synced += 1
+            self.stdout.write(
+                f"{result['server_name']}: {result['updated']} updated, "
+                f"{result['remote_keys']} remote keys, {result['missing']} missing in Outline "
+                f"(fetch {result['fetch_seconds']:.3f}s, store {result['store_seconds']:.3f}s)"
+            )
+
+        elapsed = time.monotonic() - started
+        style = self.style.SUCCESS if not failed else self.style.WARNING
+        self.stdout.write(style(f"Synced {synced} servers, {failed} failed in {elapsed:.3f}s"))
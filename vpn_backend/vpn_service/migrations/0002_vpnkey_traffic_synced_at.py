@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vpnkey',
+            name='traffic_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
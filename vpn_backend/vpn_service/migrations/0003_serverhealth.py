@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0002_vpnkey_traffic_synced_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServerHealth',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('latency_ms', models.FloatField(blank=True, null=True)),
+                ('last_checked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_success_at', models.DateTimeField(blank=True, null=True)),
+                ('last_failure_at', models.DateTimeField(blank=True, null=True)),
+                ('consecutive_failures', models.IntegerField(default=0)),
+                ('last_error', models.CharField(blank=True, default='', max_length=255)),
+                ('vpn_server', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='health', to='vpn_service.vpnserver')),
+            ],
+        ),
+    ]
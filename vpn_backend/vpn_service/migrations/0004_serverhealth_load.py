@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0003_serverhealth'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serverhealth',
+            name='connected_clients',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='serverhealth',
+            name='transferred_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0004_serverhealth_load'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledKey',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('outline_id', models.CharField(max_length=50)),
+                ('access_url', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('vpn_server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pooled_keys', to='vpn_service.vpnserver')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['vpn_server', 'claimed_at'], name='vpn_service_vpn_ser_323546_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0005_pooledkey'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='vpnkey',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['expiration_date'], name='vpnkey_active_expiration_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vpnkey',
+            index=models.Index(condition=models.Q(('is_active', True), ('traffic_limit__gt', 0)), fields=['vpn_server'], name='vpnkey_active_limited_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0006_vpnkey_enforcement_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['created_at', 'id'], name='user_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vpnkey',
+            index=models.Index(fields=['created_at', 'id'], name='vpnkey_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vpnkey',
+            index=models.Index(fields=['user', 'is_active'], name='vpnkey_user_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vpnkey',
+            index=models.Index(fields=['vpn_server', 'is_active'], name='vpnkey_server_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vpnkey',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'created_at'], name='vpnkey_active_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0007_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrafficRollupState',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('last_sample_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrafficDaily',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('bucket', models.DateTimeField()),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='vpn_service.user')),
+                ('vpn_key', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='vpn_service.vpnkey')),
+                ('vpn_server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='vpn_service.vpnserver')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrafficSample',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('collected_at', models.DateTimeField()),
+                ('delta_bytes', models.BigIntegerField()),
+                ('vpn_key', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='traffic_samples', to='vpn_service.vpnkey')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['collected_at'], name='vpn_service_collect_33929d_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TrafficHourly',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('bucket', models.DateTimeField()),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='vpn_service.user')),
+                ('vpn_key', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='vpn_service.vpnkey')),
+                ('vpn_server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='vpn_service.vpnserver')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket'], name='vpn_service_bucket_03c187_idx'), models.Index(fields=['user', 'bucket'], name='vpn_service_user_id_24897b_idx'), models.Index(fields=['vpn_server', 'bucket'], name='vpn_service_vpn_ser_60e40a_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='traffichourly',
+            constraint=models.UniqueConstraint(fields=('vpn_key', 'bucket'), name='traffic_hourly_key_bucket_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='trafficdaily',
+            index=models.Index(fields=['bucket'], name='vpn_service_bucket_3d35fd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trafficdaily',
+            index=models.Index(fields=['user', 'bucket'], name='vpn_service_user_id_1fdb19_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trafficdaily',
+            index=models.Index(fields=['vpn_server', 'bucket'], name='vpn_service_vpn_ser_01bdc5_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='trafficdaily',
+            constraint=models.UniqueConstraint(fields=('vpn_key', 'bucket'), name='traffic_daily_key_bucket_uniq'),
+        ),
+    ]
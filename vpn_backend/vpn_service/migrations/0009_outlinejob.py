@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0008_traffic_samples'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutlineJob',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('create_key', 'Create key'), ('revoke_key', 'Revoke key'), ('set_limit', 'Set traffic limit')], max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('payload', models.JSONField(default=dict)),
+                ('result', models.JSONField(blank=True, default=dict)),
+                ('idempotency_key', models.CharField(blank=True, max_length=100, null=True, unique=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.CharField(blank=True, default='', max_length=255)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('vpn_key', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='vpn_service.vpnkey')),
+                ('vpn_server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='vpn_service.vpnserver')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 'pending')), fields=['run_after', 'id'], name='outlinejob_pending_idx'), models.Index(condition=models.Q(('status', 'running')), fields=['vpn_server'], name='outlinejob_running_server_idx')],
+            },
+        ),
+    ]
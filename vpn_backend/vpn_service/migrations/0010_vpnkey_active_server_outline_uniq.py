@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-18 11:46
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+from django.utils import timezone
+
+
+def deactivate_duplicate_keys(apps, schema_editor):
+    # Переустановленный сервер Outline заново выдает те же id: из активных строк с одним
+    # (vpn_server, outline_id) активной остается самая новая, иначе ограничение не создастся
+    VPNKey = apps.get_model('vpn_service', 'VPNKey')
+    duplicates = (
+        VPNKey.objects.filter(is_active=True)
+        .values('vpn_server_id', 'outline_id')
+        .annotate(count=Count('id'), newest=Max('id'))
+        .filter(count__gt=1)
+    )
+    for row in duplicates.iterator():
+        (
+            VPNKey.objects.filter(is_active=True, vpn_server_id=row['vpn_server_id'], outline_id=row['outline_id'])
+            .exclude(id=row['newest'])
+            .update(is_active=False, updated_at=timezone.now())
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0009_outlinejob'),
+    ]
+
+    operations = [
+        migrations.RunPython(deactivate_duplicate_keys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='vpnkey',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('vpn_server', 'outline_id'), name='vpnkey_active_server_outline_uniq'),
+        ),
+    ]
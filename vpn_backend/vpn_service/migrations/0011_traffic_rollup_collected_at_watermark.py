@@ -0,0 +1,41 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:02
+
+from django.db import migrations, models
+
+
+def set_collected_at_watermark(apps, schema_editor):
+    # Продолжаем с самого позднего сэмпла, уже учтенного по старому водяному знаку (id)
+    TrafficRollupState = apps.get_model('vpn_service', 'TrafficRollupState')
+    TrafficSample = apps.get_model('vpn_service', 'TrafficSample')
+    for state in TrafficRollupState.objects.all():
+        last = (
+            TrafficSample.objects.filter(id__lte=state.last_sample_id)
+            .order_by('-collected_at', '-id').values_list('collected_at', 'id').first()
+        )
+        if last is not None:
+            state.last_collected_at, state.last_sample_id = last
+            state.save(update_fields=['last_collected_at', 'last_sample_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0010_vpnkey_active_server_outline_uniq'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='trafficsample',
+            name='vpn_service_collect_33929d_idx',
+        ),
+        migrations.AddField(
+            model_name='trafficrollupstate',
+            name='last_collected_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='trafficsample',
+            index=models.Index(fields=['collected_at', 'id'], name='trafficsample_collected_id_idx'),
+        ),
+        migrations.RunPython(set_collected_at_watermark, migrations.RunPython.noop),
+    ]
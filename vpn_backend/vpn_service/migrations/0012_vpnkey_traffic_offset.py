@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0011_traffic_rollup_collected_at_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vpnkey',
+            name='traffic_offset',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
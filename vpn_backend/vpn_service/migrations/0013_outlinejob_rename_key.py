@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0012_vpnkey_traffic_offset'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outlinejob',
+            name='kind',
+            field=models.CharField(choices=[('create_key', 'Create key'), ('revoke_key', 'Revoke key'), ('set_limit', 'Set traffic limit'), ('rename_key', 'Rename key')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vpn_service', '0013_outlinejob_rename_key'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='serverhealth',
+            old_name='connected_clients',
+            new_name='keys_with_traffic',
+        ),
+    ]
@@ -39,6 +39,22 @@ class VPNServer(models.Model):
         return f"{self.server_name} - {self.city}"
 
 
+class ServerHealth(models.Model):
+    id = models.AutoField(primary_key=True)
+    vpn_server = models.OneToOneField(VPNServer, on_delete=models.CASCADE, related_name='health')
+    latency_ms = models.FloatField(null=True, blank=True)
+    last_checked_at = models.DateTimeField(null=True, blank=True)
+    last_success_at = models.DateTimeField(null=True, blank=True)
+    last_failure_at = models.DateTimeField(null=True, blank=True)
+    consecutive_failures = models.IntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True, default='')
+    transferred_bytes = models.BigIntegerField(null=True, blank=True)
+    keys_with_traffic = models.IntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.vpn_server.server_name}: {self.consecutive_failures} failures"
+
+
 class User(models.Model):
     id = models.AutoField(primary_key=True)
     telegram_id = models.BigIntegerField(unique=True)
@@ -49,6 +65,11 @@ class User(models.Model):
     last_login = models.DateTimeField(null=True, blank=True)
     is_active = models.BooleanField(default=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='user_created_id_idx'),
+        ]
+
     def __str__(self):
         return f"{self.username or self.telegram_id}"
 
@@ -64,17 +85,31 @@ class VPNKey(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     expiration_date = models.DateTimeField(null=True, blank=True)
     traffic_limit = models.BigIntegerField(default=0)  # в байтах
+    traffic_used = models.BigIntegerField(default=0)  # снимок из Outline, в байтах
+    traffic_offset = models.BigIntegerField(default=0)  # трафик прежних ключей до переноса на другой сервер, в байтах
     traffic_last_period_bytes = models.BigIntegerField(default=0)
+    traffic_synced_at = models.DateTimeField(null=True, blank=True)
     is_active = models.BooleanField(default=True)
 
-    @property
-    def traffic_used(self):
-        from .utils.outline import OutlineVPNClient
-        client = OutlineVPNClient(api_url=self.vpn_server.api_url, cert_sha256=self.vpn_server.cert_sha)
-        if client.get_key(key_id=self.outline_id).used_bytes is not None:
-            return client.get_key(key_id=self.outline_id).used_bytes
-        else:
-            return 0
+    class Meta:
+        indexes = [
+            # Для enforce_keys: истекшие и ограниченные по трафику активные ключи
+            models.Index(fields=['expiration_date'], condition=models.Q(is_active=True),
+                         name='vpnkey_active_expiration_idx'),
+            models.Index(fields=['vpn_server'], condition=models.Q(is_active=True, traffic_limit__gt=0),
+                         name='vpnkey_active_limited_idx'),
+            # Курсорная пагинация и фильтры, которые реально используются
+            models.Index(fields=['created_at', 'id'], name='vpnkey_created_id_idx'),
+            models.Index(fields=['user', 'is_active'], name='vpnkey_user_active_idx'),
+            models.Index(fields=['vpn_server', 'is_active'], name='vpnkey_server_active_idx'),
+            models.Index(fields=['user', 'created_at'], condition=models.Q(is_active=True),
+                         name='vpnkey_active_user_created_idx'),
+        ]
+        constraints = [
+            # Один активный ключ на outline_id сервера; на него опирается bulk_create(ignore_conflicts) при импорте
+            models.UniqueConstraint(fields=['vpn_server', 'outline_id'], condition=models.Q(is_active=True),
+                                    name='vpnkey_active_server_outline_uniq'),
+        ]
 
     def __str__(self):
         return f"{self.name} - {self.user}"
@@ -86,10 +121,147 @@ class VPNKey(models.Model):
 
     def traffic_limit_exceeded(self):
         if self.traffic_limit > 0:
-            return self.traffic_used >= self.traffic_limit
+            return self.traffic_used + self.traffic_offset >= self.traffic_limit
         return False
 
 
+class PooledKey(models.Model):
+    id = models.AutoField(primary_key=True)
+    vpn_server = models.ForeignKey(VPNServer, on_delete=models.CASCADE, related_name='pooled_keys')
+    outline_id = models.CharField(max_length=50)
+    access_url = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['vpn_server', 'claimed_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.outline_id} - {self.vpn_server.server_name}"
+
+
+class OutlineJob(models.Model):
+    """Отложенная операция с Outline API, выполняется воркером process_jobs"""
+    CREATE_KEY = 'create_key'
+    REVOKE_KEY = 'revoke_key'
+    SET_LIMIT = 'set_limit'
+    RENAME_KEY = 'rename_key'
+    KIND_CHOICES = [
+        (CREATE_KEY, 'Create key'),
+        (REVOKE_KEY, 'Revoke key'),
+        (SET_LIMIT, 'Set traffic limit'),
+        (RENAME_KEY, 'Rename key'),
+    ]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    vpn_server = models.ForeignKey(VPNServer, on_delete=models.CASCADE, related_name='jobs')
+    vpn_key = models.ForeignKey(VPNKey, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+    payload = models.JSONField(default=dict)
+    result = models.JSONField(default=dict, blank=True)
+    idempotency_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True, default='')
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['run_after', 'id'], condition=models.Q(status='pending'),
+                         name='outlinejob_pending_idx'),
+            models.Index(fields=['vpn_server'], condition=models.Q(status='running'),
+                         name='outlinejob_running_server_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} #{self.id} ({self.status})"
+
+
+class TrafficSample(models.Model):
+    """Прирост трафика ключа между двумя синхронизациями; нулевые приросты не сохраняются"""
+    id = models.BigAutoField(primary_key=True)
+    vpn_key = models.ForeignKey(VPNKey, on_delete=models.CASCADE, related_name='traffic_samples')
+    collected_at = models.DateTimeField()
+    delta_bytes = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            # Водяной знак сводок (collected_at, id) и очистка старых сэмплов
+            models.Index(fields=['collected_at', 'id'], name='trafficsample_collected_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.vpn_key_id} +{self.delta_bytes} @ {self.collected_at}"
+
+
+class TrafficRollup(models.Model):
+    # Пользователь и сервер денормализованы, чтобы агрегаты читали только таблицу сводки
+    id = models.BigAutoField(primary_key=True)
+    vpn_key = models.ForeignKey(VPNKey, on_delete=models.CASCADE, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    vpn_server = models.ForeignKey(VPNServer, on_delete=models.CASCADE, related_name='+')
+    bucket = models.DateTimeField()
+    bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return f"{self.vpn_key_id} {self.bucket}: {self.bytes}"
+
+
+class TrafficHourly(TrafficRollup):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['vpn_key', 'bucket'], name='traffic_hourly_key_bucket_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['bucket']),
+            models.Index(fields=['user', 'bucket']),
+            models.Index(fields=['vpn_server', 'bucket']),
+        ]
+
+
+class TrafficDaily(TrafficRollup):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['vpn_key', 'bucket'], name='traffic_daily_key_bucket_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['bucket']),
+            models.Index(fields=['user', 'bucket']),
+            models.Index(fields=['vpn_server', 'bucket']),
+        ]
+
+
+class TrafficRollupState(models.Model):
+    """Водяной знак сводок: (collected_at, id) последнего учтенного TrafficSample (одна строка)"""
+    id = models.AutoField(primary_key=True)
+    last_collected_at = models.DateTimeField(null=True, blank=True)
+    last_sample_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Traffic rollup up to {self.last_collected_at} (sample {self.last_sample_id})"
+
+
 class TelegramBot(models.Model):
     id = models.AutoField(primary_key=True)
     bot_id = models.CharField(max_length=50, unique=True)
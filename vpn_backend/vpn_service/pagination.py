@@ -0,0 +1,8 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedAtCursorPagination(CursorPagination):
+    """Курсорная пагинация по (created_at, id): без COUNT(*) и OFFSET, время страницы не зависит от ее номера"""
+    ordering = ('created_at', 'id')
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from vpn_service.models import Country, City, VPNServer, User, VPNKey, TelegramBot
+from vpn_service.models import Country, City, VPNServer, User, VPNKey, TelegramBot, ServerHealth, OutlineJob
 
 
 class CountrySerializer(serializers.ModelSerializer):
@@ -33,6 +33,16 @@ class VPNServerRegistrationSerializer(serializers.ModelSerializer):
         fields = ['server_name', 'city', 'server_location', 'api_key', 'cert_sha', 'api_url']
 
 
+class ServerHealthSerializer(serializers.ModelSerializer):
+    server_name = serializers.ReadOnlyField(source='vpn_server.server_name')
+
+    class Meta:
+        model = ServerHealth
+        fields = ['vpn_server', 'server_name', 'latency_ms', 'last_checked_at', 'last_success_at',
+                  'last_failure_at', 'consecutive_failures', 'last_error', 'transferred_bytes',
+                  'keys_with_traffic']
+
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -51,8 +61,33 @@ class VPNKeySerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'user_telegram_id', 'vpn_server', 'server_name',
                   'server_location', 'outline_id', 'access_url', 'name', 'created_at',
                   'updated_at', 'expiration_date', 'traffic_limit', 'traffic_used',
-                  'traffic_last_period_bytes', 'is_active']
-        read_only_fields = ['created_at', 'updated_at', 'outline_id', 'access_url']
+                  'traffic_offset', 'traffic_last_period_bytes', 'traffic_synced_at', 'is_active']
+        read_only_fields = ['created_at', 'updated_at', 'outline_id', 'access_url',
+                            'traffic_used', 'traffic_offset', 'traffic_synced_at']
+
+
+class BulkKeyItemSerializer(serializers.Serializer):
+    user_id = serializers.IntegerField()
+    server_id = serializers.IntegerField(required=False)
+    country_id = serializers.IntegerField(required=False)
+    name = serializers.CharField(max_length=100, default='VPN Key')
+    traffic_limit = serializers.IntegerField(min_value=0, default=0)  # в байтах
+    expiration_days = serializers.IntegerField(min_value=1, required=False)
+
+
+class BulkUserItemSerializer(serializers.Serializer):
+    telegram_id = serializers.IntegerField()
+    username = serializers.CharField(max_length=100, required=False, allow_null=True, allow_blank=True)
+    first_name = serializers.CharField(max_length=100, required=False, allow_null=True, allow_blank=True)
+    phone_number = serializers.CharField(max_length=20, required=False, allow_null=True, allow_blank=True)
+
+
+class OutlineJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = OutlineJob
+        fields = ['id', 'kind', 'status', 'vpn_server', 'vpn_key', 'result', 'attempts',
+                  'last_error', 'run_after', 'created_at', 'updated_at', 'finished_at']
+        read_only_fields = fields
 
 
 class TelegramBotSerializer(serializers.ModelSerializer):
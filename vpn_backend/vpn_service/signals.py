@@ -0,0 +1,39 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Country, City, VPNServer, User, VPNKey
+from .utils.catalog import server_catalog
+from .utils.outline import client_pool
+from .utils.selection import server_ranking
+from .utils.user_cache import user_cache
+
+
+@receiver([post_save, post_delete], sender=VPNServer)
+def invalidate_outline_client(sender, instance, **kwargs):
+    # Данные сервера могли измениться — пересоздаем клиент и рейтинг серверов при следующем обращении
+    client_pool.invalidate(instance.id)
+    server_ranking.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Country)
+@receiver([post_save, post_delete], sender=City)
+@receiver([post_save, post_delete], sender=VPNServer)
+def invalidate_catalog(sender, instance, **kwargs):
+    # Новая версия каталога только после коммита, иначе другой процесс может собрать его из старых данных
+    transaction.on_commit(server_catalog.invalidate)
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_cache(sender, instance, **kwargs):
+    user_cache.invalidate(instance.telegram_id)
+
+
+@receiver([post_save, post_delete], sender=VPNKey)
+def invalidate_user_keys_cache(sender, instance, **kwargs):
+    # В кэше пользователя лежат его активные ключи
+    if VPNKey.user.is_cached(instance):
+        telegram_id = instance.user.telegram_id
+    else:
+        telegram_id = User.objects.filter(id=instance.user_id).values_list('telegram_id', flat=True).first()
+    if telegram_id is not None:
+        user_cache.invalidate(telegram_id)
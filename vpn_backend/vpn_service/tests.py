@@ -1,3 +1,477 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import threading
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .models import Country, City, VPNServer, User, VPNKey, PooledKey, OutlineJob, TrafficSample
+from .utils.catalog import server_catalog
+from .utils.fake_outline import FakeOutlineServer
+from .utils.jobs import enqueue_job, process_jobs
+from .utils.key_pool import claim_key
+from .utils.outline import breaker, CircuitBreaker, outline_key_name, ServerUnavailable
+from .utils.outline_async import AsyncOutlineVPNClient
+from .utils.rebalance import drain_servers
+from .utils.reconcile import reconcile_servers
+from .utils.traffic import apply_used_bytes, sync_servers_traffic
+
+
+class ListQueryCountTests(TestCase):
+    """
+    Число SQL-запросов списков не должно зависеть от числа строк: связанные
+    объекты загружаются заранее (select_related), а не по запросу на строку.
+    Замеры времени на разных объемах — manage.py bench_queries.
+    """
+
+    sizes = (10, 100)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = {}
+        for size in cls.sizes:
+            country = Country.objects.create(country_name=f'Test country {size}')
+            cities = City.objects.bulk_create(
+                City(city_name=f'Test city {size}-{i}', country=country) for i in range(size)
+            )
+            servers = VPNServer.objects.bulk_create(
+                VPNServer(server_name=f'test-{size}-{i}', city=cities[i], server_location='test',
+                          api_key='test', cert_sha='test', api_url='https://127.0.0.1:1/test')
+                for i in range(size)
+            )
+            user = User.objects.create(telegram_id=-size, username=f'test{size}')
+            VPNKey.objects.bulk_create(
+                VPNKey(user=user, vpn_server=servers[0], outline_id=str(i), access_url='ss://test',
+                       name=f'test key {i}')
+                for i in range(size)
+            )
+            cls.data[size] = {'user': user, 'server': servers[0]}
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def assertQueries(self, url, expected):
+        with self.assertNumQueries(expected):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_keys_list(self):
+        # Курсорная пагинация: один SELECT без COUNT
+        response = self.assertQueries('/api/keys/', 1)
+        self.assertTrue(response.data['results'])
+
+    def test_servers_list(self):
+        self.assertQueries('/api/servers/', 2)
+
+    def test_cities_list(self):
+        self.assertQueries('/api/cities/', 2)
+
+    def test_user_keys(self):
+        for size in self.sizes:
+            with self.subTest(size=size):
+                response = self.assertQueries(f"/api/users/{self.data[size]['user'].id}/keys/", 2)
+                self.assertEqual(len(response.data), size)
+
+    def test_server_keys(self):
+        for size in self.sizes:
+            with self.subTest(size=size):
+                response = self.assertQueries(f"/api/servers/{self.data[size]['server'].id}/keys/", 2)
+                self.assertEqual(len(response.data), size)
+
+
+class BulkUpsertTests(TestCase):
+    def test_returns_ids_of_created_and_updated_users(self):
+        existing = User.objects.create(telegram_id=100, username='old')
+        response = APIClient().post('/api/users/bulk_upsert/', {'items': [
+            {'telegram_id': 100, 'username': 'renamed'},
+            {'telegram_id': 101, 'username': 'new'},
+            {'telegram_id': 102},
+            # Повтор telegram_id: побеждает последняя позиция
+            {'telegram_id': 101, 'username': 'newest'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['created'], data['updated'], data['failed']), (2, 1, 0))
+        expected = dict(User.objects.values_list('telegram_id', 'id'))
+        self.assertEqual({int(telegram_id): user_id for telegram_id, user_id in data['ids'].items()}, expected)
+        self.assertEqual(data['ids']['100'], existing.id)
+        self.assertEqual(User.objects.get(telegram_id=100).username, 'renamed')
+        self.assertEqual(User.objects.get(telegram_id=101).username, 'newest')
+
+
+class CatalogTests(TestCase):
+    def setUp(self):
+        # Версия каталога живет в Django cache между тестами, а сигналы внутри TestCase не коммитятся
+        server_catalog.invalidate()
+        self.city = City.objects.create(city_name='Test city', country=Country.objects.create(country_name='Test'))
+
+    def test_etag_and_not_modified(self):
+        response = self.client.get('/api/catalog/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get('/api/catalog/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        # Новый сервер меняет версию каталога после коммита
+        with self.captureOnCommitCallbacks(execute=True):
+            VPNServer.objects.create(server_name='new', city=self.city, server_location='test', api_key='test',
+                                     cert_sha='test', api_url='https://127.0.0.1:1/test')
+        response = self.client.get('/api/catalog/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('new', [
+            server['server_name']
+            for country in response.json() for city in country['cities'] for server in city['servers']
+        ])
+
+
+class CursorPaginationTests(TestCase):
+    def test_pages_are_stable_while_rows_are_added(self):
+        # Одинаковый created_at: порядок страниц держится на id
+        User.objects.bulk_create(User(telegram_id=i, username=f'user{i}') for i in range(7))
+        User.objects.update(created_at=timezone.now() - datetime.timedelta(days=1))
+        existing = list(User.objects.order_by('id').values_list('id', flat=True))
+
+        seen, added = [], []
+        url = '/api/users/?page_size=3'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(user['id'] for user in response.data['results'])
+            url = response.data['next']
+            if len(added) < 2:
+                added.append(User.objects.create(telegram_id=1000 + len(added)).id)
+
+        self.assertEqual(seen, existing + added)
+
+
+class FakeOutlineTestCase(TransactionTestCase):
+    """
+    Тесты против фейкового Outline сервера (utils/fake_outline.py) в потоке процесса.
+
+    Fan-out выполняется в своем event loop, а breaker читает ServerHealth из
+    пула потоков sync_to_async, поэтому данные должны быть закоммичены —
+    отсюда TransactionTestCase. Состояние общего breaker сбрасывается в
+    каждом тесте.
+    """
+
+    def setUp(self):
+        self.reset_breaker()
+        self.addCleanup(self.reset_breaker)
+        country = Country.objects.create(country_name='Test')
+        self.city = City.objects.create(city_name='Test city', country=country)
+        self.user = User.objects.create(telegram_id=1, username='alice')
+
+    def reset_breaker(self):
+        breaker._state.clear()
+        breaker._refreshed_at = 0
+
+    def add_server(self, name='test', **options):
+        fake = FakeOutlineServer(**options).start()
+        self.addCleanup(fake.stop)
+        server = VPNServer.objects.create(server_name=name, city=self.city, server_location='test',
+                                          api_key='test', cert_sha='test', api_url=fake.api_url)
+        return server, fake
+
+    def add_key(self, server, fake, name='key', **fields):
+        remote = fake.state.create_key(name=outline_key_name(self.user, name))
+        return VPNKey.objects.create(user=self.user, vpn_server=server, outline_id=remote['id'],
+                                     access_url=remote['accessUrl'], name=name, **fields)
+
+
+class TrafficSyncTests(FakeOutlineTestCase):
+    def sync(self, server):
+        [result] = sync_servers_traffic([server])
+        self.assertNotIn('error', result)
+        return result
+
+    def deltas(self, vpn_key):
+        return list(TrafficSample.objects.filter(vpn_key=vpn_key).order_by('id').values_list('delta_bytes', flat=True))
+
+    def test_delta_and_counter_reset(self):
+        server, fake = self.add_server()
+        vpn_key = self.add_key(server, fake)
+        VPNKey.objects.create(user=self.user, vpn_server=server, outline_id='missing', access_url='ss://test',
+                              name='missing')
+
+        fake.state.add_traffic(vpn_key.outline_id, 1000)
+        result = self.sync(server)
+        self.assertEqual((result['updated'], result['missing']), (1, 1))
+        self.assertEqual(self.deltas(vpn_key), [1000])
+
+        fake.state.add_traffic(vpn_key.outline_id, 500)
+        self.sync(server)
+        # Без нового трафика нулевой прирост не сохраняется
+        self.sync(server)
+        self.assertEqual(self.deltas(vpn_key), [1000, 500])
+        vpn_key.refresh_from_db()
+        self.assertEqual(vpn_key.traffic_used, 1500)
+
+        # Счетчик Outline уменьшился (ключ пересоздан или сброшен) — прирост равен новому значению
+        fake.state.bytes_transferred[vpn_key.outline_id] = 200
+        self.sync(server)
+        self.assertEqual(self.deltas(vpn_key), [1000, 500, 200])
+        vpn_key.refresh_from_db()
+        self.assertEqual(vpn_key.traffic_used, 200)
+
+    def test_apply_used_bytes(self):
+        keys = [VPNKey(outline_id='1', traffic_used=100), VPNKey(outline_id='2', traffic_used=100),
+                VPNKey(outline_id='3', traffic_used=100), VPNKey(outline_id='4', traffic_used=100)]
+        updated, missing, samples = apply_used_bytes(keys, {'1': 150, '2': 100, '3': 40})
+        self.assertEqual([vpn_key.traffic_used for vpn_key in updated], [150, 100, 40])
+        self.assertEqual(missing, 1)
+        self.assertEqual([sample.delta_bytes for sample in samples], [50, 40])
+
+
+class ReconcileTests(FakeOutlineTestCase):
+    def test_classification_and_fixes(self):
+        server, fake = self.add_server()
+        matched = self.add_key(server, fake, 'matched')
+        renamed = self.add_key(server, fake, 'renamed')
+        fake.state.keys[renamed.outline_id]['name'] = 'stale name'
+        # Ключа нет в Outline, строка активна
+        ghost = VPNKey.objects.create(user=self.user, vpn_server=server, outline_id='ghost', access_url='ss://test',
+                                      name='ghost')
+        # Ключ остался в Outline после отзыва
+        orphan = self.add_key(server, fake, 'orphan', is_active=False)
+        # Ключ пула и ключ, о котором бэкенд ничего не знает
+        pooled = fake.state.create_key(name='Pooled key')
+        PooledKey.objects.create(vpn_server=server, outline_id=pooled['id'], access_url=pooled['accessUrl'])
+        unknown = fake.state.create_key(name='manual')
+
+        report = reconcile_servers([server], dry_run=True)
+        self.assertEqual(
+            {kind: report[kind] for kind in ('orphans', 'unknown', 'ghosts', 'names', 'limits', 'fixed')},
+            {'orphans': 1, 'unknown': 1, 'ghosts': 1, 'names': 1, 'limits': 0, 'fixed': 0},
+        )
+        self.assertIn(orphan.outline_id, fake.state.keys)
+
+        report = reconcile_servers([server])
+        self.assertEqual((report['fixed'], report['failed']), (3, 0))
+        ghost.refresh_from_db()
+        self.assertFalse(ghost.is_active)
+        self.assertNotIn(orphan.outline_id, fake.state.keys)
+        self.assertEqual(fake.state.keys[renamed.outline_id]['name'], outline_key_name(self.user, 'renamed'))
+        self.assertEqual(set(fake.state.keys), {matched.outline_id, renamed.outline_id, pooled['id'], unknown['id']})
+
+        report = reconcile_servers([server], delete_unknown=True)
+        self.assertEqual(report['unknown'], 1)
+        self.assertEqual(set(fake.state.keys), {matched.outline_id, renamed.outline_id, pooled['id']})
+
+    def test_rows_changed_after_fetch_are_not_ghosts(self):
+        server, fake = self.add_server()
+        vpn_key = VPNKey.objects.create(user=self.user, vpn_server=server, outline_id='gone', access_url='ss://test',
+                                        name='moved')
+        # updated_at позже запроса к Outline: строку успели изменить (например, перенос rebalance)
+        VPNKey.objects.filter(id=vpn_key.id).update(updated_at=timezone.now() + datetime.timedelta(minutes=1))
+        report = reconcile_servers([server])
+        self.assertEqual(report['ghosts'], 0)
+        vpn_key.refresh_from_db()
+        self.assertTrue(vpn_key.is_active)
+
+
+class RebalanceTests(FakeOutlineTestCase):
+    def test_drain_swaps_keys_to_target(self):
+        source, source_fake = self.add_server('source')
+        target, target_fake = self.add_server('target')
+        keys = [self.add_key(source, source_fake, f'key{i}', traffic_used=300, traffic_limit=1000) for i in range(2)]
+
+        report = drain_servers([source.id])
+        self.assertEqual((report['moved'], report['failed'], report['deleted'], report['unplaced']), (2, 0, 2, 0))
+
+        source.refresh_from_db()
+        self.assertFalse(source.active)
+        self.assertEqual(source_fake.state.keys, {})
+        for vpn_key in keys:
+            vpn_key.refresh_from_db()
+            self.assertEqual(vpn_key.vpn_server_id, target.id)
+            self.assertTrue(vpn_key.is_active)
+            # Трафик старого ключа переходит в traffic_offset, новому ключу — только остаток квоты
+            self.assertEqual((vpn_key.traffic_used, vpn_key.traffic_offset), (0, 300))
+            remote = target_fake.state.keys[vpn_key.outline_id]
+            self.assertEqual(remote['accessUrl'], vpn_key.access_url)
+            self.assertEqual(remote['name'], outline_key_name(self.user, vpn_key.name))
+            self.assertEqual(remote['dataLimit'], {'bytes': 700})
+
+    def test_keys_with_pending_jobs_stay(self):
+        source, source_fake = self.add_server('source')
+        self.add_server('target')
+        vpn_key = self.add_key(source, source_fake)
+        enqueue_job(OutlineJob.REVOKE_KEY, source, {'outline_id': vpn_key.outline_id}, vpn_key=vpn_key)
+
+        report = drain_servers([source.id])
+        self.assertEqual(report['moved'], 0)
+        vpn_key.refresh_from_db()
+        self.assertEqual(vpn_key.vpn_server_id, source.id)
+        self.assertIn(vpn_key.outline_id, source_fake.state.keys)
+
+
+class KeyPoolTests(FakeOutlineTestCase):
+    def fill_pool(self, server, fake, count):
+        for _ in range(count):
+            remote = fake.state.create_key(name='Pooled key')
+            PooledKey.objects.create(vpn_server=server, outline_id=remote['id'], access_url=remote['accessUrl'])
+
+    def test_claim_renames_and_limits_through_jobs(self):
+        server, fake = self.add_server()
+        self.fill_pool(server, fake, 1)
+
+        vpn_key = claim_key(server, self.user, 'phone', traffic_limit=500)
+        self.assertEqual(vpn_key.outline_id, PooledKey.objects.get().outline_id)
+        self.assertIsNone(claim_key(server, self.user, 'laptop'))
+
+        report = process_jobs()
+        self.assertEqual((report['claimed'], report['succeeded']), (2, 2))
+        remote = fake.state.keys[vpn_key.outline_id]
+        self.assertEqual(remote['name'], outline_key_name(self.user, 'phone'))
+        self.assertEqual(remote['dataLimit'], {'bytes': 500})
+
+    @skipUnlessDBFeature('has_select_for_update_skip_locked')
+    def test_concurrent_claims_take_distinct_keys(self):
+        server, fake = self.add_server()
+        self.fill_pool(server, fake, 5)
+        workers = 8
+        barrier = threading.Barrier(workers)
+        claimed = [None] * workers
+
+        def claim(index):
+            try:
+                barrier.wait()
+                claimed[index] = claim_key(server, self.user, f'key{index}')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim, args=(index,)) for index in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        keys = [vpn_key for vpn_key in claimed if vpn_key is not None]
+        self.assertEqual(len(keys), 5)
+        self.assertEqual(len({vpn_key.outline_id for vpn_key in keys}), 5)
+        self.assertFalse(PooledKey.objects.filter(claimed_at=None).exists())
+        self.assertEqual(OutlineJob.objects.filter(kind=OutlineJob.RENAME_KEY).count(), 5)
+
+
+class OutlineJobTests(FakeOutlineTestCase):
+    def enqueue_create(self, server, traffic_limit=100):
+        job, _ = enqueue_job(OutlineJob.CREATE_KEY, server, {
+            'user_id': self.user.id, 'name': 'phone', 'outline_name': outline_key_name(self.user, 'phone'),
+            'traffic_limit': traffic_limit,
+        })
+        return job
+
+    def test_create_key(self):
+        server, fake = self.add_server()
+        job = self.enqueue_create(server)
+
+        self.assertEqual(process_jobs()['succeeded'], 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutlineJob.SUCCEEDED)
+        vpn_key = VPNKey.objects.get(id=job.result['key_id'])
+        self.assertEqual(fake.state.keys[vpn_key.outline_id]['dataLimit'], {'bytes': 100})
+
+    @override_settings(JOB_MAX_ATTEMPTS=2, JOB_BACKOFF_BASE=10, JOB_BACKOFF_MAX=60)
+    def test_retry_with_backoff_then_terminal_failure(self):
+        server, fake = self.add_server()
+        job = self.enqueue_create(server)
+
+        async def reject_limit(client, key_id, limit_bytes):
+            return False
+
+        with mock.patch.object(AsyncOutlineVPNClient, 'add_data_limit', reject_limit):
+            started = timezone.now()
+            self.assertEqual(process_jobs()['retried'], 1)
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (OutlineJob.PENDING, 1))
+            # JOB_BACKOFF_BASE * 2^0 с разбросом ±20%
+            delay = (job.run_after - started).total_seconds()
+            self.assertTrue(8 <= delay <= 13, delay)
+            self.assertEqual(list(fake.state.keys), [job.result['outline_id']])
+
+            # До run_after задача не берется
+            self.assertEqual(process_jobs()['claimed'], 0)
+
+            OutlineJob.objects.update(run_after=timezone.now())
+            self.assertEqual(process_jobs()['failed'], 1)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (OutlineJob.FAILED, 2))
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(job.last_error, 'Unable to set data limit')
+        # Повторная попытка не создала второй ключ, а после окончательной неудачи созданный ключ удален
+        self.assertEqual(fake.state.keys, {})
+        self.assertFalse(VPNKey.objects.exists())
+
+    def test_open_breaker_defers_without_spending_attempt(self):
+        server, fake = self.add_server()
+        job = self.enqueue_create(server)
+        for _ in range(3):
+            breaker.record_failure(server.id)
+
+        report = process_jobs()
+        self.assertEqual((report['claimed'], report['deferred']), (1, 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (OutlineJob.PENDING, 0))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertEqual(fake.state.keys, {})
+
+
+class CircuitBreakerTests(FakeOutlineTestCase):
+    def request(self, server, circuit):
+        async def run():
+            async with AsyncOutlineVPNClient(server.api_url, timeout=(1, 1), server_id=server.id,
+                                             breaker=circuit) as client:
+                return await client.get_server_information()
+        return asyncio.run(run())
+
+    def expire_cooldown(self, circuit, server):
+        circuit._state[server.id]['opened_at'] -= circuit.cooldown
+
+    def test_open_and_half_open(self):
+        server, fake = self.add_server()
+        circuit = CircuitBreaker(failure_threshold=2, cooldown=30, refresh_interval=3600)
+        circuit.refresh()
+
+        fake.configure(drop_rate=1)
+        with self.assertRaises(httpx.TransportError):
+            self.request(server, circuit)
+        self.assertFalse(circuit.is_open(server.id))
+        with self.assertRaises(httpx.TransportError):
+            self.request(server, circuit)
+        self.assertTrue(circuit.is_open(server.id))
+
+        # Разомкнутая цепь не пропускает запросы даже к ожившему серверу
+        fake.configure(drop_rate=0)
+        with self.assertRaises(ServerUnavailable):
+            self.request(server, circuit)
+
+        # После cooldown полуоткрытая цепь пропускает ровно один пробный запрос
+        self.expire_cooldown(circuit, server)
+        self.assertFalse(circuit.is_open(server.id))
+        self.assertTrue(circuit.allow(server.id))
+        self.assertFalse(circuit.allow(server.id))
+
+        # Неудачная проба снова размыкает цепь
+        self.expire_cooldown(circuit, server)
+        fake.configure(drop_rate=1)
+        with self.assertRaises(httpx.TransportError):
+            self.request(server, circuit)
+        self.assertTrue(circuit.is_open(server.id))
+
+        # Удачная проба замыкает цепь
+        self.expire_cooldown(circuit, server)
+        fake.configure(drop_rate=0)
+        self.assertEqual(self.request(server, circuit)['name'], 'Fake Outline')
+        self.assertFalse(circuit.is_open(server.id))
+        self.assertTrue(circuit.allow(server.id))
+        self.assertTrue(circuit.allow(server.id))
@@ -1,8 +1,9 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from . import async_views
 from .views import (
     CountryViewSet, CityViewSet, VPNServerViewSet,
-    UserViewSet, VPNKeyViewSet, TelegramBotViewSet
+    UserViewSet, VPNKeyViewSet, TelegramBotViewSet, OutlineJobViewSet, CatalogView, TrafficTopView
 )
 
 router = DefaultRouter()
@@ -11,7 +12,17 @@ router.register(r'cities', CityViewSet)
 router.register(r'servers', VPNServerViewSet)
 router.register(r'users', UserViewSet)
 router.register(r'keys', VPNKeyViewSet)
+router.register(r'jobs', OutlineJobViewSet)
 
 urlpatterns = [
+    path('catalog/', CatalogView.as_view(), name='catalog'),
+    path('traffic/top/', TrafficTopView.as_view(), name='traffic-top'),
+    # Async версии view, ждущих Outline API; без блокировки потоков работают под ASGI
+    path('async/keys/create_key/', async_views.create_key, name='async-key-create'),
+    path('async/keys/<int:pk>/revoke/', async_views.revoke, name='async-key-revoke'),
+    path('async/keys/<int:pk>/update_traffic/', async_views.update_traffic, name='async-key-update-traffic'),
+    path('async/servers/<int:pk>/test_connection/', async_views.test_connection,
+         name='async-server-test-connection'),
+    path('async/servers/<int:pk>/keys/', async_views.server_keys, name='async-server-keys'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
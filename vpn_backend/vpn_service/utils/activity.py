@@ -0,0 +1,135 @@
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, DateTimeField, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from vpn_service.models import User
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityBuffer:
+    """
+    Write-behind буфер отметок активности (User.last_login) в памяти процесса.
+
+    touch() только запоминает время последней активности пользователя, по
+    одной записи на telegram_id. Фоновый поток раз в flush_interval секунд (или
+    сразу, когда в буфере max_size пользователей) записывает накопленное
+    UPDATE-запросами по chunk_size пользователей, поэтому тысячи сообщений бота
+    превращаются в несколько запросов. В БД last_login только растет: если
+    другой процесс уже записал более позднее время, оно сохраняется. Остаток
+    буфера записывается при завершении процесса через atexit; при аварийном
+    завершении теряются отметки за последние flush_interval секунд.
+    """
+
+    chunk_size = 1000
+
+    def __init__(self, flush_interval=None, max_size=None):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.touches = 0
+        self.flushes = 0
+        self.flushed_users = 0
+
+    def _settings(self):
+        return (
+            self.flush_interval or settings.ACTIVITY_FLUSH_INTERVAL,
+            self.max_size or settings.ACTIVITY_BUFFER_MAX_SIZE,
+        )
+
+    def touch(self, telegram_id, at=None):
+        """Запоминает активность пользователя; в БД попадет при следующей записи буфера"""
+        at = at or timezone.now()
+        _, max_size = self._settings()
+        with self._lock:
+            previous = self._pending.get(telegram_id)
+            if previous is None or previous < at:
+                self._pending[telegram_id] = at
+            self.touches += 1
+            size = len(self._pending)
+            self._ensure_thread()
+        if size >= max_size:
+            self._wakeup.set()
+        return size
+
+    def _ensure_thread(self):
+        # Вызывается под self._lock
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='activity-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            flush_interval, _ = self._settings()
+            self._wakeup.wait(flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush user activity')
+            finally:
+                # Поток живет между записями долго — не держим соединение с БД открытым
+                connection.close()
+
+    def flush(self):
+        """Записывает накопленные отметки в БД; при ошибке они возвращаются в буфер. Возвращает число пользователей"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        items = list(pending.items())
+        try:
+            for start in range(0, len(items), self.chunk_size):
+                chunk = items[start:start + self.chunk_size]
+                latest = Case(
+                    *[When(telegram_id=telegram_id, then=Value(at)) for telegram_id, at in chunk],
+                    output_field=DateTimeField(),
+                )
+                User.objects.filter(telegram_id__in=[telegram_id for telegram_id, _ in chunk]).update(
+                    last_login=Greatest(Coalesce('last_login', latest), latest),
+                )
+        except Exception:
+            with self._lock:
+                for telegram_id, at in pending.items():
+                    current = self._pending.get(telegram_id)
+                    if current is None or current < at:
+                        self._pending[telegram_id] = at
+            raise
+
+        with self._lock:
+            self.flushes += 1
+            self.flushed_users += len(items)
+        return len(items)
+
+    def stats(self):
+        flush_interval, max_size = self._settings()
+        with self._lock:
+            return {
+                'buffered': len(self._pending),
+                'touches': self.touches,
+                'flushes': self.flushes,
+                'flushed_users': self.flushed_users,
+                'flush_interval': flush_interval,
+                'max_size': max_size,
+            }
+
+
+activity_buffer = ActivityBuffer()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        activity_buffer.flush()
+    except Exception:
+        logger.exception('Failed to flush user activity on shutdown')
@@ -0,0 +1,138 @@
+import asyncio
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from vpn_service.models import User, VPNKey, VPNServer
+from .outline import outline_key_name
+from .outline_async import run_across_servers
+from .selection import server_ranking
+from .user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+
+async def _create_server_keys(client, server, items, concurrency):
+    """Создает ключи для всех позиций одного сервера, не больше concurrency запросов одновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create(item):
+        async with semaphore:
+            key = await client.create_key(name=item['outline_name'])
+            if item['traffic_limit'] > 0:
+                try:
+                    limited = await client.add_data_limit(key.key_id, item['traffic_limit'])
+                except Exception:
+                    limited = False
+                if not limited:
+                    # Ключ без лимита оставлять нельзя — удаляем и считаем позицию неудачной
+                    await client.delete_key(key.key_id)
+                    raise RuntimeError('Unable to set data limit')
+            return key
+
+    return await asyncio.gather(*(create(item) for item in items), return_exceptions=True)
+
+
+async def _delete_server_keys(client, server, outline_ids):
+    return await asyncio.gather(*(client.delete_key(key_id) for key_id in outline_ids), return_exceptions=True)
+
+
+def bulk_provision_keys(items):
+    """
+    Создает ключи для списка провалидированных позиций (BulkKeyItemSerializer).
+
+    Пользователи и серверы загружаются двумя запросами, запросы к Outline идут
+    на все серверы сразу (не больше BULK_CREATE_SERVER_CONCURRENCY на сервер),
+    строки VPNKey записываются одним bulk_create. Возвращает результаты в
+    порядке items: {'index', 'status': 'created', 'key'} или
+    {'index', 'status': 'error', 'message'}. Пул заранее созданных ключей
+    не используется, чтобы массовая выдача не опустошала его для бота.
+    """
+    results = [None] * len(items)
+    users = User.objects.in_bulk({item['user_id'] for item in items})
+    servers = VPNServer.objects.in_bulk({item['server_id'] for item in items if item.get('server_id')})
+
+    by_server = {}
+    for index, item in enumerate(items):
+        user = users.get(item['user_id'])
+        if user is None:
+            results[index] = {'index': index, 'status': 'error', 'message': 'User not found'}
+            continue
+
+        if item.get('server_id'):
+            server = servers.get(item['server_id'])
+            if server is None:
+                results[index] = {'index': index, 'status': 'error', 'message': 'Server not found'}
+                continue
+        else:
+            server = server_ranking.select(country_id=item.get('country_id'))
+            if server is None:
+                results[index] = {'index': index, 'status': 'error',
+                                  'message': 'No available VPN server for the requested location'}
+                continue
+            server_ranking.record_key_created(server.id)
+
+        expiration_date = None
+        if item.get('expiration_days'):
+            expiration_date = timezone.now() + datetime.timedelta(days=item['expiration_days'])
+
+        by_server.setdefault(server.id, (server, []))[1].append({
+            'index': index,
+            'user': user,
+            'name': item['name'],
+            'outline_name': outline_key_name(user, item['name']),
+            'traffic_limit': item['traffic_limit'],
+            'expiration_date': expiration_date,
+        })
+
+    def create(client, server):
+        return _create_server_keys(client, server, by_server[server.id][1],
+                                   settings.BULK_CREATE_SERVER_CONCURRENCY)
+
+    rows = []
+    for fetched in run_across_servers([server for server, _ in by_server.values()], create):
+        server_items = by_server[fetched.server.id][1]
+        created = fetched.result if fetched.error is None else [fetched.error] * len(server_items)
+        for item, key in zip(server_items, created):
+            if isinstance(key, BaseException):
+                results[item['index']] = {
+                    'index': item['index'], 'status': 'error',
+                    'message': str(key) or key.__class__.__name__,
+                }
+                continue
+            rows.append((item['index'], VPNKey(
+                user=item['user'],
+                vpn_server=fetched.server,
+                outline_id=key.key_id,
+                access_url=key.access_url,
+                name=item['name'],
+                expiration_date=item['expiration_date'],
+                traffic_limit=item['traffic_limit'],
+            )))
+
+    try:
+        with transaction.atomic():
+            VPNKey.objects.bulk_create([vpn_key for _, vpn_key in rows], batch_size=1000)
+            # bulk_create не шлет сигналы — сбрасываем кэш владельцев сами
+            telegram_ids = {vpn_key.user.telegram_id for _, vpn_key in rows}
+            transaction.on_commit(lambda: user_cache.invalidate_many(telegram_ids))
+    except Exception as e:
+        # Запись в БД не удалась — удаляем уже созданные в Outline ключи, чтобы не оставлять сирот
+        logger.exception('Bulk key insert failed, deleting %s remote keys', len(rows))
+        orphans = {}
+        for _, vpn_key in rows:
+            orphans.setdefault(vpn_key.vpn_server_id, (vpn_key.vpn_server, []))[1].append(vpn_key.outline_id)
+        run_across_servers(
+            [server for server, _ in orphans.values()],
+            lambda client, server: _delete_server_keys(client, server, orphans[server.id][1]),
+        )
+        for index, _ in rows:
+            results[index] = {'index': index, 'status': 'error', 'message': str(e)}
+        return results
+
+    for index, vpn_key in rows:
+        results[index] = {'index': index, 'status': 'created', 'key': vpn_key}
+    return results
@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.db import transaction
+
+from vpn_service.models import User
+from .user_cache import user_cache
+
+UPSERT_FIELDS = ('username', 'first_name', 'phone_number')
+
+
+def bulk_upsert_users(items, chunk_size=None):
+    """
+    Создает или обновляет пользователей по telegram_id (провалидированные BulkUserItemSerializer).
+
+    На каждую пачку из chunk_size пользователей — один
+    bulk_create(update_conflicts=True, unique_fields=['telegram_id']), то есть
+    INSERT ... ON CONFLICT DO UPDATE. Обновляются только переданные поля:
+    позиции с разным набором полей записываются отдельными пачками. При
+    повторе telegram_id в запросе побеждает последняя позиция. Возвращает
+    {'created', 'updated', 'ids': {telegram_id: id}}.
+    """
+    chunk_size = chunk_size or settings.BULK_UPSERT_CHUNK_SIZE
+    latest = {item['telegram_id']: item for item in items}
+
+    groups = {}
+    for telegram_id, item in latest.items():
+        fields = tuple(field for field in UPSERT_FIELDS if field in item)
+        groups.setdefault(fields, []).append(item)
+
+    ids = {}
+    created = 0
+    with transaction.atomic():
+        for fields, group in groups.items():
+            for start in range(0, len(group), chunk_size):
+                chunk = group[start:start + chunk_size]
+                telegram_ids = [item['telegram_id'] for item in chunk]
+                existing = set(User.objects.filter(telegram_id__in=telegram_ids).values_list('telegram_id', flat=True))
+                rows = [User(**item) for item in chunk]
+                if fields:
+                    User.objects.bulk_create(rows, update_conflicts=True, unique_fields=['telegram_id'],
+                                             update_fields=list(fields))
+                else:
+                    # Обновлять нечего — существующие строки не трогаем
+                    User.objects.bulk_create(rows, ignore_conflicts=True)
+                created += len(chunk) - len(existing)
+                # bulk_create с update_conflicts в Django 4.2 не проставляет pk — забираем их одним запросом
+                ids.update(User.objects.filter(telegram_id__in=telegram_ids).values_list('telegram_id', 'id'))
+
+    # Сигналы при bulk_create не отправляются — сбрасываем кэш поиска по telegram_id сами
+    transaction.on_commit(lambda: user_cache.invalidate_many(latest.keys()))
+    return {'created': created, 'updated': len(latest) - created, 'ids': ids}
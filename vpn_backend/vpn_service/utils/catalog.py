@@ -0,0 +1,87 @@
+import hashlib
+import json
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from vpn_service.models import Country, City, VPNServer
+
+
+def build_catalog():
+    """Дерево страна → город → активные серверы тремя запросами без JOIN"""
+    cities_by_country = {}
+    servers_by_city = {}
+    for server in (
+        VPNServer.objects.filter(active=True)
+        .order_by('id')
+        .values('id', 'city_id', 'server_name', 'server_location')
+    ):
+        servers_by_city.setdefault(server.pop('city_id'), []).append(server)
+
+    for city in City.objects.order_by('city_name').values('id', 'country_id', 'city_name'):
+        city['servers'] = servers_by_city.get(city['id'], [])
+        cities_by_country.setdefault(city.pop('country_id'), []).append(city)
+
+    return [
+        {
+            'id': country['id'],
+            'country_name': country['country_name'],
+            'cities': cities_by_country.get(country['id'], []),
+        }
+        for country in Country.objects.order_by('country_name').values('id', 'country_name')
+    ]
+
+
+class CatalogCache:
+    """
+    Заранее сериализованный каталог серверов с ETag.
+
+    Версия каталога хранится в Django cache (общем для процессов, см. CACHES)
+    без срока жизни и меняется только сигналами Country, City и VPNServer
+    после коммита транзакции. Готовое тело ответа лежит в Django cache под
+    ключом версии (его собирает первый обратившийся процесс) и в памяти
+    процесса, так что обычный запрос стоит одного cache.get версии.
+    Массовые update() сигналов не шлют — после них нужно вызвать invalidate().
+    """
+
+    version_key = 'catalog:version'
+    body_key_prefix = 'catalog:body:'
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._local = None
+        self._lock = threading.Lock()
+
+    def _version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            version = uuid.uuid4().hex
+            # Версию успел записать другой процесс — берем ее; если ключ тут же вытеснен, остаемся со своей
+            if not cache.add(self.version_key, version, None):
+                version = cache.get(self.version_key) or version
+        return version
+
+    def get(self):
+        """Возвращает (body, etag) актуальной версии каталога"""
+        version = self._version()
+        local = self._local
+        if local is not None and local[0] == version:
+            return local[1], local[2]
+
+        entry = cache.get(self.body_key_prefix + version)
+        if entry is None:
+            body = json.dumps(build_catalog(), ensure_ascii=False, separators=(',', ':')).encode()
+            entry = (body, '"%s"' % hashlib.sha256(body).hexdigest())
+            cache.set(self.body_key_prefix + version, entry, self.timeout or settings.CATALOG_CACHE_TIMEOUT)
+
+        with self._lock:
+            self._local = (version, entry[0], entry[1])
+        return entry
+
+    def invalidate(self):
+        cache.set(self.version_key, uuid.uuid4().hex, None)
+
+
+server_catalog = CatalogCache()
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from vpn_service.models import VPNKey, VPNServer
+from .outline_async import run_across_servers
+from .user_cache import user_cache
+
+
+def violating_keys(now=None):
+    """
+    Активные ключи с истекшим сроком или превышенным лимитом трафика (снимок
+    traffic_used плюс трафик прежних ключей traffic_offset после переноса)
+    """
+    now = now or timezone.now()
+    return VPNKey.objects.filter(is_active=True).filter(
+        Q(expiration_date__lt=now)
+        | Q(traffic_limit__gt=0, traffic_used__gte=F('traffic_limit') - F('traffic_offset'))
+    )
+
+
+async def _delete_server_keys(client, server, outline_ids, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def delete(outline_id):
+        async with semaphore:
+            return await client.delete_key(outline_id)
+
+    return await asyncio.gather(*(delete(outline_id) for outline_id in outline_ids), return_exceptions=True)
+
+
+def enforce_keys(batch_size=None, dry_run=False):
+    """
+    Отзывает ключи, у которых истек срок или превышен лимит трафика.
+
+    Ключи выбираются пачками по batch_size (keyset по id, без OFFSET), удаляются
+    в Outline конкурентно на всех серверах сразу (не больше
+    ENFORCE_SERVER_CONCURRENCY запросов на сервер) и деактивируются одним UPDATE
+    на пачку. Ключ, который Outline не смог удалить из-за ошибки, остается
+    активным до следующего прохода.
+    """
+    batch_size = batch_size or settings.ENFORCE_BATCH_SIZE
+    now = timezone.now()
+    started = time.monotonic()
+    report = {'expired': 0, 'over_limit': 0, 'revoked': 0, 'failed': 0, 'servers': {}}
+
+    candidates = violating_keys(now).order_by('id').values_list(
+        'id', 'vpn_server_id', 'outline_id', 'expiration_date', 'user__telegram_id'
+    )
+    last_id = 0
+    while True:
+        batch = list(candidates.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1][0]
+
+        by_server = {}
+        owners = {}
+        for key_id, server_id, outline_id, expiration_date, telegram_id in batch:
+            owners[key_id] = telegram_id
+            if expiration_date is not None and expiration_date < now:
+                report['expired'] += 1
+            else:
+                report['over_limit'] += 1
+            by_server.setdefault(server_id, []).append((key_id, outline_id))
+        if dry_run:
+            continue
+
+        servers = VPNServer.objects.in_bulk(by_server.keys())
+
+        def delete(client, server):
+            outline_ids = [outline_id for _, outline_id in by_server[server.id]]
+            return _delete_server_keys(client, server, outline_ids, settings.ENFORCE_SERVER_CONCURRENCY)
+
+        revoked_ids = []
+        for result in run_across_servers(servers.values(), delete):
+            stats = report['servers'].setdefault(result.server.server_name, {
+                'revoked': 0, 'failed': 0, 'seconds': 0,
+            })
+            stats['seconds'] = round(stats['seconds'] + result.elapsed, 3)
+            outcomes = result.result if result.error is None else [result.error] * len(by_server[result.server.id])
+            for (key_id, _), outcome in zip(by_server[result.server.id], outcomes):
+                # False означает 404: ключа в Outline уже нет, в БД его тоже можно деактивировать
+                if isinstance(outcome, BaseException):
+                    stats['failed'] += 1
+                else:
+                    stats['revoked'] += 1
+                    revoked_ids.append(key_id)
+
+        VPNKey.objects.filter(id__in=revoked_ids).update(is_active=False, updated_at=timezone.now())
+        # update() не шлет сигналы — сбрасываем кэш пользователей с отозванными ключами сами
+        telegram_ids = {owners[key_id] for key_id in revoked_ids}
+        transaction.on_commit(lambda: user_cache.invalidate_many(telegram_ids))
+        report['revoked'] += len(revoked_ids)
+        report['failed'] += sum(len(keys) for keys in by_server.values()) - len(revoked_ids)
+
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
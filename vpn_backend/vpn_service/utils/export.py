@@ -0,0 +1,129 @@
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from vpn_service.models import User, VPNKey
+
+# Колонка выгрузки -> поле для values_list; связанные поля приходят JOIN тем же запросом
+KEY_EXPORT_FIELDS = [
+    ('id', 'id'),
+    ('user_id', 'user_id'),
+    ('user_telegram_id', 'user__telegram_id'),
+    ('vpn_server_id', 'vpn_server_id'),
+    ('server_name', 'vpn_server__server_name'),
+    ('server_location', 'vpn_server__server_location'),
+    ('outline_id', 'outline_id'),
+    ('name', 'name'),
+    ('created_at', 'created_at'),
+    ('expiration_date', 'expiration_date'),
+    ('traffic_limit', 'traffic_limit'),
+    ('traffic_used', 'traffic_used'),
+    ('traffic_synced_at', 'traffic_synced_at'),
+    ('is_active', 'is_active'),
+]
+
+USER_EXPORT_FIELDS = [
+    ('id', 'id'),
+    ('telegram_id', 'telegram_id'),
+    ('username', 'username'),
+    ('first_name', 'first_name'),
+    ('phone_number', 'phone_number'),
+    ('created_at', 'created_at'),
+    ('last_login', 'last_login'),
+    ('is_active', 'is_active'),
+]
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+class _Echo:
+    """Псевдофайл для csv.writer: write() возвращает строку вместо записи"""
+
+    def write(self, value):
+        return value
+
+
+def export_keys_queryset(server_id=None, is_active=None, since=None, until=None):
+    queryset = VPNKey.objects.all()
+    if server_id is not None:
+        queryset = queryset.filter(vpn_server_id=server_id)
+    if is_active is not None:
+        queryset = queryset.filter(is_active=is_active)
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lt=until)
+    return queryset
+
+
+def export_users_queryset(server_id=None, is_active=None, since=None, until=None):
+    queryset = User.objects.all()
+    if server_id is not None:
+        # Пользователи, у которых есть ключ на сервере; подзапрос вместо JOIN, чтобы не было дублей
+        queryset = queryset.filter(id__in=VPNKey.objects.filter(vpn_server_id=server_id).values('user_id'))
+    if is_active is not None:
+        queryset = queryset.filter(is_active=is_active)
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lt=until)
+    return queryset
+
+
+def _rows(queryset, fields, chunk_size):
+    return (
+        queryset.order_by('created_at', 'id')
+        .values_list(*(field for _, field in fields))
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def _ndjson(rows, columns):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def _csv(rows, columns):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(
+            value.isoformat() if hasattr(value, 'isoformat') else value
+            for value in row
+        )
+
+
+def _batched(lines, size=500):
+    # Отдаем строки пачками: по одной записи на строку WSGI-сервер делал бы тысячи мелких send()
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def streaming_export(queryset, fields, export_format, filename, chunk_size=None):
+    """
+    Потоковая выгрузка queryset в NDJSON или CSV.
+
+    Строки читаются из БД через iterator(chunk_size) (на PostgreSQL —
+    серверный курсор) и сразу отдаются клиенту, поэтому память не зависит от
+    размера таблицы. Берутся только сохраненные в БД значения, запросов к
+    Outline нет.
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    columns = [column for column, _ in fields]
+    rows = _rows(queryset, fields, chunk_size)
+    body = _csv(rows, columns) if export_format == 'csv' else _ndjson(rows, columns)
+    response = StreamingHttpResponse(_batched(body), content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
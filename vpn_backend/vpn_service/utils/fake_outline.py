@@ -0,0 +1,331 @@
+import argparse
+import email
+import hashlib
+import json
+import os
+import random
+import secrets
+import ssl
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOutlineState:
+    """Состояние фейкового Outline сервера: ключи, лимиты и счетчики трафика"""
+
+    def __init__(self, name='Fake Outline', hostname='127.0.0.1', port_for_new_keys=12345):
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.bytes_transferred = {}
+        self.next_id = 0
+        self.server_info = {
+            'name': name,
+            'serverId': secrets.token_hex(8),
+            'metricsEnabled': True,
+            'createdTimestampMs': int(time.time() * 1000),
+            'version': '1.0.0',
+            'portForNewAccessKeys': port_for_new_keys,
+            'hostnameForAccessKeys': hostname,
+        }
+
+    def create_key(self, key_id=None, name=None, data_limit=None):
+        with self.lock:
+            if key_id is None:
+                key_id = str(self.next_id)
+                self.next_id += 1
+            password = secrets.token_urlsafe(16)
+            key = {
+                'id': key_id,
+                'name': name or '',
+                'password': password,
+                'port': self.server_info['portForNewAccessKeys'],
+                'method': 'chacha20-ietf-poly1305',
+                'accessUrl': f"ss://{password}@{self.server_info['hostnameForAccessKeys']}:"
+                             f"{self.server_info['portForNewAccessKeys']}/?outline=1",
+            }
+            if data_limit is not None:
+                key['dataLimit'] = {'bytes': data_limit}
+            self.keys[key_id] = key
+            return dict(key)
+
+    def add_traffic(self, key_id, used_bytes):
+        with self.lock:
+            self.bytes_transferred[key_id] = self.bytes_transferred.get(key_id, 0) + used_bytes
+
+
+class FakeOutlineHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+
+        latency = self.server.latency + random.uniform(0, self.server.latency_jitter)
+        if latency:
+            time.sleep(latency)
+
+        # Инъекция ошибок: обрыв соединения без ответа или ответ error_status
+        roll = random.random()
+        if roll < self.server.drop_rate:
+            self.close_connection = True
+            return
+        if roll < self.server.drop_rate + self.server.error_rate:
+            return self._send(self.server.error_status, {'code': 'Injected', 'message': 'Injected error'})
+
+        prefix = f"/{self.server.secret}"
+        path = self.path.split('?', 1)[0]
+        if not path.startswith(prefix):
+            return self._send(404)
+        parts = [part for part in path[len(prefix):].split('/') if part]
+
+        route = (method, parts[0] if parts else '', len(parts))
+        if route == ('GET', 'server', 1):
+            return self._send(200, self.state.server_info)
+        if route == ('GET', 'metrics', 2) and parts[1] == 'transfer':
+            with self.state.lock:
+                return self._send(200, {'bytesTransferredByUserId': dict(self.state.bytes_transferred)})
+        if route == ('GET', 'metrics', 2) and parts[1] == 'enabled':
+            return self._send(200, {'metricsEnabled': self.state.server_info['metricsEnabled']})
+        if parts and parts[0] == 'access-keys':
+            return self._access_keys(method, parts[1:])
+        return self._send(404)
+
+    def _access_keys(self, method, parts):
+        state = self.state
+        if not parts:
+            if method == 'GET':
+                with state.lock:
+                    return self._send(200, {'accessKeys': list(state.keys.values())})
+            if method == 'POST':
+                payload = self._json()
+                limit = (payload.get('limit') or {}).get('bytes')
+                return self._send(201, state.create_key(name=payload.get('name'), data_limit=limit))
+            return self._send(405)
+
+        key_id = parts[0]
+        if method == 'PUT' and len(parts) == 1:
+            payload = self._json()
+            limit = (payload.get('limit') or {}).get('bytes')
+            return self._send(201, state.create_key(key_id=key_id, name=payload.get('name'), data_limit=limit))
+
+        with state.lock:
+            key = state.keys.get(key_id)
+            if key is None:
+                return self._send(404)
+
+            if len(parts) == 1 and method == 'GET':
+                return self._send(200, key)
+            if len(parts) == 1 and method == 'DELETE':
+                del state.keys[key_id]
+                state.bytes_transferred.pop(key_id, None)
+                return self._send(204)
+            if parts[1:] == ['name'] and method == 'PUT':
+                key['name'] = self._form().get('name', '')
+                return self._send(204)
+            if parts[1:] == ['data-limit'] and method == 'PUT':
+                key['dataLimit'] = {'bytes': self._json()['limit']['bytes']}
+                return self._send(204)
+            if parts[1:] == ['data-limit'] and method == 'DELETE':
+                key.pop('dataLimit', None)
+                return self._send(204)
+        return self._send(404)
+
+    def _json(self):
+        return json.loads(self.body) if self.body else {}
+
+    def _form(self):
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return self._json()
+        message = email.message_from_bytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + self.body
+        )
+        if not message.is_multipart():
+            return {}
+        return {
+            part.get_param('name', header='content-disposition'): part.get_payload(decode=True).decode()
+            for part in message.get_payload()
+        }
+
+    def _send(self, code, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(code)
+        if payload is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _FakeHTTPServer(ThreadingHTTPServer):
+    # Очередь listen() по умолчанию — 5 соединений: под нагрузочным тестом лишние
+    # SYN отбрасываются и клиент ждет повтора секунду, что искажает задержки
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakeOutlineServer:
+    """
+    Фейковый Outline Management API в отдельном потоке текущего процесса.
+
+    Без certfile сервер работает по HTTP, с certfile/keyfile — по HTTPS,
+    а cert_sha256 содержит отпечаток сертификата для OutlineVPNClient.
+    Каждый запрос ждет latency плюс случайные 0..latency_jitter секунд; с
+    вероятностью error_rate отвечает error_status, с вероятностью drop_rate
+    закрывает соединение без ответа. Параметры меняются на ходу через configure().
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, certfile=None, keyfile=None, state=None,
+                 latency_jitter=0, error_rate=0, error_status=500, drop_rate=0):
+        self.state = state or FakeOutlineState(hostname=host)
+        self.httpd = _FakeHTTPServer((host, port), FakeOutlineHandler)
+        self.httpd.state = self.state
+        self.httpd.secret = secrets.token_urlsafe(12)
+        self.configure(latency=latency, latency_jitter=latency_jitter, error_rate=error_rate,
+                       error_status=error_status, drop_rate=drop_rate)
+        self.scheme = 'http'
+        self.cert_sha256 = 'fake'
+
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+            self.scheme = 'https'
+            with open(certfile) as f:
+                der = ssl.PEM_cert_to_DER_cert(f.read())
+            self.cert_sha256 = hashlib.sha256(der).hexdigest().upper()
+
+        self._thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"{self.scheme}://{host}:{port}/{self.httpd.secret}"
+
+    def configure(self, **options):
+        for name in ('latency', 'latency_jitter', 'error_rate', 'error_status', 'drop_rate'):
+            if name in options:
+                setattr(self.httpd, name, options[name])
+        return self
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeOutlineProcess:
+    """
+    Фейковый Outline сервер в отдельном процессе (python -m vpn_service.utils.fake_outline).
+
+    Нужен, когда сервер не должен делить GIL с нагружаемым кодом. Параметры те
+    же, что у FakeOutlineServer, плюс keys — сколько ключей создать при старте.
+    """
+
+    def __init__(self, port=0, latency=0, latency_jitter=0, error_rate=0, error_status=500, drop_rate=0,
+                 keys=0, certfile=None, keyfile=None):
+        self.args = [
+            '--port', str(port), '--latency', str(latency), '--latency-jitter', str(latency_jitter),
+            '--error-rate', str(error_rate), '--error-status', str(error_status),
+            '--drop-rate', str(drop_rate), '--keys', str(keys),
+        ]
+        if certfile:
+            self.args += ['--certfile', certfile, '--keyfile', keyfile]
+        self.process = None
+        self.api_url = None
+        self.cert_sha256 = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'vpn_service.utils.fake_outline', *self.args],
+            stdout=subprocess.PIPE,
+            text=True,
+            # Каталог проекта (vpn_backend), чтобы пакет vpn_service импортировался из любого cwd
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+        )
+        # Первая строка вывода — адрес и отпечаток запущенного сервера
+        info = json.loads(self.process.stdout.readline())
+        self.api_url = info['api_url']
+        self.cert_sha256 = info['cert_sha256']
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process.stdout.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake Outline Management API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--latency-jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--drop-rate', type=float, default=0)
+    parser.add_argument('--keys', type=int, default=0, help='Number of keys to create on start')
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    args = parser.parse_args(argv)
+
+    server = FakeOutlineServer(
+        host=args.host, port=args.port, latency=args.latency, latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate, error_status=args.error_status, drop_rate=args.drop_rate,
+        certfile=args.certfile, keyfile=args.keyfile,
+    )
+    for index in range(args.keys):
+        server.state.create_key(name=f'Key {index}')
+    print(json.dumps({'api_url': server.api_url, 'cert_sha256': server.cert_sha256}), flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
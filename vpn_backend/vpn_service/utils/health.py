@@ -0,0 +1,66 @@
+import asyncio
+
+from django.utils import timezone
+
+from vpn_service.models import ServerHealth
+from .outline import breaker
+from .outline_async import probe_client_pool, run_across_servers
+
+
+async def _probe(client, server):
+    # Статистика нужна только для выбора сервера: ее ошибка не делает сервер нездоровым
+    info, stats = await asyncio.gather(
+        client.get_server_information(),
+        client.get_server_stats(),
+        return_exceptions=True,
+    )
+    if isinstance(info, BaseException):
+        raise info
+    return {'info': info, 'stats': None if isinstance(stats, BaseException) else stats}
+
+
+def probe_servers(servers, timeout=None):
+    """
+    Опрашивает get_server_information() и статистику всех серверов одновременно
+    и записывает задержку, время последнего успеха, число ошибок подряд и
+    нагрузку в ServerHealth (один bulk_create и один bulk_update на проход).
+    """
+    servers = list(servers)
+    results = run_across_servers(servers, _probe, timeout=timeout, pool=probe_client_pool)
+    now = timezone.now()
+
+    existing = {
+        health.vpn_server_id: health
+        for health in ServerHealth.objects.filter(vpn_server__in=servers)
+    }
+    created, updated = [], []
+    for result in results:
+        health = existing.get(result.server.id)
+        if health is None:
+            health = ServerHealth(vpn_server=result.server)
+            created.append(health)
+        else:
+            updated.append(health)
+
+        health.last_checked_at = now
+        health.latency_ms = round(result.elapsed * 1000, 1)
+        if result.error is None:
+            health.last_success_at = now
+            health.consecutive_failures = 0
+            health.last_error = ''
+            if result.result['stats'] is not None:
+                health.transferred_bytes = result.result['stats']['transferred_bytes']
+                health.keys_with_traffic = result.result['stats']['keys_with_traffic']
+            breaker.record_success(result.server.id)
+        else:
+            health.last_failure_at = now
+            health.consecutive_failures += 1
+            health.last_error = (str(result.error) or result.error.__class__.__name__)[:255]
+            breaker.record_failure(result.server.id)
+
+    ServerHealth.objects.bulk_create(created)
+    ServerHealth.objects.bulk_update(updated, [
+        'latency_ms', 'last_checked_at', 'last_success_at', 'last_failure_at',
+        'consecutive_failures', 'last_error', 'transferred_bytes', 'keys_with_traffic',
+    ])
+    return results
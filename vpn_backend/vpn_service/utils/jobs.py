@@ -0,0 +1,283 @@
+import asyncio
+import datetime
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from vpn_service.models import OutlineJob, User, VPNKey, VPNServer
+from .outline import breaker, ServerUnavailable
+from .outline_async import run_across_servers, ServerResult
+from .user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_job(kind, server, payload, vpn_key=None, idempotency_key=None):
+    """
+    Ставит операцию в очередь. Возвращает (job, created): с уже известным
+    idempotency_key возвращается существующая задача, новая не создается.
+    """
+    if idempotency_key:
+        job = OutlineJob.objects.filter(idempotency_key=idempotency_key).first()
+        if job is not None:
+            return job, False
+    try:
+        with transaction.atomic():
+            job = OutlineJob.objects.create(
+                kind=kind,
+                vpn_server=server,
+                vpn_key=vpn_key,
+                payload=payload,
+                idempotency_key=idempotency_key or None,
+            )
+    except IntegrityError:
+        # Параллельный запрос с тем же ключом успел раньше
+        return OutlineJob.objects.get(idempotency_key=idempotency_key), False
+    return job, True
+
+
+def record_completed_job(kind, server, vpn_key, idempotency_key):
+    """Запоминает idempotency_key операции, выполненной сразу без очереди (например, ключ из пула)"""
+    try:
+        with transaction.atomic():
+            return OutlineJob.objects.create(
+                kind=kind,
+                status=OutlineJob.SUCCEEDED,
+                vpn_server=server,
+                vpn_key=vpn_key,
+                result={'key_id': vpn_key.id},
+                idempotency_key=idempotency_key,
+                finished_at=timezone.now(),
+            )
+    except IntegrityError:
+        return OutlineJob.objects.get(idempotency_key=idempotency_key)
+
+
+def backoff_delay(attempts):
+    """Экспоненциальная задержка перед повтором с небольшим случайным разбросом"""
+    delay = min(settings.JOB_BACKOFF_BASE * 2 ** (attempts - 1), settings.JOB_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def release_stale_jobs():
+    """Возвращает в очередь задачи, зависшие в running дольше JOB_LOCK_TIMEOUT (упавший воркер)"""
+    threshold = timezone.now() - datetime.timedelta(seconds=settings.JOB_LOCK_TIMEOUT)
+    return OutlineJob.objects.filter(status=OutlineJob.RUNNING, locked_at__lt=threshold).update(
+        status=OutlineJob.PENDING, locked_at=None, run_after=timezone.now(), updated_at=timezone.now(),
+    )
+
+
+def claim_jobs(batch_size):
+    """
+    Забирает готовые к выполнению задачи, не превышая JOB_SERVER_CONCURRENCY
+    выполняющихся задач на сервер с учетом других воркеров. Строки блокируются
+    с skip_locked, поэтому несколько воркеров не возьмут одну задачу.
+    """
+    limit = settings.JOB_SERVER_CONCURRENCY
+    now = timezone.now()
+    with transaction.atomic():
+        candidates = list(
+            OutlineJob.objects.select_for_update(skip_locked=True)
+            .filter(status=OutlineJob.PENDING, run_after__lte=now)
+            .order_by('run_after', 'id')[:batch_size]
+        )
+        if not candidates:
+            return []
+
+        running = dict(
+            OutlineJob.objects.filter(status=OutlineJob.RUNNING,
+                                      vpn_server_id__in={job.vpn_server_id for job in candidates})
+            .values_list('vpn_server_id')
+            .annotate(count=Count('id'))
+        )
+        claimed = []
+        for job in candidates:
+            if running.get(job.vpn_server_id, 0) >= limit:
+                continue
+            running[job.vpn_server_id] = running.get(job.vpn_server_id, 0) + 1
+            job.status = OutlineJob.RUNNING
+            job.locked_at = now
+            job.attempts += 1
+            claimed.append(job)
+        OutlineJob.objects.bulk_update(claimed, ['status', 'locked_at', 'attempts', 'updated_at'])
+    return claimed
+
+
+async def _run_create_key(client, job):
+    # Ключ, созданный в прошлой попытке, повторно не создаем
+    if 'outline_id' not in job.result:
+        key = await client.create_key(name=job.payload['outline_name'])
+        job.result.update({'outline_id': key.key_id, 'access_url': key.access_url})
+    if job.payload.get('traffic_limit', 0) > 0:
+        if not await client.add_data_limit(job.result['outline_id'], job.payload['traffic_limit']):
+            raise RuntimeError('Unable to set data limit')
+
+
+async def _run_revoke_key(client, job):
+    # False означает, что ключа в Outline уже нет — это тоже успех
+    await client.delete_key(job.payload['outline_id'])
+
+
+async def _run_set_limit(client, job):
+    # outline_limit учитывает трафик прежних ключей (outline_data_limit); в старых задачах его нет
+    if 'outline_limit' in job.payload:
+        limit = job.payload['outline_limit']
+    else:
+        limit = job.payload['traffic_limit'] or None
+    if limit is not None:
+        done = await client.add_data_limit(job.payload['outline_id'], limit)
+    else:
+        done = await client.delete_data_limit(job.payload['outline_id'])
+    if not done:
+        raise RuntimeError('Unable to change data limit')
+
+
+async def _run_rename_key(client, job):
+    if not await client.rename_key(job.payload['outline_id'], job.payload['outline_name']):
+        raise RuntimeError('Unable to rename key')
+
+
+RUNNERS = {
+    OutlineJob.CREATE_KEY: _run_create_key,
+    OutlineJob.REVOKE_KEY: _run_revoke_key,
+    OutlineJob.SET_LIMIT: _run_set_limit,
+    OutlineJob.RENAME_KEY: _run_rename_key,
+}
+
+
+async def _run_server_jobs(client, server, jobs):
+    return await asyncio.gather(*(RUNNERS[job.kind](client, job) for job in jobs), return_exceptions=True)
+
+
+async def _delete_keys(client, server, outline_ids):
+    return await asyncio.gather(*(client.delete_key(outline_id) for outline_id in outline_ids),
+                                return_exceptions=True)
+
+
+def _delete_created_keys(servers, outline_ids):
+    """Удаляет в Outline ключи, созданные задачами CREATE_KEY, которые окончательно не удались"""
+    def delete(client, server):
+        return _delete_keys(client, server, outline_ids[server.id])
+
+    for result in run_across_servers([servers[server_id] for server_id in outline_ids], delete):
+        server_ids = outline_ids[result.server.id]
+        outcomes = result.result if result.error is None else [result.error] * len(server_ids)
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        if errors:
+            logger.warning('Failed to delete %s keys of failed jobs on server %s: %r',
+                           len(errors), result.server.id, errors[0])
+
+
+def _complete(job):
+    """Записывает в БД результат успешной операции; вызывается внутри транзакции"""
+    if job.kind == OutlineJob.CREATE_KEY:
+        expiration_date = job.payload.get('expiration_date')
+        vpn_key = VPNKey.objects.create(
+            user_id=job.payload['user_id'],
+            vpn_server_id=job.vpn_server_id,
+            outline_id=job.result['outline_id'],
+            access_url=job.result['access_url'],
+            name=job.payload['name'],
+            expiration_date=parse_datetime(expiration_date) if expiration_date else None,
+            traffic_limit=job.payload.get('traffic_limit', 0),
+        )
+        job.vpn_key = vpn_key
+        job.result['key_id'] = vpn_key.id
+    elif job.kind == OutlineJob.REVOKE_KEY:
+        VPNKey.objects.filter(id=job.vpn_key_id).update(is_active=False, updated_at=timezone.now())
+    elif job.kind == OutlineJob.SET_LIMIT:
+        VPNKey.objects.filter(id=job.vpn_key_id).update(
+            traffic_limit=job.payload['traffic_limit'], updated_at=timezone.now(),
+        )
+    if job.kind in (OutlineJob.REVOKE_KEY, OutlineJob.SET_LIMIT):
+        # update() не шлет сигналы — сбрасываем кэш владельца ключа сами
+        telegram_ids = list(
+            User.objects.filter(vpn_keys__id=job.vpn_key_id).values_list('telegram_id', flat=True)
+        )
+        transaction.on_commit(lambda: user_cache.invalidate_many(telegram_ids))
+
+
+def process_jobs(batch_size=None):
+    """
+    Выполняет одну пачку задач: операции всех серверов идут одновременно,
+    результат каждой задачи записывается своей транзакцией. Неудачная задача
+    возвращается в очередь с экспоненциальной задержкой, после
+    JOB_MAX_ATTEMPTS попыток помечается failed, а ключ, который успела создать
+    задача CREATE_KEY, удаляется в Outline. Задачи сервера с разомкнутой цепью
+    откладываются на OUTLINE_BREAKER_COOLDOWN и попыткой не считаются.
+    """
+    batch_size = batch_size or settings.JOB_BATCH_SIZE
+    started = time.monotonic()
+    release_stale_jobs()
+    jobs = claim_jobs(batch_size)
+    report = {'claimed': len(jobs), 'succeeded': 0, 'retried': 0, 'deferred': 0, 'failed': 0}
+    if not jobs:
+        report['seconds'] = round(time.monotonic() - started, 3)
+        return report
+
+    by_server = {}
+    for job in jobs:
+        by_server.setdefault(job.vpn_server_id, []).append(job)
+    servers = VPNServer.objects.in_bulk(by_server.keys())
+    # Breaker читает ServerHealth из БД, поэтому проверяем его до перехода в event loop. is_open не
+    # занимает пробный запрос полуоткрытой цепи — его сделает клиент, и результат запишется в breaker
+    available = [server for server in servers.values() if not breaker.is_open(server.id)]
+    results = [
+        ServerResult(server, None, ServerUnavailable(server.id), 0)
+        for server in servers.values() if server not in available
+    ]
+
+    def run(client, server):
+        return _run_server_jobs(client, server, by_server[server.id])
+
+    results.extend(run_across_servers(available, run))
+    created_keys = {}
+    for fetched in results:
+        server_jobs = by_server[fetched.server.id]
+        outcomes = fetched.result if fetched.error is None else [fetched.error] * len(server_jobs)
+        for job, outcome in zip(server_jobs, outcomes):
+            job.locked_at = None
+            if not isinstance(outcome, BaseException):
+                try:
+                    with transaction.atomic():
+                        _complete(job)
+                        job.status = OutlineJob.SUCCEEDED
+                        job.finished_at = timezone.now()
+                        job.last_error = ''
+                        job.save()
+                    report['succeeded'] += 1
+                    continue
+                except Exception as e:
+                    logger.exception('Failed to store result of job %s', job.id)
+                    outcome = e
+
+            job.last_error = (str(outcome) or outcome.__class__.__name__)[:255]
+            if isinstance(outcome, ServerUnavailable):
+                # Запрос к Outline не отправлялся — попытку возвращаем и ждем, пока breaker пропустит пробу
+                job.attempts -= 1
+                job.status = OutlineJob.PENDING
+                job.run_after = timezone.now() + datetime.timedelta(seconds=settings.OUTLINE_BREAKER_COOLDOWN)
+                report['deferred'] += 1
+            elif job.attempts >= settings.JOB_MAX_ATTEMPTS:
+                job.status = OutlineJob.FAILED
+                job.finished_at = timezone.now()
+                if job.kind == OutlineJob.CREATE_KEY and 'outline_id' in job.result:
+                    created_keys.setdefault(job.vpn_server_id, []).append(job.result['outline_id'])
+                report['failed'] += 1
+            else:
+                job.status = OutlineJob.PENDING
+                job.run_after = timezone.now() + datetime.timedelta(seconds=backoff_delay(job.attempts))
+                report['retried'] += 1
+            # result сохраняем: в нем outline_id уже созданного ключа для следующей попытки
+            job.save()
+
+    if created_keys:
+        _delete_created_keys(servers, created_keys)
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
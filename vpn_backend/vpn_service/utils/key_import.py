@@ -0,0 +1,196 @@
+import re
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from vpn_service.models import PooledKey, User, VPNKey
+from .outline import breaker, ServerUnavailable
+from .outline_async import run_across_servers
+from .selection import server_ranking
+from .user_cache import user_cache
+
+NAME_MAX_LENGTH = VPNKey._meta.get_field('name').max_length
+
+
+def compile_pattern(pattern=None):
+    """
+    Регулярное выражение для имени ключа в Outline с группами user и name.
+
+    user — username или telegram_id владельца, name — название ключа. По
+    умолчанию OUTLINE_KEY_IMPORT_PATTERN, то есть формат outline_key_name.
+    ValueError, если выражение некорректно или в нем нет нужных групп.
+    """
+    try:
+        compiled = re.compile(pattern or settings.OUTLINE_KEY_IMPORT_PATTERN)
+    except re.error as e:
+        raise ValueError(f'Invalid pattern: {e}')
+    missing = {'user', 'name'} - set(compiled.groupindex)
+    if missing:
+        raise ValueError(f"Pattern must contain named groups: {', '.join(sorted(missing))}")
+    return compiled
+
+
+def _resolve_users(tokens, chunk_size):
+    """
+    ({token: (user_id, telegram_id)}, ambiguous): сначала по username, затем
+    числовые токены по telegram_id. username не уникален — токены, под которые
+    подходит несколько пользователей, попадают в ambiguous, а не в словарь.
+    """
+    tokens = list(tokens)
+    users = {}
+    ambiguous = set()
+    for start in range(0, len(tokens), chunk_size):
+        chunk = tokens[start:start + chunk_size]
+        for user_id, telegram_id, username in User.objects.filter(username__in=chunk).values_list(
+                'id', 'telegram_id', 'username'):
+            if username in users:
+                ambiguous.add(username)
+            users[username] = (user_id, telegram_id)
+        numeric = {
+            int(token): token for token in chunk
+            if token.isdigit() and token not in users and token not in ambiguous
+        }
+        for user_id, telegram_id in User.objects.filter(telegram_id__in=numeric).values_list('id', 'telegram_id'):
+            users.setdefault(numeric[telegram_id], (user_id, telegram_id))
+    for token in ambiguous:
+        del users[token]
+    return users, ambiguous
+
+
+def import_keys(server, remote_keys, pattern=None, dry_run=False, chunk_size=None):
+    """
+    Заводит строки VPNKey для ключей сервера, созданных в Outline в обход бэкенда.
+
+    remote_keys — результат get_keys(). Ключи, для которых уже есть строка
+    VPNKey этого сервера (в том числе отозванная) или свободный ключ пула,
+    пропускаются. Имя ключа разбирается по pattern (compile_pattern), владелец
+    ищется по username или telegram_id пачками по chunk_size; ключи, username
+    которых есть у нескольких пользователей, не импортируются (ambiguous).
+    Новые строки пишутся bulk_create(ignore_conflicts=True): строку, которую
+    параллельно завел create_key, отсекает уникальный индекс по (vpn_server,
+    outline_id), и в imported она не попадает.
+    Лимит и счетчик трафика берутся из Outline, чтобы первая синхронизация не
+    записала весь накопленный трафик как прирост. С dry_run только считает.
+    """
+    pattern = compile_pattern(pattern)
+    chunk_size = chunk_size or settings.KEY_IMPORT_BATCH_SIZE
+    started = time.monotonic()
+
+    known = set(VPNKey.objects.filter(vpn_server=server).values_list('outline_id', flat=True).iterator(chunk_size))
+    known.update(PooledKey.objects.filter(vpn_server=server, claimed_at=None).values_list('outline_id', flat=True))
+
+    candidates = []
+    unmatched = 0
+    unmatched_names = set()
+    for remote_key in remote_keys:
+        outline_id = str(remote_key.key_id)
+        if outline_id in known:
+            continue
+        match = pattern.fullmatch(remote_key.name or '')
+        if match is None or not match.group('user'):
+            unmatched += 1
+            if len(unmatched_names) < 10:
+                unmatched_names.add(remote_key.name or '')
+            continue
+        candidates.append((match.group('user'), match.group('name') or '', outline_id, remote_key))
+
+    users, ambiguous = _resolve_users({token for token, *_ in candidates}, chunk_size)
+    synced_at = timezone.now()
+    rows = []
+    unknown_users = set()
+    ambiguous_keys = 0
+    imported_users = set()
+    for token, name, outline_id, remote_key in candidates:
+        if token in ambiguous:
+            ambiguous_keys += 1
+            continue
+        user = users.get(token)
+        if user is None:
+            unknown_users.add(token)
+            continue
+        used_bytes = remote_key.used_bytes or 0
+        rows.append(VPNKey(
+            user_id=user[0],
+            vpn_server=server,
+            outline_id=outline_id,
+            access_url=remote_key.access_url,
+            name=name[:NAME_MAX_LENGTH],
+            traffic_limit=remote_key.data_limit or 0,
+            traffic_used=used_bytes,
+            traffic_last_period_bytes=used_bytes,
+            traffic_synced_at=synced_at,
+        ))
+        imported_users.add(user[1])
+
+    imported = len(rows)
+    if rows and not dry_run:
+        with transaction.atomic():
+            VPNKey.objects.bulk_create(rows, batch_size=chunk_size, ignore_conflicts=True)
+            # С ignore_conflicts bulk_create не сообщает, какие строки вставлены: считаем
+            # свои строки по outline_id и метке синхронизации
+            outline_ids = [row.outline_id for row in rows]
+            imported = sum(
+                VPNKey.objects.filter(
+                    vpn_server=server, outline_id__in=outline_ids[start:start + chunk_size],
+                    traffic_synced_at=synced_at,
+                ).count()
+                for start in range(0, len(outline_ids), chunk_size)
+            )
+            # bulk_create не шлет сигналы — сбрасываем кэши пользователей и рейтинг серверов сами
+            transaction.on_commit(lambda: user_cache.invalidate_many(imported_users))
+            transaction.on_commit(server_ranking.invalidate)
+
+    return {
+        'server_id': server.id,
+        'server_name': server.server_name,
+        'remote_keys': len(remote_keys),
+        'known': len(remote_keys) - len(candidates) - unmatched,
+        'imported': imported,
+        'unmatched': unmatched,
+        'unknown_users': len(candidates) - len(rows) - ambiguous_keys,
+        'ambiguous': ambiguous_keys,
+        # Примеры для подбора pattern
+        'unmatched_names': sorted(unmatched_names),
+        'unknown_user_tokens': sorted(unknown_users)[:10],
+        'ambiguous_users': sorted(ambiguous)[:10],
+        'seconds': round(time.monotonic() - started, 3),
+    }
+
+
+async def _fetch_keys(client, server):
+    return await client.get_keys()
+
+
+def import_server_keys(server, pattern=None, dry_run=False, timeout=None):
+    """Импортирует ключи одного сервера: один get_keys() к Outline API и несколько запросов к БД"""
+    pattern = compile_pattern(pattern)
+    # Синхронный OutlineVPN.get_keys() разбирает JSON метрик заново для каждого ключа (квадратично
+    # от числа ключей), асинхронный клиент разбирает ответ один раз. Breaker проверяем до event loop
+    if breaker.is_open(server.id):
+        raise ServerUnavailable(server.id)
+    fetched, = run_across_servers([server], _fetch_keys, timeout=timeout)
+    if fetched.error is not None:
+        raise fetched.error
+    return {**import_keys(server, fetched.result, pattern, dry_run), 'fetch_seconds': round(fetched.elapsed, 3)}
+
+
+def import_servers_keys(servers, pattern=None, dry_run=False, timeout=None):
+    """
+    Импортирует ключи нескольких серверов: get_keys() идет ко всем серверам
+    одновременно, затем ключи серверов по очереди записываются в БД.
+    """
+    pattern = compile_pattern(pattern)
+    results = []
+    for fetched in run_across_servers(servers, _fetch_keys, timeout=timeout):
+        if fetched.error is not None:
+            results.append({
+                'server_id': fetched.server.id,
+                'server_name': fetched.server.server_name,
+                'error': str(fetched.error) or fetched.error.__class__.__name__,
+            })
+            continue
+        result = import_keys(fetched.server, fetched.result, pattern, dry_run)
+        results.append({**result, 'fetch_seconds': round(fetched.elapsed, 3)})
+    return results
@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from vpn_service.models import OutlineJob, PooledKey, VPNKey, VPNServer
+from .jobs import enqueue_job
+from .outline import outline_key_name
+from .outline_async import run_across_servers
+
+logger = logging.getLogger(__name__)
+
+POOLED_KEY_NAME = 'Pooled key'
+
+def claim_key(server, user, name, traffic_limit=0, expiration_date=None):
+    """
+    Выдает пользователю заранее созданный ключ из пула сервера одной транзакцией.
+
+    Возвращает VPNKey или None, если пул сервера пуст. Переименование ключа
+    и лимит трафика в Outline ставятся задачами OutlineJob в той же транзакции
+    и выполняются воркером process_jobs: падение процесса после ответа не
+    оставит ключ без лимита.
+    """
+    with transaction.atomic():
+        pooled = (
+            PooledKey.objects.select_for_update(skip_locked=True)
+            .filter(vpn_server=server, claimed_at=None)
+            .order_by('id')
+            .first()
+        )
+        if pooled is None:
+            return None
+
+        pooled.claimed_at = timezone.now()
+        pooled.save(update_fields=['claimed_at'])
+        vpn_key = VPNKey.objects.create(
+            user=user,
+            vpn_server=server,
+            outline_id=pooled.outline_id,
+            access_url=pooled.access_url,
+            name=name,
+            expiration_date=expiration_date,
+            traffic_limit=traffic_limit,
+        )
+        enqueue_job(OutlineJob.RENAME_KEY, server,
+                    {'outline_id': vpn_key.outline_id, 'outline_name': outline_key_name(user, name)},
+                    vpn_key=vpn_key)
+        if traffic_limit > 0:
+            enqueue_job(OutlineJob.SET_LIMIT, server,
+                        {'outline_id': vpn_key.outline_id, 'traffic_limit': traffic_limit,
+                         'outline_limit': traffic_limit},
+                        vpn_key=vpn_key)
+    return vpn_key
+
+
+async def _create_pooled_keys(client, server, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def create():
+        async with semaphore:
+            return await client.create_key(name=POOLED_KEY_NAME)
+
+    return await asyncio.gather(*(create() for _ in range(count)), return_exceptions=True)
+
+
+def pool_depths(servers):
+    """Число свободных ключей в пуле каждого сервера одним запросом"""
+    rows = (
+        PooledKey.objects.filter(vpn_server__in=servers, claimed_at=None)
+        .values('vpn_server_id')
+        .annotate(depth=Count('id'))
+    )
+    return {row['vpn_server_id']: row['depth'] for row in rows}
+
+
+def refill_pools(servers, low_water=None, target=None):
+    """
+    Пополняет пулы серверов, где свободных ключей меньше low_water, до target.
+
+    Ключи создаются конкурентно на всех серверах сразу (не больше
+    KEY_POOL_REFILL_CONCURRENCY запросов на сервер) и записываются одним
+    bulk_create. Неудачные создания логируются и считаются в failed.
+    """
+    low_water = settings.KEY_POOL_LOW_WATER if low_water is None else low_water
+    target = settings.KEY_POOL_TARGET if target is None else target
+
+    servers = list(servers)
+    depths = pool_depths(servers)
+    missing = {
+        server.id: target - depths.get(server.id, 0)
+        for server in servers
+        if depths.get(server.id, 0) < low_water
+    }
+    to_refill = [server for server in servers if server.id in missing]
+    if not to_refill:
+        return []
+
+    def create(client, server):
+        return _create_pooled_keys(client, server, missing[server.id], settings.KEY_POOL_REFILL_CONCURRENCY)
+
+    rows, report = [], []
+    for result in run_across_servers(to_refill, create):
+        outcomes = result.result or []
+        created = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        if result.error is not None:
+            errors = [result.error] * missing[result.server.id]
+        if errors:
+            logger.warning('Failed to create %s of %s pooled keys on server %s: %r',
+                           len(errors), missing[result.server.id], result.server.id, errors[0])
+        rows.extend(
+            PooledKey(vpn_server=result.server, outline_id=key.key_id, access_url=key.access_url)
+            for key in created
+        )
+        report.append({
+            'server_id': result.server.id,
+            'server_name': result.server.server_name,
+            'depth_before': depths.get(result.server.id, 0),
+            'requested': missing[result.server.id],
+            'created': len(created),
+            'failed': len(errors),
+            'seconds': round(result.elapsed, 3),
+            'error': (str(errors[0]) or errors[0].__class__.__name__) if errors else None,
+        })
+    PooledKey.objects.bulk_create(rows, batch_size=1000)
+    return report
+
+
+def prune_claimed(older_than=None):
+    """Удаляет давно выданные записи пула, оставляя окно для метрик"""
+    older_than = older_than or datetime.timedelta(seconds=settings.KEY_POOL_METRICS_WINDOW)
+    deleted, _ = PooledKey.objects.filter(claimed_at__lt=timezone.now() - older_than).delete()
+    return deleted
+
+
+def pool_stats():
+    """Глубина пула и скорость пополнения/выдачи за окно KEY_POOL_METRICS_WINDOW по серверам"""
+    window = settings.KEY_POOL_METRICS_WINDOW
+    since = timezone.now() - datetime.timedelta(seconds=window)
+    servers = VPNServer.objects.filter(active=True).annotate(
+        depth=Count('pooled_keys', filter=Q(pooled_keys__claimed_at=None)),
+        refilled=Count('pooled_keys', filter=Q(pooled_keys__created_at__gte=since)),
+        claimed=Count('pooled_keys', filter=Q(pooled_keys__claimed_at__gte=since)),
+    )
+    return [
+        {
+            'server_id': server.id,
+            'server_name': server.server_name,
+            'depth': server.depth,
+            'refilled': server.refilled,
+            'claimed': server.claimed,
+            'refill_per_hour': round(server.refilled * 3600 / window, 2),
+            'claim_per_hour': round(server.claimed * 3600 / window, 2),
+        }
+        for server in servers
+    ]
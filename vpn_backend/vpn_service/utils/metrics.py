@@ -0,0 +1,282 @@
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами; observe() — один bisect и три сложения под lock"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = [(labels, list(entry[0]), entry[1], entry[2]) for labels, entry in self._values.items()]
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class Gauge:
+    """Значения считаются в момент запроса /metrics функцией collect() -> {labels: value}"""
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for labels, value in self.collect().items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _active_keys_by_server():
+    from django.db.models import Count, Q
+    from vpn_service.models import VPNServer
+    servers = VPNServer.objects.annotate(
+        active_keys=Count('vpn_keys', filter=Q(vpn_keys__is_active=True)),
+    ).values_list('server_name', 'active_keys')
+    return {(server_name,): active_keys for server_name, active_keys in servers}
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Request latency by view and action',
+    ['view', 'action', 'method', 'status'],
+))
+request_db_queries = registry.register(Histogram(
+    'http_request_db_queries', 'Database queries per request',
+    ['view', 'action'], buckets=QUERY_COUNT_BUCKETS,
+))
+request_db_duration = registry.register(Histogram(
+    'http_request_db_duration_seconds', 'Total database query time per request',
+    ['view', 'action'],
+))
+outline_duration = registry.register(Histogram(
+    'outline_client_request_duration_seconds', 'Outline API call latency by server and method',
+    ['server', 'method'],
+))
+outline_errors = registry.register(Counter(
+    'outline_client_errors_total', 'Failed Outline API calls by server, method and exception',
+    ['server', 'method', 'error'],
+))
+active_keys = registry.register(Gauge(
+    'vpn_active_keys', 'Active keys per server', ['server'], collect=_active_keys_by_server,
+))
+
+
+INSTRUMENTED_METHODS = frozenset([
+    'get_keys', 'get_key', 'create_key', 'delete_key', 'rename_key', 'add_data_limit',
+    'delete_data_limit', 'get_server_information', 'get_server_stats', 'get_metrics',
+])
+
+
+class InstrumentedOutlineClient:
+    """
+    Обертка над OutlineVPNClient или AsyncOutlineVPNClient: замеряет время и
+    считает ошибки методов API с меткой сервера, остальное проксирует как есть.
+    """
+
+    def __init__(self, client, server_label):
+        self._client = client
+        self._server = server_label
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in INSTRUMENTED_METHODS:
+            return attr
+
+        if asyncio.iscoroutinefunction(attr):
+            async def timed_async(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await attr(*args, **kwargs)
+                except BaseException as e:
+                    outline_errors.inc(self._server, name, e.__class__.__name__)
+                    raise
+                finally:
+                    outline_duration.observe(time.perf_counter() - started, self._server, name)
+            return timed_async
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            except Exception as e:
+                outline_errors.inc(self._server, name, e.__class__.__name__)
+                raise
+            finally:
+                outline_duration.observe(time.perf_counter() - started, self._server, name)
+        return timed
+
+
+def instrument_client(client, server):
+    from django.conf import settings
+    if not settings.METRICS_ENABLED:
+        return client
+    return InstrumentedOutlineClient(client, server.server_name)
+
+
+# Счетчик [число, время] SQL-запросов текущего запроса. Контекст копируется в
+# потоки sync_to_async, поэтому запросы async ORM тоже попадают в счетчик
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries[0] += 1
+        queries[1] += time.perf_counter() - started
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """Обработчик connection_created (подключается в VpnServiceConfig.ready): счетчик запросов на каждое соединение"""
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class MetricsMiddleware:
+    """Время ответа, число и время SQL-запросов на запрос с метками view/action; работает под WSGI и ASGI"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        from django.conf import settings
+        if self.is_async:
+            return self.__acall__(request)
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        queries = [0, 0.0]
+        token = _request_queries.set(queries)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self._observe(request, response, time.perf_counter() - started, queries)
+        return response
+
+    async def __acall__(self, request):
+        from django.conf import settings
+        if not settings.METRICS_ENABLED:
+            return await self.get_response(request)
+
+        queries = [0, 0.0]
+        token = _request_queries.set(queries)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self._observe(request, response, time.perf_counter() - started, queries)
+        return response
+
+    def _observe(self, request, response, elapsed, queries):
+        view, action = self._labels(request)
+        request_duration.observe(elapsed, view, action, request.method, str(response.status_code))
+        request_db_queries.observe(queries[0], view, action)
+        request_db_duration.observe(queries[1], view, action)
+
+    @staticmethod
+    def _labels(request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unresolved', ''
+        func = match.func
+        view = getattr(getattr(func, 'cls', None), '__name__', None) or getattr(func, '__name__', 'unknown')
+        # У DRF ViewSet as_view() запоминает соответствие HTTP метода и action
+        actions = getattr(func, 'actions', None) or {}
+        return view, actions.get(request.method.lower(), '')
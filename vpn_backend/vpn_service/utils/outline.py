@@ -1,48 +1,283 @@
-from outline_vpn.outline_vpn import OutlineVPN
+import threading
+import time
+
+import requests
+from asgiref.sync import sync_to_async
+from outline_vpn.outline_vpn import OutlineVPN, _FingerprintAdapter
+
+from .metrics import instrument_client
+
+
+class ServerUnavailable(Exception):
+    """Сервер недоступен: цепь разомкнута, запрос к Outline не отправлялся"""
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+        super().__init__(f"Outline server {server_id} is unavailable (circuit open)")
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker по серверам Outline.
+
+    После failure_threshold сетевых ошибок подряд цепь размыкается, и запросы
+    к серверу сразу завершаются ServerUnavailable. Через cooldown секунд
+    пропускается один пробный запрос: успех замыкает цепь, ошибка снова
+    размыкает. Кроме собственных вызовов учитываются результаты фонового
+    пробника из таблицы ServerHealth, которая перечитывается не чаще
+    refresh_interval секунд.
+    """
+
+    def __init__(self, failure_threshold=None, cooldown=None, refresh_interval=None):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.refresh_interval = refresh_interval
+        self._state = {}
+        self._lock = threading.Lock()
+        self._refreshed_at = 0
+
+    def _settings(self):
+        from django.conf import settings
+        return (
+            self.failure_threshold or settings.OUTLINE_BREAKER_FAILURE_THRESHOLD,
+            self.cooldown or settings.OUTLINE_BREAKER_COOLDOWN,
+            self.refresh_interval or settings.OUTLINE_HEALTH_REFRESH_INTERVAL,
+        )
+
+    def _entry(self, server_id):
+        return self._state.setdefault(server_id, {'failures': 0, 'opened_at': None, 'updated_at': 0})
+
+    def refresh(self, force=False):
+        """Подтягивает состояние серверов из таблицы ServerHealth одним запросом"""
+        threshold, _, refresh_interval = self._settings()
+        now = time.time()
+        if not force and now - self._refreshed_at < refresh_interval:
+            return
+        self._refreshed_at = now
+
+        from vpn_service.models import ServerHealth
+        rows = ServerHealth.objects.exclude(last_checked_at=None).values_list(
+            'vpn_server_id', 'consecutive_failures', 'last_checked_at'
+        )
+        with self._lock:
+            for server_id, failures, checked_at in rows:
+                entry = self._entry(server_id)
+                checked_at = checked_at.timestamp()
+                if checked_at <= entry['updated_at']:
+                    continue
+                entry['failures'] = failures
+                entry['updated_at'] = checked_at
+                if failures >= threshold:
+                    entry['opened_at'] = max(entry['opened_at'] or 0, checked_at)
+                else:
+                    entry['opened_at'] = None
+
+    def is_open(self, server_id):
+        _, cooldown, _ = self._settings()
+        self.refresh()
+        with self._lock:
+            entry = self._state.get(server_id)
+            return bool(entry and entry['opened_at'] and time.time() - entry['opened_at'] < cooldown)
+
+    async def aallow(self, server_id):
+        """allow() для async кода: таблица ServerHealth перечитывается в потоке, а не в event loop"""
+        _, _, refresh_interval = self._settings()
+        if time.time() - self._refreshed_at >= refresh_interval:
+            await sync_to_async(self.refresh)()
+        return self.allow(server_id)
+
+    def allow(self, server_id):
+        _, cooldown, _ = self._settings()
+        self.refresh()
+        with self._lock:
+            entry = self._state.get(server_id)
+            if entry is None or entry['opened_at'] is None:
+                return True
+            now = time.time()
+            if now - entry['opened_at'] >= cooldown:
+                # Полуоткрытое состояние: пропускаем один пробный запрос за cooldown
+                entry['opened_at'] = now
+                return True
+            return False
+
+    def record_success(self, server_id):
+        with self._lock:
+            entry = self._entry(server_id)
+            entry.update(failures=0, opened_at=None, updated_at=time.time())
+
+    def record_failure(self, server_id):
+        threshold, _, _ = self._settings()
+        with self._lock:
+            entry = self._entry(server_id)
+            now = time.time()
+            entry['failures'] += 1
+            entry['updated_at'] = now
+            if entry['failures'] >= threshold:
+                entry['opened_at'] = now
+
+
+breaker = CircuitBreaker()
+
+
+class _PooledFingerprintAdapter(_FingerprintAdapter):
+    """Адаптер с проверкой отпечатка сертификата и таймаутом по умолчанию для всех запросов"""
+
+    def __init__(self, fingerprint=None, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(fingerprint, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
 
 
 class OutlineVPNClient:
-    def __init__(self, api_url, cert_sha256=None):
+    def __init__(self, api_url, cert_sha256=None, timeout=None, pool_maxsize=None, server_id=None,
+                 breaker=None):
         self.client = OutlineVPN(api_url=api_url, cert_sha256=cert_sha256)
+        self.server_id = server_id
+        self.breaker = breaker
+
+        if timeout is not None or pool_maxsize is not None:
+            # Заменяем адаптер сессии: keep-alive соединения в ограниченном пуле и таймауты (connect, read)
+            adapter = _PooledFingerprintAdapter(
+                cert_sha256,
+                timeout=timeout,
+                pool_connections=1,
+                pool_maxsize=pool_maxsize or 10,
+                pool_block=True,
+            )
+            self.client.session.mount('https://', adapter)
+            self.client.session.mount('http://', adapter)
+
+    def close(self):
+        self.client.session.close()
+
+    def _call(self, method, *args, **kwargs):
+        if self.breaker is None:
+            return method(*args, **kwargs)
+        if not self.breaker.allow(self.server_id):
+            raise ServerUnavailable(self.server_id)
+        try:
+            result = method(*args, **kwargs)
+        except requests.RequestException:
+            self.breaker.record_failure(self.server_id)
+            raise
+        self.breaker.record_success(self.server_id)
+        return result
 
     def get_keys(self):
-        return self.client.get_keys()
+        return self._call(self.client.get_keys)
 
     def get_key(self, key_id):
-        return self.client.get_key(key_id)
+        return self._call(self.client.get_key, key_id)
 
     def create_key(self, name=None):
-        return self.client.create_key(name=name)
+        return self._call(self.client.create_key, name=name)
 
     def delete_key(self, key_id):
-        return self.client.delete_key(key_id)
+        return self._call(self.client.delete_key, key_id)
 
     def rename_key(self, key_id, name):
-        return self.client.rename_key(key_id, name)
+        return self._call(self.client.rename_key, key_id, name)
 
     def add_data_limit(self, key_id, limit_bytes):
-        return self.client.add_data_limit(key_id, limit_bytes)
+        return self._call(self.client.add_data_limit, key_id, limit_bytes)
 
     def delete_data_limit(self, key_id):
-        return self.client.delete_data_limit(key_id)
+        return self._call(self.client.delete_data_limit, key_id)
 
     def get_server_information(self):
-        return self.client.get_server_information()
+        return self._call(self.client.get_server_information)
 
     def get_server_stats(self):
-        try:
-            metrics = self.client.get_metrics()
-            return {
-                'transferred_bytes': metrics.transferred_bytes,
-                'connected_clients': len(metrics.connected_clients)
-            }
-        except:
-            return {
-                'transferred_bytes': 0,
-                'connected_clients': 0
-            }
+        """Суммарный трафик сервера и число ключей, по которым был трафик; ошибки Outline пробрасываются"""
+        transferred = self._call(self.client.get_transferred_data)['bytesTransferredByUserId']
+        return {
+            'transferred_bytes': sum(transferred.values()),
+            'keys_with_traffic': sum(1 for used_bytes in transferred.values() if used_bytes),
+        }
 
     def gb_to_bytes(self, gb):
         """Преобразует гигабайты в байты"""
         bytes_in_gb = 1024 ** 3  # 1 ГБ = 1024^3 байт
-        return int(gb * bytes_in_gb)
\ No newline at end of file
+        return int(gb * bytes_in_gb)
+
+
+class OutlineClientPool:
+    """
+    Реестр переиспользуемых клиентов Outline на процесс, по одному на VPNServer.
+
+    Клиент хранится по server.id вместе с (api_url, cert_sha): если адрес или
+    сертификат сервера изменились, клиент пересоздается при следующем обращении.
+    """
+
+    def __init__(self, connect_timeout=None, read_timeout=None, pool_maxsize=None, breaker=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_maxsize = pool_maxsize
+        self.breaker = breaker
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _settings(self):
+        from django.conf import settings
+        return (
+            self.connect_timeout or settings.OUTLINE_CONNECT_TIMEOUT,
+            self.read_timeout or settings.OUTLINE_READ_TIMEOUT,
+            self.pool_maxsize or settings.OUTLINE_POOL_MAXSIZE,
+        )
+
+    def get(self, server):
+        fingerprint = (server.api_url, server.cert_sha)
+        with self._lock:
+            entry = self._clients.get(server.id)
+            if entry is not None and entry[0] == fingerprint:
+                return entry[1]
+
+            connect_timeout, read_timeout, pool_maxsize = self._settings()
+            client = instrument_client(OutlineVPNClient(
+                api_url=server.api_url,
+                cert_sha256=server.cert_sha,
+                timeout=(connect_timeout, read_timeout),
+                pool_maxsize=pool_maxsize,
+                server_id=server.id,
+                breaker=self.breaker,
+            ), server)
+            self._clients[server.id] = (fingerprint, client)
+
+        if entry is not None:
+            entry[1].close()
+        return client
+
+    def invalidate(self, server_id):
+        with self._lock:
+            entry = self._clients.pop(server_id, None)
+        if entry is not None:
+            entry[1].close()
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        for _, client in entries:
+            client.close()
+
+
+client_pool = OutlineClientPool(breaker=breaker)
+
+
+def get_client(server):
+    """Возвращает переиспользуемый клиент Outline для сервера"""
+    return client_pool.get(server)
+
+
+def outline_key_name(user, name):
+    """Имя ключа в Outline: '<username или telegram_id> - <название ключа>'"""
+    return f"{user.username or user.telegram_id} - {name}"
+
+
+def outline_data_limit(traffic_limit, traffic_offset=0):
+    """Лимит ключа в Outline: остаток квоты за вычетом трафика прежних ключей (traffic_offset); None — без лимита"""
+    if traffic_limit <= 0:
+        return None
+    return max(traffic_limit - traffic_offset, 0)
@@ -0,0 +1,315 @@
+import asyncio
+import functools
+import hashlib
+import ssl
+import threading
+import time
+import weakref
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import httpx
+from outline_vpn.outline_vpn import OutlineKey, OutlineServerErrorException, UNABLE_TO_GET_METRICS_ERROR
+
+from .metrics import instrument_client
+from .outline import breaker, ServerUnavailable
+
+ServerResult = namedtuple('ServerResult', ['server', 'result', 'error', 'elapsed'])
+
+_ssl_contexts = {}
+
+
+async def _pinned_ssl_context(api_url, cert_sha256):
+    """
+    SSL контекст, доверяющий только сертификату с отпечатком cert_sha256.
+
+    Сертификат забирается одним TLS рукопожатием без проверки, сверяется с
+    отпечатком и дальше используется как единственный доверенный, поэтому
+    все последующие соединения проверяются еще до отправки запроса.
+    """
+    parts = urlsplit(api_url)
+    cache_key = (parts.hostname, parts.port or 443, cert_sha256)
+    if cache_key in _ssl_contexts:
+        return _ssl_contexts[cache_key]
+
+    probe = ssl.create_default_context()
+    probe.check_hostname = False
+    probe.verify_mode = ssl.CERT_NONE
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 443, ssl=probe)
+    try:
+        der = writer.get_extra_info('ssl_object').getpeercert(binary_form=True)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+    if hashlib.sha256(der).hexdigest() != cert_sha256.replace(':', '').lower():
+        raise OutlineServerErrorException('Certificate fingerprint does not match cert_sha256')
+
+    context = ssl.create_default_context(cadata=der)
+    context.check_hostname = False
+    context.verify_flags |= ssl.VERIFY_X509_PARTIAL_CHAIN
+    _ssl_contexts[cache_key] = context
+    return context
+
+
+def _guarded(method):
+    """Пропускает вызов через circuit breaker клиента, как OutlineVPNClient._call"""
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if self.breaker is None:
+            return await method(self, *args, **kwargs)
+        if not await self.breaker.aallow(self.server_id):
+            raise ServerUnavailable(self.server_id)
+        try:
+            result = await method(self, *args, **kwargs)
+        except httpx.TransportError:
+            self.breaker.record_failure(self.server_id)
+            raise
+        self.breaker.record_success(self.server_id)
+        return result
+    return wrapper
+
+
+class AsyncOutlineVPNClient:
+    """
+    Асинхронный аналог OutlineVPNClient на одном httpx.AsyncClient с keep-alive.
+
+    Клиент привязан к event loop, в котором сделан первый запрос; закрывайте
+    его через aclose() или используйте как async context manager.
+    """
+
+    def __init__(self, api_url, cert_sha256=None, timeout=None, pool_maxsize=None, server_id=None,
+                 breaker=None):
+        self.api_url = api_url.rstrip('/')
+        self.cert_sha256 = cert_sha256
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.server_id = server_id
+        self.breaker = breaker
+        self._http = None
+        self._http_lock = asyncio.Lock()
+        # Очередь ожидания держим в семафоре: httpcore на каждое освобождение
+        # соединения перебирает все ждущие запросы, и сотни ожидающих под ASGI
+        # превращаются в квадратичную нагрузку на CPU
+        self._slots = asyncio.Semaphore(pool_maxsize or 10)
+
+    @classmethod
+    def for_server(cls, server, breaker=None):
+        from django.conf import settings
+        return cls(
+            api_url=server.api_url,
+            cert_sha256=server.cert_sha,
+            timeout=(settings.OUTLINE_CONNECT_TIMEOUT, settings.OUTLINE_READ_TIMEOUT),
+            pool_maxsize=settings.OUTLINE_POOL_MAXSIZE,
+            server_id=server.id,
+            breaker=breaker,
+        )
+
+    async def _client(self):
+        async with self._http_lock:
+            if self._http is None:
+                verify = True
+                if self.api_url.startswith('https://'):
+                    if not self.cert_sha256:
+                        raise OutlineServerErrorException('No certificate SHA256 provided')
+                    verify = await _pinned_ssl_context(self.api_url, self.cert_sha256)
+                connect_timeout, read_timeout = self.timeout or (None, None)
+                self._http = httpx.AsyncClient(
+                    verify=verify,
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                    limits=httpx.Limits(
+                        max_connections=self.pool_maxsize or 10,
+                        max_keepalive_connections=self.pool_maxsize or 10,
+                    ),
+                )
+            return self._http
+
+    async def _request(self, method, path, **kwargs):
+        http = await self._client()
+        async with self._slots:
+            return await http.request(method, f"{self.api_url}{path}", **kwargs)
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    @_guarded
+    async def get_keys(self):
+        response, metrics = await asyncio.gather(
+            self._request('GET', '/access-keys/'),
+            self._metrics(),
+        )
+        if response.status_code != 200 or 'accessKeys' not in response.json():
+            raise OutlineServerErrorException('Unable to retrieve keys')
+        return [OutlineKey(key, metrics) for key in response.json()['accessKeys']]
+
+    @_guarded
+    async def get_key(self, key_id):
+        response, metrics = await asyncio.gather(
+            self._request('GET', f"/access-keys/{key_id}"),
+            self._metrics(),
+        )
+        if response.status_code != 200:
+            raise OutlineServerErrorException('Unable to get key')
+        return OutlineKey(response.json(), metrics)
+
+    @_guarded
+    async def create_key(self, name=None):
+        payload = {'name': name} if name else {}
+        response = await self._request('POST', '/access-keys', json=payload)
+        if response.status_code != 201:
+            raise OutlineServerErrorException(f"Unable to create key. {response.text}")
+        return OutlineKey(response.json())
+
+    @_guarded
+    async def delete_key(self, key_id):
+        """True — ключ удален, False — ключа на сервере нет; другие ответы считаются ошибкой"""
+        response = await self._request('DELETE', f"/access-keys/{key_id}")
+        if response.status_code not in (204, 404):
+            raise OutlineServerErrorException(f"Unable to delete key. {response.text}")
+        return response.status_code == 204
+
+    @_guarded
+    async def rename_key(self, key_id, name):
+        response = await self._request('PUT', f"/access-keys/{key_id}/name", json={'name': name})
+        return response.status_code == 204
+
+    @_guarded
+    async def add_data_limit(self, key_id, limit_bytes):
+        response = await self._request(
+            'PUT', f"/access-keys/{key_id}/data-limit", json={'limit': {'bytes': limit_bytes}}
+        )
+        return response.status_code == 204
+
+    @_guarded
+    async def delete_data_limit(self, key_id):
+        response = await self._request('DELETE', f"/access-keys/{key_id}/data-limit")
+        return response.status_code == 204
+
+    @_guarded
+    async def get_server_information(self):
+        response = await self._request('GET', '/server')
+        if response.status_code != 200:
+            raise OutlineServerErrorException('Unable to get information about the server')
+        return response.json()
+
+    async def _metrics(self):
+        response = await self._request('GET', '/metrics/transfer')
+        if response.status_code >= 400 or 'bytesTransferredByUserId' not in response.json():
+            raise OutlineServerErrorException(UNABLE_TO_GET_METRICS_ERROR)
+        return response.json()
+
+    @_guarded
+    async def get_metrics(self):
+        """Трафик по ключам: {"bytesTransferredByUserId": {"1": 1008040941, ...}}"""
+        return await self._metrics()
+
+    @_guarded
+    async def get_server_stats(self):
+        """Суммарный трафик сервера и число ключей, по которым был трафик"""
+        transferred = (await self._metrics())['bytesTransferredByUserId']
+        return {
+            'transferred_bytes': sum(transferred.values()),
+            'keys_with_traffic': sum(1 for used_bytes in transferred.values() if used_bytes),
+        }
+
+
+async def gather_across_servers(servers, operation, concurrency=None, timeout=None, pool=None):
+    """
+    Выполняет await operation(client, server) для всех серверов одновременно.
+
+    Клиенты берутся из pool (по умолчанию async_client_pool — общий для event
+    loop и с circuit breaker: вызовы к разомкнутому серверу завершаются
+    ServerUnavailable). Не больше concurrency серверов обрабатываются
+    параллельно, каждый ограничен своим timeout. Возвращает список
+    ServerResult в порядке servers; ошибка одного сервера не прерывает
+    остальные. Внутри operation нельзя обращаться к ORM синхронно — данные из
+    БД нужно подготовить заранее.
+    """
+    from django.conf import settings
+    pool = pool or async_client_pool
+    semaphore = asyncio.Semaphore(concurrency or settings.OUTLINE_FANOUT_CONCURRENCY)
+
+    async def run(server):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(operation(pool.get(server), server), timeout)
+                return ServerResult(server, result, None, time.monotonic() - started)
+            except Exception as e:
+                return ServerResult(server, None, e, time.monotonic() - started)
+
+    return await asyncio.gather(*(run(server) for server in servers))
+
+
+def run_across_servers(servers, operation, concurrency=None, timeout=None, pool=None):
+    """
+    Синхронная обертка над gather_across_servers для management-команд и sync
+    view. asyncio.run создает свой event loop, поэтому клиенты pool этого loop
+    закрываются в конце вызова.
+    """
+    pool = pool or async_client_pool
+    if pool.breaker is not None:
+        # Breaker читает ServerHealth из БД — подтягиваем его до перехода в event loop
+        pool.breaker.refresh()
+
+    async def gather():
+        try:
+            return await gather_across_servers(list(servers), operation, concurrency, timeout, pool)
+        finally:
+            await pool.aclose()
+
+    return asyncio.run(gather())
+
+
+class AsyncOutlineClientPool:
+    """
+    Переиспользуемые асинхронные клиенты Outline для async view под ASGI.
+
+    httpx.AsyncClient привязан к event loop, поэтому клиенты хранятся отдельно
+    для каждого loop (под uvicorn он один на процесс) и по server.id вместе с
+    (api_url, cert_sha), как в OutlineClientPool. Клиенты пропускают вызовы
+    через общий circuit breaker.
+    """
+
+    def __init__(self, breaker=None):
+        self.breaker = breaker
+        self._clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, server):
+        """Клиент для сервера в текущем event loop; вызывать только из корутины"""
+        loop = asyncio.get_running_loop()
+        fingerprint = (server.api_url, server.cert_sha)
+        with self._lock:
+            clients = self._clients.setdefault(loop, {})
+            entry = clients.get(server.id)
+            if entry is not None and entry[0] == fingerprint:
+                return entry[1]
+            client = instrument_client(AsyncOutlineVPNClient.for_server(server, breaker=self.breaker), server)
+            clients[server.id] = (fingerprint, client)
+
+        if entry is not None:
+            # Адрес или сертификат сервера изменились — старый клиент закрываем в фоне
+            loop.create_task(entry[1].aclose())
+        return client
+
+    async def aclose(self):
+        """Закрывает клиенты текущего event loop"""
+        with self._lock:
+            clients = self._clients.pop(asyncio.get_running_loop(), {})
+        for _, client in clients.values():
+            await client.aclose()
+
+
+async_client_pool = AsyncOutlineClientPool(breaker=breaker)
+# Для пробника серверов: он сам пишет результаты в breaker и должен опрашивать и разомкнутые серверы
+probe_client_pool = AsyncOutlineClientPool()
@@ -0,0 +1,290 @@
+import asyncio
+import heapq
+import logging
+import math
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from vpn_service.models import OutlineJob, VPNKey, VPNServer
+from .catalog import server_catalog
+from .outline import breaker, outline_data_limit, outline_key_name, ServerUnavailable
+from .outline_async import run_across_servers, ServerResult
+from .selection import server_ranking
+from .user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+Move = namedtuple('Move', ['vpn_key', 'source', 'target'])
+
+# Задачи очереди, которые еще обратятся к Outline по outline_id ключа
+ACTIVE_JOB_STATUSES = [OutlineJob.PENDING, OutlineJob.RUNNING]
+
+MOVED_FIELDS = ['vpn_server', 'outline_id', 'access_url', 'traffic_used', 'traffic_offset',
+                'traffic_last_period_bytes', 'traffic_synced_at', 'updated_at']
+
+
+def _load_servers():
+    return list(
+        VPNServer.objects.select_related('city', 'health')
+        .annotate(active_keys=Count('vpn_keys', filter=Q(vpn_keys__is_active=True)))
+    )
+
+
+def _healthy(server):
+    health = getattr(server, 'health', None)
+    failures = health.consecutive_failures if health else 0
+    return failures < settings.OUTLINE_BREAKER_FAILURE_THRESHOLD and not breaker.is_open(server.id)
+
+
+def plan_moves(drain=(), sources=None, tolerance=None, limit=None, same_country=True):
+    """
+    Планирует перенос активных ключей между серверами.
+
+    С drain переносятся все активные ключи указанных серверов. Иначе ищутся
+    перегруженные серверы (из sources или все): у которых активных ключей
+    больше среднего по группе более чем на tolerance; лишние ключи уходят на
+    серверы ниже среднего. Группа — страна сервера (same_country) или все
+    серверы. Цели — активные здоровые серверы (ServerHealth и circuit
+    breaker), каждый ключ назначается на наименее загруженную с учетом уже
+    запланированных переносов. Ключи с невыполненными задачами OutlineJob не
+    переносятся: задача держит старый outline_id. Возвращает (moves, unplaced):
+    список Move и число ключей, для которых не нашлось цели.
+    """
+    tolerance = settings.REBALANCE_TOLERANCE if tolerance is None else tolerance
+    drain = set(drain)
+    servers = _load_servers()
+
+    def group_of(server):
+        return server.city.country_id if same_country else None
+
+    targets = {}
+    for server in servers:
+        if server.active and server.id not in drain and _healthy(server):
+            targets.setdefault(group_of(server), []).append(server)
+
+    excess = {}
+    if drain:
+        for server in servers:
+            if server.id in drain and server.active_keys:
+                excess[server.id] = (server, server.active_keys)
+        ceilings = {}
+    else:
+        ceilings = {}
+        for group, members in targets.items():
+            average = sum(server.active_keys for server in members) / len(members)
+            ceilings[group] = math.ceil(average)
+            for server in members:
+                if sources is not None and server.id not in sources:
+                    continue
+                if server.active_keys > average * (1 + tolerance):
+                    excess[server.id] = (server, server.active_keys - ceilings[group])
+
+    # Кучи целей по группам: (запланированное число ключей, id, сервер)
+    heaps = {}
+    for group, members in targets.items():
+        heaps[group] = [(server.active_keys, server.id, server) for server in members if server.id not in excess]
+        heapq.heapify(heaps[group])
+
+    moves = []
+    unplaced = 0
+    for server_id, (source, count) in excess.items():
+        if limit is not None:
+            count = min(count, limit - len(moves))
+        if count <= 0:
+            continue
+        keys = (
+            VPNKey.objects.filter(vpn_server_id=server_id, is_active=True)
+            .exclude(jobs__status__in=ACTIVE_JOB_STATUSES)
+            .select_related('user')
+            .order_by('id')[:count]
+        )
+        heap = heaps.get(group_of(source), [])
+        ceiling = ceilings.get(group_of(source))
+        for vpn_key in keys:
+            # В режиме выравнивания не поднимаем цель выше среднего по группе
+            if not heap or (ceiling is not None and heap[0][0] >= ceiling):
+                unplaced += 1
+                continue
+            planned, target_id, target = heapq.heappop(heap)
+            moves.append(Move(vpn_key, source, target))
+            heapq.heappush(heap, (planned + 1, target_id, target))
+    return moves, unplaced
+
+
+class _Throttle:
+    """Не больше rate операций в секунду на сервер и не больше concurrency одновременно"""
+
+    def __init__(self, rate, concurrency):
+        self.interval = 1 / rate if rate else 0
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._next = 0
+        self._lock = asyncio.Lock()
+
+    async def run(self, coroutine_function, *args):
+        async with self.semaphore:
+            if self.interval:
+                async with self._lock:
+                    now = time.monotonic()
+                    delay = self._next - now
+                    self._next = max(now, self._next) + self.interval
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            return await coroutine_function(*args)
+
+
+async def _create_keys(client, server, moves, rate, concurrency):
+    throttle = _Throttle(rate, concurrency)
+
+    async def create(move):
+        key = await client.create_key(name=outline_key_name(move.vpn_key.user, move.vpn_key.name))
+        # Новому ключу — только остаток квоты: трафик старого ключа уходит в traffic_offset
+        limit = outline_data_limit(move.vpn_key.traffic_limit, move.vpn_key.traffic_offset + move.vpn_key.traffic_used)
+        if limit is not None:
+            if not await client.add_data_limit(key.key_id, limit):
+                # Ключ без лимита оставлять нельзя — удаляем и считаем перенос неудачным
+                await client.delete_key(key.key_id)
+                raise RuntimeError('Unable to set data limit')
+        return key
+
+    return await asyncio.gather(*(throttle.run(create, move) for move in moves), return_exceptions=True)
+
+
+async def _delete_keys(client, server, outline_ids, rate, concurrency):
+    throttle = _Throttle(rate, concurrency)
+    return await asyncio.gather(
+        *(throttle.run(client.delete_key, outline_id) for outline_id in outline_ids), return_exceptions=True,
+    )
+
+
+def _available(servers):
+    # Breaker читает ServerHealth из БД, поэтому проверяем его до перехода в event loop. is_open не
+    # занимает пробный запрос полуоткрытой цепи — его сделает клиент, и результат запишется в breaker
+    available = [server for server in servers if not breaker.is_open(server.id)]
+    blocked = [ServerResult(server, None, ServerUnavailable(server.id), 0) for server in servers if server not in available]
+    return available, blocked
+
+
+def _move_batch(moves, report, rate, concurrency):
+    by_target = {}
+    for move in moves:
+        by_target.setdefault(move.target.id, (move.target, []))[1].append(move)
+
+    available, results = _available([target for target, _ in by_target.values()])
+
+    def create(client, server):
+        return _create_keys(client, server, by_target[server.id][1], rate, concurrency)
+
+    results.extend(run_across_servers(available, create))
+
+    created = []
+    for result in results:
+        target_moves = by_target[result.server.id][1]
+        outcomes = result.result if result.error is None else [result.error] * len(target_moves)
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        if errors:
+            logger.warning('Failed to create %s of %s keys on server %s: %r',
+                           len(errors), len(target_moves), result.server.id, errors[0])
+            report['failed'] += len(errors)
+        created.extend(
+            (move, outcome) for move, outcome in zip(target_moves, outcomes)
+            if not isinstance(outcome, BaseException)
+        )
+
+    # Подменяем строки одной транзакцией; ключи, отозванные или перенесенные за время
+    # создания или получившие задачу в очереди, не трогаем — созданные для них ключи
+    # удаляются вместе со старыми
+    to_delete = {}
+    moved_users = set()
+    now = timezone.now()
+    with transaction.atomic():
+        key_ids = [move.vpn_key.id for move, _ in created]
+        rows = VPNKey.objects.select_for_update().in_bulk(key_ids)
+        busy = set(
+            OutlineJob.objects.filter(vpn_key_id__in=key_ids, status__in=ACTIVE_JOB_STATUSES)
+            .values_list('vpn_key_id', flat=True)
+        )
+        updated = []
+        for move, outline_key in created:
+            row = rows.get(move.vpn_key.id)
+            if row is None or not row.is_active or row.vpn_server_id != move.source.id or row.id in busy:
+                to_delete.setdefault(move.target.id, (move.target, []))[1].append(outline_key.key_id)
+                report['skipped'] += 1
+                continue
+            to_delete.setdefault(move.source.id, (move.source, []))[1].append(row.outline_id)
+            row.vpn_server = move.target
+            row.outline_id = outline_key.key_id
+            row.access_url = outline_key.access_url
+            # Счетчик трафика нового ключа в Outline начинается с нуля, израсходованное
+            # копится в traffic_offset и учитывается enforce_keys
+            row.traffic_offset += row.traffic_used
+            row.traffic_used = 0
+            row.traffic_last_period_bytes = 0
+            row.traffic_synced_at = None
+            row.updated_at = now
+            updated.append(row)
+            moved_users.add(move.vpn_key.user.telegram_id)
+            report['servers'].setdefault(move.source.server_name, {'out': 0, 'in': 0})['out'] += 1
+            report['servers'].setdefault(move.target.server_name, {'out': 0, 'in': 0})['in'] += 1
+        VPNKey.objects.bulk_update(updated, MOVED_FIELDS)
+        # bulk_update не шлет сигналы — сбрасываем кэш владельцев сами
+        transaction.on_commit(lambda: user_cache.invalidate_many(moved_users))
+    report['moved'] += len(updated)
+
+    available, results = _available([server for server, _ in to_delete.values()])
+
+    def delete(client, server):
+        return _delete_keys(client, server, to_delete[server.id][1], rate, concurrency)
+
+    results.extend(run_across_servers(available, delete))
+    for result in results:
+        outline_ids = to_delete[result.server.id][1]
+        outcomes = result.result if result.error is None else [result.error] * len(outline_ids)
+        failed = sum(1 for outcome in outcomes if isinstance(outcome, BaseException))
+        report['deleted'] += len(outline_ids) - failed
+        report['delete_failed'] += failed
+
+
+def execute_moves(moves, batch_size=None, concurrency=None, rate=None):
+    """
+    Выполняет перенос пачками по batch_size ключей.
+
+    В каждой пачке новые ключи создаются на всех целях одновременно, строки
+    VPNKey подменяются одним bulk_update в транзакции, затем старые ключи
+    удаляются на всех источниках одновременно. На каждый сервер не больше
+    concurrency запросов одновременно и не больше rate в секунду. Если процесс
+    упадет посреди пачки, в Outline останутся лишние ключи без строк в БД —
+    reconcile покажет их как unknown, удалить их можно reconcile --delete-unknown.
+    """
+    batch_size = batch_size or settings.REBALANCE_BATCH_SIZE
+    concurrency = concurrency or settings.REBALANCE_SERVER_CONCURRENCY
+    rate = settings.REBALANCE_SERVER_RATE if rate is None else rate
+    started = time.monotonic()
+    report = {'planned': len(moves), 'moved': 0, 'failed': 0, 'skipped': 0, 'deleted': 0, 'delete_failed': 0,
+              'servers': {}}
+    for start in range(0, len(moves), batch_size):
+        _move_batch(moves[start:start + batch_size], report, rate, concurrency)
+    server_ranking.invalidate()
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
+
+
+def deactivate_servers(server_ids):
+    """Снимает серверы с выдачи (active=False) без переноса ключей"""
+    VPNServer.objects.filter(id__in=server_ids).update(active=False, updated_at=timezone.now())
+    # update() не шлет сигналы — каталог и рейтинг сбрасываем сами
+    server_catalog.invalidate()
+    server_ranking.invalidate()
+
+
+def drain_servers(server_ids, limit=None, same_country=True, **options):
+    """Снимает серверы с выдачи (active=False) и переносит их активные ключи на другие серверы"""
+    deactivate_servers(server_ids)
+    moves, unplaced = plan_moves(drain=server_ids, limit=limit, same_country=same_country)
+    report = execute_moves(moves, **options)
+    report['unplaced'] = unplaced
+    return report
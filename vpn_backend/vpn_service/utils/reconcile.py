@@ -0,0 +1,211 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from vpn_service.models import PooledKey, VPNKey
+from .outline import outline_data_limit, outline_key_name
+from .outline_async import run_across_servers
+from .user_cache import user_cache
+
+
+async def _fetch_keys(client, server):
+    return {str(key.key_id): key for key in await client.get_keys()}
+
+
+async def _apply_fixes(client, server, plan, concurrency):
+    """Удаляет лишние ключи, переименовывает ключи и выправляет лимиты одного сервера"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    operations = (
+        [client.delete_key(outline_id) for outline_id in plan['delete']]
+        + [client.rename_key(outline_id, name) for outline_id, name in plan['names']]
+        + [
+            client.add_data_limit(outline_id, limit) if limit is not None else client.delete_data_limit(outline_id)
+            for outline_id, limit in plan['limits']
+        ]
+    )
+    return await asyncio.gather(*(run(operation) for operation in operations), return_exceptions=True)
+
+
+def _deactivate_ghosts(ghosts, fetched_at):
+    """
+    Деактивирует строки ghosts — {id: (vpn_server_id, outline_id)}, которые
+    под блокировкой все еще указывают на тот же ключ и не менялись после
+    fetched_at. Возвращает число деактивированных строк.
+    """
+    with transaction.atomic():
+        rows = (
+            VPNKey.objects.select_for_update(of=('self',))
+            .filter(id__in=ghosts.keys(), is_active=True, updated_at__lt=fetched_at)
+            .values_list('id', 'vpn_server_id', 'outline_id', 'user__telegram_id')
+        )
+        ids, telegram_ids = [], set()
+        for key_id, server_id, outline_id, telegram_id in rows:
+            if ghosts[key_id] == (server_id, outline_id):
+                ids.append(key_id)
+                telegram_ids.add(telegram_id)
+        VPNKey.objects.filter(id__in=ids).update(is_active=False, updated_at=timezone.now())
+        # update() не шлет сигналы — сбрасываем кэш владельцев сами
+        transaction.on_commit(lambda: user_cache.invalidate_many(telegram_ids))
+    return len(ids)
+
+
+def reconcile_servers(servers, dry_run=False, timeout=None, delete_unknown=False):
+    """
+    Сверяет ключи в Outline с VPNKey по каждому серверу.
+
+    Делает один get_keys() на сервер (все серверы одновременно) и сравнивает
+    множества outline_id с активными строками VPNKey:
+      - orphans: ключ есть в Outline, активной строки нет, но есть отозванная
+        строка VPNKey или выданный ключ пула этого сервера — удаляется в Outline;
+      - unknown: ключ есть в Outline, а строк о нем нет вовсе (создан в обход
+        бэкенда или остался от прерванного переноса) — только попадает в отчет,
+        удаляется лишь с delete_unknown; ключи, созданные в обход бэкенда,
+        можно сначала завести командой import_outline_keys;
+      - ghosts: активная строка есть, а ключа в Outline нет — строка
+        деактивируется одним UPDATE, если не менялась после запроса к Outline
+        (перенос rebalance меняет outline_id и updated_at);
+      - names/limits: имя или лимит трафика в Outline не совпадают с БД —
+        выправляются в Outline.
+    Строки, созданные или измененные после запроса к Outline, в ghosts не
+    попадают, ghosts перечитываются под блокировкой перед деактивацией, а
+    удаляемые ключи перепроверяются по БД перед удалением. Строки БД читаются
+    одним потоковым запросом, исправления в Outline идут на все серверы
+    одновременно (не больше RECONCILE_SERVER_CONCURRENCY запросов на сервер).
+    С dry_run только считает расхождения.
+    """
+    servers = list(servers)
+    started = time.monotonic()
+    fetched_at = timezone.now()
+    fetched = run_across_servers(servers, _fetch_keys, timeout=timeout)
+
+    report = {'servers': {}, 'orphans': 0, 'unknown': 0, 'ghosts': 0, 'names': 0, 'limits': 0, 'fixed': 0,
+              'failed': 0}
+    remote = {}
+    for result in fetched:
+        if result.error is not None:
+            report['servers'][result.server.server_name] = {
+                'error': str(result.error) or result.error.__class__.__name__,
+            }
+            continue
+        remote[result.server.id] = (result.server, result.result)
+
+    rows = (
+        VPNKey.objects.filter(vpn_server_id__in=remote.keys(), is_active=True)
+        .select_related('user')
+        .only('id', 'vpn_server_id', 'outline_id', 'name', 'traffic_limit', 'traffic_offset', 'updated_at',
+              'user__username', 'user__telegram_id')
+    )
+    active = {server_id: {} for server_id in remote}
+    for vpn_key in rows.iterator(chunk_size=5000):
+        active[vpn_key.vpn_server_id][vpn_key.outline_id] = vpn_key
+    pooled = set(
+        PooledKey.objects.filter(vpn_server_id__in=remote.keys(), claimed_at=None)
+        .values_list('vpn_server_id', 'outline_id')
+    )
+    unmatched = {
+        (server_id, outline_id)
+        for server_id, (server, remote_keys) in remote.items() for outline_id in remote_keys
+        if outline_id not in active[server_id] and (server_id, outline_id) not in pooled
+    }
+    unmatched_ids = {outline_id for _, outline_id in unmatched}
+    # Ключ, о котором бэкенд что-то знал: отозванная строка или выданный ключ пула
+    recorded = unmatched & (set(
+        VPNKey.objects.filter(vpn_server_id__in=remote.keys(), outline_id__in=unmatched_ids, is_active=False)
+        .values_list('vpn_server_id', 'outline_id')
+    ) | set(
+        PooledKey.objects.filter(vpn_server_id__in=remote.keys(), outline_id__in=unmatched_ids)
+        .exclude(claimed_at=None)
+        .values_list('vpn_server_id', 'outline_id')
+    ))
+
+    plans = {}
+    ghosts = {}
+    for server_id, (server, remote_keys) in remote.items():
+        server_rows = active[server_id]
+        plan = {
+            'orphans': [
+                outline_id for outline_id in remote_keys
+                if (server_id, outline_id) in unmatched and (server_id, outline_id) in recorded
+            ],
+            'unknown': [
+                outline_id for outline_id in remote_keys
+                if (server_id, outline_id) in unmatched and (server_id, outline_id) not in recorded
+            ],
+            'ghosts': [
+                (vpn_key.id, outline_id) for outline_id, vpn_key in server_rows.items()
+                if outline_id not in remote_keys and vpn_key.updated_at < fetched_at
+            ],
+            'names': [],
+            'limits': [],
+        }
+        for outline_id, vpn_key in server_rows.items():
+            remote_key = remote_keys.get(outline_id)
+            if remote_key is None:
+                continue
+            expected_name = outline_key_name(vpn_key.user, vpn_key.name)
+            if remote_key.name != expected_name:
+                plan['names'].append((outline_id, expected_name))
+            expected_limit = outline_data_limit(vpn_key.traffic_limit, vpn_key.traffic_offset)
+            if remote_key.data_limit != expected_limit:
+                plan['limits'].append((outline_id, expected_limit))
+
+        plans[server_id] = plan
+        ghosts.update((key_id, (server_id, outline_id)) for key_id, outline_id in plan['ghosts'])
+        report['servers'][server.server_name] = {
+            'remote_keys': len(remote_keys),
+            'active_keys': len(server_rows),
+            **{kind: len(plan[kind]) for kind in ('orphans', 'unknown', 'ghosts', 'names', 'limits')},
+        }
+        for kind in ('orphans', 'unknown', 'ghosts', 'names', 'limits'):
+            report[kind] += len(plan[kind])
+
+    if not dry_run:
+        report['fixed'] += _deactivate_ghosts(ghosts, fetched_at)
+
+        for plan in plans.values():
+            plan['delete'] = plan['orphans'] + (plan['unknown'] if delete_unknown else [])
+        # Перепроверяем удаляемые ключи прямо перед удалением: create_key и пополнение
+        # пула создают ключ в Outline раньше, чем строку в БД
+        delete_ids = {outline_id for plan in plans.values() for outline_id in plan['delete']}
+        in_use = set(
+            VPNKey.objects.filter(vpn_server_id__in=plans.keys(), outline_id__in=delete_ids, is_active=True)
+            .values_list('vpn_server_id', 'outline_id')
+        ) | set(
+            PooledKey.objects.filter(vpn_server_id__in=plans.keys(), outline_id__in=delete_ids, claimed_at=None)
+            .values_list('vpn_server_id', 'outline_id')
+        )
+        for server_id, plan in plans.items():
+            plan['delete'] = [outline_id for outline_id in plan['delete'] if (server_id, outline_id) not in in_use]
+
+        to_fix = [
+            remote[server_id][0] for server_id, plan in plans.items()
+            if plan['delete'] or plan['names'] or plan['limits']
+        ]
+
+        def fix(client, server):
+            return _apply_fixes(client, server, plans[server.id], settings.RECONCILE_SERVER_CONCURRENCY)
+
+        # Исправления ограничены таймаутами клиента, а не таймаутом опроса
+        for result in run_across_servers(to_fix, fix):
+            plan = plans[result.server.id]
+            total = len(plan['delete']) + len(plan['names']) + len(plan['limits'])
+            outcomes = result.result if result.error is None else [result.error] * total
+            # delete_key возвращает False, если ключа уже нет, — это не ошибка; rename и лимиты — ошибка
+            failed = sum(
+                1 for index, outcome in enumerate(outcomes)
+                if isinstance(outcome, BaseException) or (outcome is False and index >= len(plan['delete']))
+            )
+            report['servers'][result.server.server_name]['failed'] = failed
+            report['fixed'] += total - failed
+            report['failed'] += failed
+
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Q
+
+from vpn_service.models import VPNServer
+from .outline import breaker
+
+logger = logging.getLogger(__name__)
+
+
+class ServerRanking:
+    """
+    Кэш нагрузки серверов в памяти процесса для автоматического выбора сервера.
+
+    Раз в refresh_interval секунд одним агрегирующим запросом собирается число
+    активных ключей на каждом активном сервере вместе с последними трафиком,
+    числом ключей с трафиком и состоянием из ServerHealth. Обновляет кэш фоновый поток
+    процесса, запущенный первым select(); в запросе кэш собирается только при
+    первом выборе и после invalidate(). Сам выбор идет только по этому кэшу:
+    ни запросов к БД, ни обращений к Outline на каждый вызов select().
+    """
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = refresh_interval
+        self._entries = []
+        self._lock = threading.Lock()
+        self._refreshed_at = 0
+        self._thread = None
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._refresh_loop, name='server-ranking', daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            refresh_interval = self.refresh_interval or settings.SERVER_RANKING_REFRESH_INTERVAL
+            time.sleep(max(1, refresh_interval - (time.monotonic() - self._refreshed_at)))
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Failed to refresh server ranking')
+            finally:
+                # Соединение потока не держим открытым между обновлениями
+                connection.close()
+
+    def refresh(self, force=False):
+        refresh_interval = self.refresh_interval or settings.SERVER_RANKING_REFRESH_INTERVAL
+        if not force and time.monotonic() - self._refreshed_at < refresh_interval:
+            return
+
+        servers = (
+            VPNServer.objects.filter(active=True)
+            .select_related('city', 'health')
+            .annotate(active_keys=Count('vpn_keys', filter=Q(vpn_keys__is_active=True)))
+        )
+        entries = []
+        for server in servers:
+            health = getattr(server, 'health', None)
+            entries.append({
+                'server': server,
+                'city_id': server.city_id,
+                'country_id': server.city.country_id,
+                'active_keys': server.active_keys,
+                'keys_with_traffic': (health and health.keys_with_traffic) or 0,
+                'transferred_bytes': (health and health.transferred_bytes) or 0,
+                'failures': health.consecutive_failures if health else 0,
+            })
+
+        with self._lock:
+            self._entries = entries
+            self._refreshed_at = time.monotonic()
+
+    def invalidate(self):
+        self._refreshed_at = 0
+
+    def select(self, country_id=None, city_id=None):
+        """Возвращает наименее загруженный здоровый сервер или None"""
+        if not self._refreshed_at:
+            self.refresh()
+        self._start_refresher()
+        threshold = settings.OUTLINE_BREAKER_FAILURE_THRESHOLD
+        with self._lock:
+            entries = [
+                entry for entry in self._entries
+                if (country_id is None or entry['country_id'] == int(country_id))
+                and (city_id is None or entry['city_id'] == int(city_id))
+                and entry['failures'] < threshold
+            ]
+        # breaker может перечитывать ServerHealth из БД — не держим блокировку на время запроса
+        candidates = [entry for entry in entries if not breaker.is_open(entry['server'].id)]
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda entry: (
+            entry['active_keys'], entry['keys_with_traffic'], entry['transferred_bytes'],
+        ))
+        return best['server']
+
+    def record_key_created(self, server_id):
+        # До следующего обновления учитываем выданный ключ сами, чтобы не выбирать тот же сервер подряд
+        with self._lock:
+            for entry in self._entries:
+                if entry['server'].id == server_id:
+                    entry['active_keys'] += 1
+
+
+server_ranking = ServerRanking()
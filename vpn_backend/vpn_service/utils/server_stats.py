@@ -0,0 +1,84 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .outline_async import run_across_servers
+
+STATS_KEY_PREFIX = 'server-stats:'
+LOCK_KEY_PREFIX = 'server-stats-lock:'
+
+
+async def _fetch_stats(client, server):
+    return await client.get_server_stats()
+
+
+def collect_server_stats(servers, ttl=None, timeout=None):
+    """
+    Статистика серверов из кэша с обновлением устаревших записей.
+
+    Запись сервера в Django cache считается свежей ttl секунд. Устаревшие и
+    отсутствующие записи обновляются одновременно по всем серверам, каждый
+    сервер ограничен timeout. Обновляет запись только процесс, взявший
+    cache.add-блокировку сервера, остальные отдают прежнее значение — поэтому
+    частый опрос дашбордами не умножает запросы к Outline. Если сервер не
+    ответил, отдается последнее известное значение с stale=True и ошибкой.
+    """
+    ttl = settings.SERVER_STATS_TTL if ttl is None else ttl
+    timeout = timeout or settings.SERVER_STATS_TIMEOUT
+    servers = list(servers)
+    entries = cache.get_many([f'{STATS_KEY_PREFIX}{server.id}' for server in servers])
+    now = time.time()
+
+    to_refresh = []
+    for server in servers:
+        entry = entries.get(f'{STATS_KEY_PREFIX}{server.id}')
+        if entry is not None and now - entry['collected_at'] < ttl:
+            continue
+        # Блокировка живет не дольше одного опроса, даже если процесс упадет
+        if cache.add(f'{LOCK_KEY_PREFIX}{server.id}', 1, timeout + 1):
+            to_refresh.append(server)
+
+    errors = {}
+    if to_refresh:
+        try:
+            results = run_across_servers(to_refresh, _fetch_stats, timeout=timeout)
+            fresh = {}
+            for result in results:
+                latency_ms = round(result.elapsed * 1000, 1)
+                key = f'{STATS_KEY_PREFIX}{result.server.id}'
+                if result.error is None:
+                    fresh[key] = entries[key] = {
+                        'stats': result.result,
+                        'collected_at': time.time(),
+                        'latency_ms': latency_ms,
+                    }
+                else:
+                    errors[result.server.id] = {
+                        'error': str(result.error) or result.error.__class__.__name__,
+                        'latency_ms': latency_ms,
+                    }
+            cache.set_many(fresh, settings.SERVER_STATS_STALE_TTL)
+        finally:
+            cache.delete_many([f'{LOCK_KEY_PREFIX}{server.id}' for server in to_refresh])
+
+    now = time.time()
+    report = []
+    for server in servers:
+        entry = entries.get(f'{STATS_KEY_PREFIX}{server.id}')
+        error = errors.get(server.id)
+        age = round(now - entry['collected_at'], 1) if entry else None
+        report.append({
+            'server_id': server.id,
+            'server_name': server.server_name,
+            'transferred_bytes': entry['stats']['transferred_bytes'] if entry else None,
+            'keys_with_traffic': entry['stats']['keys_with_traffic'] if entry else None,
+            'collected_at': (datetime.datetime.fromtimestamp(entry['collected_at'], tz=datetime.timezone.utc)
+                             if entry else None),
+            'age_seconds': age,
+            'stale': entry is None or age >= ttl,
+            'latency_ms': error['latency_ms'] if error else (entry['latency_ms'] if entry else None),
+            'error': error['error'] if error else None,
+        })
+    return report
@@ -0,0 +1,185 @@
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from vpn_service.models import TrafficSample, VPNKey, VPNServer
+from .outline import get_client
+from .outline_async import run_across_servers
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_FIELDS = ['traffic_used', 'traffic_last_period_bytes', 'traffic_synced_at']
+
+
+def fetch_used_bytes(server):
+    """Возвращает {outline_id: used_bytes} для всех ключей сервера одним запросом get_keys()"""
+    client = get_client(server)
+    return {str(key.key_id): key.used_bytes or 0 for key in client.get_keys()}
+
+
+def apply_used_bytes(keys, used_bytes, synced_at=None):
+    """
+    Записывает снимок трафика в объекты ключей.
+
+    Возвращает (обновленные, число отсутствующих в Outline, TrafficSample с
+    приростом с прошлого снимка). Если счетчик Outline уменьшился (ключ
+    пересоздан или сброшен), приростом считается все новое значение.
+    """
+    synced_at = synced_at or timezone.now()
+    updated = []
+    samples = []
+    missing = 0
+    for vpn_key in keys:
+        if vpn_key.outline_id not in used_bytes:
+            missing += 1
+            continue
+        current = used_bytes[vpn_key.outline_id]
+        delta = current - vpn_key.traffic_used if current >= vpn_key.traffic_used else current
+        if delta > 0:
+            samples.append(TrafficSample(vpn_key=vpn_key, collected_at=synced_at, delta_bytes=delta))
+        vpn_key.traffic_used = current
+        vpn_key.traffic_last_period_bytes = current
+        vpn_key.traffic_synced_at = synced_at
+        updated.append(vpn_key)
+    return updated, missing, samples
+
+
+async def fetch_used_bytes_async(client, server):
+    return {str(key.key_id): key.used_bytes or 0 for key in await client.get_keys()}
+
+
+def store_server_traffic(server, used_bytes):
+    """Записывает полученный из Outline трафик во все ключи сервера одним bulk_update вместе с приростами"""
+    with transaction.atomic():
+        # Прирост считаем от заблокированных строк: параллельная синхронизация того же
+        # ключа (?fresh=1, update_traffic) дождется коммита и не запишет его второй раз
+        keys = (
+            VPNKey.objects.select_for_update().filter(vpn_server=server)
+            .only('id', 'outline_id', *TRAFFIC_FIELDS).order_by('id')
+        )
+        updated, missing, samples = apply_used_bytes(keys, used_bytes)
+        save_traffic(updated, samples)
+    return len(updated), missing
+
+
+def store_keys_traffic(keys, used_bytes):
+    """
+    Записывает трафик из Outline в переданные ключи вместе с приростами.
+
+    Как и store_server_traffic, перечитывает строки под select_for_update и
+    считает прирост от значения в БД, а не от переданных объектов, которые
+    могли устареть; новые значения копируются в переданные объекты.
+    Возвращает число обновленных ключей.
+    """
+    by_id = {vpn_key.id: vpn_key for vpn_key in keys}
+    ids = sorted(by_id)
+    with transaction.atomic():
+        updated, samples = [], []
+        for start in range(0, len(ids), 1000):
+            locked = (
+                VPNKey.objects.select_for_update().filter(id__in=ids[start:start + 1000])
+                .only('id', 'outline_id', *TRAFFIC_FIELDS).order_by('id')
+            )
+            chunk_updated, _, chunk_samples = apply_used_bytes(locked, used_bytes)
+            updated.extend(chunk_updated)
+            samples.extend(chunk_samples)
+        save_traffic(updated, samples)
+    for row in updated:
+        for field in TRAFFIC_FIELDS:
+            setattr(by_id[row.id], field, getattr(row, field))
+    return len(updated)
+
+
+def sync_server_traffic(server):
+    """Обновляет трафик всех ключей сервера одним запросом get_keys() к Outline API"""
+    started = time.monotonic()
+    used_bytes = fetch_used_bytes(server)
+    fetched = time.monotonic()
+    updated, missing = store_server_traffic(server, used_bytes)
+    finished = time.monotonic()
+
+    return {
+        'server_id': server.id,
+        'server_name': server.server_name,
+        'remote_keys': len(used_bytes),
+        'updated': updated,
+        'missing': missing,
+        'fetch_seconds': round(fetched - started, 3),
+        'total_seconds': round(finished - started, 3),
+    }
+
+
+def sync_servers_traffic(servers, timeout=None):
+    """
+    Обновляет трафик ключей нескольких серверов: запросы get_keys() идут ко всем
+    серверам одновременно, затем результаты по очереди записываются в БД.
+    """
+    results = []
+    for fetched in run_across_servers(servers, fetch_used_bytes_async, timeout=timeout):
+        server = fetched.server
+        result = {
+            'server_id': server.id,
+            'server_name': server.server_name,
+            'fetch_seconds': round(fetched.elapsed, 3),
+        }
+        if fetched.error is not None:
+            logger.warning('Traffic sync failed for server %s: %r', server.id, fetched.error)
+            result['error'] = str(fetched.error) or fetched.error.__class__.__name__
+            results.append(result)
+            continue
+
+        started = time.monotonic()
+        updated, missing = store_server_traffic(server, fetched.result)
+        result.update({
+            'remote_keys': len(fetched.result),
+            'updated': updated,
+            'missing': missing,
+            'store_seconds': round(time.monotonic() - started, 3),
+        })
+        results.append(result)
+    return results
+
+
+def stale_traffic_keys(keys, max_age=None):
+    """Ключи, снимок трафика которых старше max_age секунд (по умолчанию TRAFFIC_SNAPSHOT_MAX_AGE)"""
+    if max_age is None:
+        max_age = settings.TRAFFIC_SNAPSHOT_MAX_AGE
+    threshold = timezone.now() - datetime.timedelta(seconds=max_age)
+    return [
+        vpn_key for vpn_key in keys
+        if vpn_key.traffic_synced_at is None or vpn_key.traffic_synced_at < threshold
+    ]
+
+
+def refresh_stale_traffic(keys, max_age=None):
+    """
+    Обновляет снимок трафика только у устаревших ключей из переданного списка.
+    Делает один запрос get_keys() на каждый затронутый сервер, все серверы
+    опрашиваются одновременно; ошибки сервера не прерывают ответ — у его
+    ключей остается прежний снимок.
+    """
+    stale_by_server = {}
+    for vpn_key in stale_traffic_keys(keys, max_age):
+        stale_by_server.setdefault(vpn_key.vpn_server_id, []).append(vpn_key)
+    if not stale_by_server:
+        return 0
+
+    servers = VPNServer.objects.filter(id__in=stale_by_server.keys())
+    updated = 0
+    for fetched in run_across_servers(servers, fetch_used_bytes_async):
+        if fetched.error is not None:
+            logger.warning('Traffic refresh failed for server %s: %r', fetched.server.id, fetched.error)
+            continue
+        updated += store_keys_traffic(stale_by_server[fetched.server.id], fetched.result)
+    return updated
+
+
+def save_traffic(updated, samples):
+    """Сохраняет снимки трафика ключей и приросты одной транзакцией"""
+    with transaction.atomic():
+        VPNKey.objects.bulk_update(updated, TRAFFIC_FIELDS, batch_size=1000)
+        TrafficSample.objects.bulk_create(samples, batch_size=1000)
@@ -0,0 +1,162 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from vpn_service.models import (
+    TrafficSample, TrafficHourly, TrafficDaily, TrafficRollupState, User, VPNKey, VPNServer,
+)
+
+ROLLUPS = {'hour': TrafficHourly, 'day': TrafficDaily}
+
+TOP_GROUPS = {'user': 'user', 'key': 'vpn_key', 'server': 'vpn_server'}
+
+
+def _merge_rollup(model, kind, samples):
+    """Добавляет приросты пачки к строкам сводки одним bulk upsert"""
+    rows = (
+        samples.annotate(period=Trunc('collected_at', kind))
+        .values('vpn_key', 'vpn_key__user', 'vpn_key__vpn_server', 'period')
+        .annotate(total=Sum('delta_bytes'))
+        .order_by()
+    )
+    merged = {}
+    for row in rows:
+        merged[(row['vpn_key'], row['period'])] = model(
+            vpn_key_id=row['vpn_key'],
+            user_id=row['vpn_key__user'],
+            vpn_server_id=row['vpn_key__vpn_server'],
+            bucket=row['period'],
+            bytes=row['total'],
+        )
+    if not merged:
+        return 0
+
+    existing = model.objects.filter(
+        vpn_key_id__in={key_id for key_id, _ in merged},
+        bucket__in={bucket for _, bucket in merged},
+    ).values_list('vpn_key_id', 'bucket', 'bytes')
+    for key_id, bucket, total in existing:
+        if (key_id, bucket) in merged:
+            merged[(key_id, bucket)].bytes += total
+
+    model.objects.bulk_create(
+        merged.values(),
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=['vpn_key', 'bucket'],
+        update_fields=['bytes'],
+    )
+    return len(merged)
+
+
+def _after(collected_at, sample_id):
+    """Сэмплы строго после (collected_at, id) в порядке водяного знака"""
+    return Q(collected_at__gt=collected_at) | Q(collected_at=collected_at, id__gt=sample_id)
+
+
+def rollup_traffic(batch_size=None, now=None):
+    """
+    Переносит новые TrafficSample в часовую и дневную сводки.
+
+    Водяной знак — (collected_at, id) последнего учтенного сэмпла, а не id:
+    id выдаются до коммита, и сэмпл из еще не закоммиченной транзакции с
+    меньшим id оказался бы позади водяного знака. Поэтому учитываются только
+    сэмплы старше TRAFFIC_ROLLUP_LAG секунд — к этому времени транзакция,
+    записавшая их, уже закоммичена. Идем пачками по batch_size: каждая пачка
+    агрегируется в БД, складывается с уже существующими строками сводки и
+    вместе со сдвигом водяного знака записывается одной транзакцией. Строка
+    водяного знака блокируется, поэтому параллельные запуски не учтут один
+    сэмпл дважды.
+    """
+    batch_size = batch_size or settings.TRAFFIC_ROLLUP_BATCH_SIZE
+    cutoff = (now or timezone.now()) - datetime.timedelta(seconds=settings.TRAFFIC_ROLLUP_LAG)
+    started = time.monotonic()
+    report = {'samples': 0, 'hourly': 0, 'daily': 0}
+
+    while True:
+        with transaction.atomic():
+            state, _ = TrafficRollupState.objects.select_for_update().get_or_create(id=1)
+            pending = TrafficSample.objects.filter(collected_at__lt=cutoff)
+            if state.last_collected_at is not None:
+                pending = pending.filter(_after(state.last_collected_at, state.last_sample_id))
+            ordered = pending.order_by('collected_at', 'id').values_list('collected_at', 'id')
+            upper = list(ordered[batch_size - 1:batch_size])
+            upper = upper[0] if upper else ordered.reverse().first()
+            if upper is None:
+                break
+
+            batch = pending.exclude(_after(*upper))
+            report['samples'] += batch.count()
+            report['hourly'] += _merge_rollup(TrafficHourly, 'hour', batch)
+            report['daily'] += _merge_rollup(TrafficDaily, 'day', batch)
+            state.last_collected_at, state.last_sample_id = upper
+            state.save(update_fields=['last_collected_at', 'last_sample_id', 'updated_at'])
+
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
+
+
+def prune_traffic(now=None):
+    """
+    Удаляет сырые сэмплы старше TRAFFIC_SAMPLE_RETENTION_DAYS (только уже
+    учтенные в сводках) и часовую сводку старше TRAFFIC_HOURLY_RETENTION_DAYS.
+    Дневная сводка хранится без ограничения.
+    """
+    now = now or timezone.now()
+    state = TrafficRollupState.objects.filter(id=1).first()
+
+    samples = 0
+    if state is not None and state.last_collected_at is not None:
+        samples, _ = TrafficSample.objects.filter(
+            collected_at__lt=now - datetime.timedelta(days=settings.TRAFFIC_SAMPLE_RETENTION_DAYS),
+        ).exclude(_after(state.last_collected_at, state.last_sample_id)).delete()
+    hourly, _ = TrafficHourly.objects.filter(
+        bucket__lt=now - datetime.timedelta(days=settings.TRAFFIC_HOURLY_RETENTION_DAYS),
+    ).delete()
+    return {'samples': samples, 'hourly': hourly}
+
+
+def traffic_series(period, since=None, until=None, **filters):
+    """Трафик по интервалам сводки period ('hour' или 'day') с фильтрами vpn_key/user/vpn_server"""
+    rollups = ROLLUPS[period].objects.filter(**filters)
+    if since is not None:
+        rollups = rollups.filter(bucket__gte=since)
+    if until is not None:
+        rollups = rollups.filter(bucket__lt=until)
+    return list(
+        rollups.values('bucket')
+        .annotate(total_bytes=Sum('bytes'))
+        .order_by('bucket')
+    )
+
+
+def top_traffic(group_by, period='day', since=None, until=None, limit=10):
+    """Top-N ключей, пользователей или серверов по трафику за интервал, только по сводке"""
+    field = TOP_GROUPS[group_by]
+    rollups = ROLLUPS[period].objects.all()
+    if since is not None:
+        rollups = rollups.filter(bucket__gte=since)
+    if until is not None:
+        rollups = rollups.filter(bucket__lt=until)
+    rows = list(
+        rollups.values(field)
+        .annotate(total_bytes=Sum('bytes'))
+        .order_by('-total_bytes')[:limit]
+    )
+
+    ids = [row[field] for row in rows]
+    if group_by == 'user':
+        labels = {user.id: str(user) for user in User.objects.filter(id__in=ids)}
+    elif group_by == 'server':
+        labels = dict(VPNServer.objects.filter(id__in=ids).values_list('id', 'server_name'))
+    else:
+        labels = dict(VPNKey.objects.filter(id__in=ids).values_list('id', 'name'))
+    return [
+        {'id': row[field], 'label': labels.get(row[field]), 'total_bytes': row['total_bytes']}
+        for row in rows
+    ]
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from vpn_service.models import User, VPNKey
+from vpn_service.serializers import UserSerializer
+
+
+class UserLookupCache:
+    """
+    Двухуровневый кэш поиска пользователя по telegram_id.
+
+    Первый уровень — LRU в памяти процесса с коротким TTL, второй — Django
+    cache framework (общий для процессов, если CACHES указывает на Redis или
+    memcached). Сигналы User/VPNKey сбрасывают запись на обоих уровнях в
+    текущем процессе и во втором уровне; локальные LRU других процессов
+    догоняют изменения не позже чем через local_ttl секунд. Массовые
+    операции (bulk_create/update) сигналов не шлют и видны после истечения TTL.
+    """
+
+    key_prefix = 'user-by-telegram:'
+
+    def __init__(self, maxsize=None, local_ttl=None, shared_ttl=None):
+        self.maxsize = maxsize
+        self.local_ttl = local_ttl
+        self.shared_ttl = shared_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _key(self, telegram_id):
+        return f"{self.key_prefix}{telegram_id}"
+
+    def _store_local(self, telegram_id, value):
+        maxsize = self.maxsize or settings.USER_CACHE_LOCAL_MAXSIZE
+        local_ttl = self.local_ttl or settings.USER_CACHE_LOCAL_TTL
+        with self._lock:
+            self._entries[telegram_id] = (time.monotonic() + local_ttl, value)
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, telegram_id, loader):
+        """Возвращает закэшированное значение или вызывает loader(telegram_id); None не кэшируется"""
+        telegram_id = int(telegram_id)
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(telegram_id)
+                self.local_hits += 1
+                return entry[1]
+
+        value = cache.get(self._key(telegram_id))
+        if value is not None:
+            with self._lock:
+                self.shared_hits += 1
+            self._store_local(telegram_id, value)
+            return value
+
+        with self._lock:
+            self.misses += 1
+        value = loader(telegram_id)
+        if value is not None:
+            cache.set(self._key(telegram_id), value, self.shared_ttl or settings.USER_CACHE_SHARED_TTL)
+            self._store_local(telegram_id, value)
+        return value
+
+    def invalidate(self, telegram_id):
+        telegram_id = int(telegram_id)
+        with self._lock:
+            self._entries.pop(telegram_id, None)
+        cache.delete(self._key(telegram_id))
+
+    def invalidate_many(self, telegram_ids):
+        telegram_ids = [int(telegram_id) for telegram_id in telegram_ids]
+        with self._lock:
+            for telegram_id in telegram_ids:
+                self._entries.pop(telegram_id, None)
+        cache.delete_many([self._key(telegram_id) for telegram_id in telegram_ids])
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_ratio': round((self.local_hits + self.shared_hits) / lookups, 4) if lookups else None,
+            'local_size': len(self._entries),
+        }
+
+
+def load_user_summary(telegram_id):
+    """Пользователь и краткая информация о его активных ключах — два запроса к БД"""
+    user = User.objects.filter(telegram_id=telegram_id).first()
+    if user is None:
+        return None
+
+    keys = (
+        VPNKey.objects.filter(user=user, is_active=True)
+        .select_related('vpn_server')
+        .order_by('created_at')
+    )
+    data = dict(UserSerializer(user).data)
+    data['active_keys'] = [
+        {
+            'id': vpn_key.id,
+            'name': vpn_key.name,
+            'vpn_server': vpn_key.vpn_server_id,
+            'server_name': vpn_key.vpn_server.server_name,
+            'server_location': vpn_key.vpn_server.server_location,
+            'access_url': vpn_key.access_url,
+            'expiration_date': vpn_key.expiration_date,
+            'traffic_limit': vpn_key.traffic_limit,
+            'traffic_used': vpn_key.traffic_used,
+            'traffic_offset': vpn_key.traffic_offset,
+        }
+        for vpn_key in keys
+    ]
+    return data
+
+
+user_cache = UserLookupCache()
@@ -1,27 +1,204 @@
-from rest_framework import viewsets, status, permissions
+import datetime
+
+from rest_framework import viewsets, status, permissions, serializers
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.views import APIView
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
 from django.shortcuts import get_object_or_404
-from .models import Country, City, VPNServer, User, VPNKey, TelegramBot
+from django.utils import timezone
+from .models import Country, City, VPNServer, User, VPNKey, TelegramBot, ServerHealth, OutlineJob
 from .serializers import (
     CountrySerializer, CitySerializer, VPNServerSerializer,
     UserSerializer, VPNKeySerializer, TelegramBotSerializer,
-    VPNServerRegistrationSerializer
+    VPNServerRegistrationSerializer, ServerHealthSerializer, BulkKeyItemSerializer,
+    BulkUserItemSerializer, OutlineJobSerializer
+)
+from .pagination import CreatedAtCursorPagination
+from .utils.outline import get_client, outline_data_limit, outline_key_name, ServerUnavailable
+from .utils.outline_async import run_across_servers
+from .utils.bulk_keys import bulk_provision_keys
+from .utils.bulk_users import bulk_upsert_users
+from .utils.export import (
+    EXPORT_FORMATS, KEY_EXPORT_FIELDS, USER_EXPORT_FIELDS,
+    export_keys_queryset, export_users_queryset, streaming_export
 )
-from .utils.outline import OutlineVPNClient
+from .utils.jobs import enqueue_job, record_completed_job
+from .utils.key_import import compile_pattern, import_server_keys
+from .utils.key_pool import claim_key, pool_stats
+from .utils.selection import server_ranking
+from .utils.server_stats import collect_server_stats
+from .utils.catalog import server_catalog
+from .utils.metrics import registry
+from .utils.user_cache import user_cache, load_user_summary
+from .utils.activity import activity_buffer
+from .utils.traffic_rollup import ROLLUPS, TOP_GROUPS, traffic_series, top_traffic
+from .utils.traffic import sync_server_traffic, refresh_stale_traffic, store_keys_traffic
+
+
+def fresh_requested(request):
+    return request.query_params.get('fresh') in ('1', 'true', 'yes')
+
+
+def datetime_param(request, name):
+    """Дата из query param в ISO 8601 (без зоны — в текущей зоне) или None; ValueError при ошибке"""
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'{name} must be an ISO 8601 datetime')
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def traffic_range(request):
+    """period, since и until из query params (?period=hour|day&since=&until= или ?days=N); ValueError при ошибке"""
+    period = request.query_params.get('period', 'day')
+    if period not in ROLLUPS:
+        raise ValueError('period must be one of: ' + ', '.join(ROLLUPS))
+
+    since = datetime_param(request, 'since')
+    until = datetime_param(request, 'until')
+    if since is None:
+        since = timezone.now() - datetime.timedelta(days=int(request.query_params.get('days', 7)))
+    return period, since, until
+
+
+def traffic_response(request, **filters):
+    # Читаем только сводки TrafficHourly/TrafficDaily, сырые сэмплы не трогаем
+    try:
+        period, since, until = traffic_range(request)
+    except ValueError as e:
+        return Response({
+            'status': 'error',
+            'message': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+    return Response({
+        'period': period,
+        'since': since,
+        'until': until,
+        'series': traffic_series(period, since, until, **filters),
+    })
+
+
+def idempotency_key(request):
+    key = request.headers.get('Idempotency-Key') or request.data.get('idempotency_key')
+    return str(key)[:100] if key else None
+
+
+def export_response(request, build_queryset, fields, filename):
+    """
+    Потоковая выгрузка с фильтрами ?server=&active=&since=&until= (по created_at)
+    и ?fmt=ndjson|csv. Параметр format занят DRF под выбор renderer.
+    """
+    export_format = request.query_params.get('fmt', 'ndjson')
+    try:
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError('fmt must be one of: ' + ', '.join(EXPORT_FORMATS))
+        server_id = request.query_params.get('server') or None
+        if server_id is not None and not server_id.isdigit():
+            raise ValueError('server must be an integer')
+        active = request.query_params.get('active')
+        if active not in (None, '', 'true', 'false', '1', '0'):
+            raise ValueError('active must be true or false')
+        is_active = active in ('true', '1') if active else None
+        since = datetime_param(request, 'since')
+        until = datetime_param(request, 'until')
+    except ValueError as e:
+        return Response({
+            'status': 'error',
+            'message': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    queryset = build_queryset(server_id=server_id, is_active=is_active, since=since, until=until)
+    return streaming_export(queryset, fields, export_format, filename)
+
+
+def job_response(job):
+    # Пока задача не завершена — 202 и id для опроса /jobs/{id}/
+    code = status.HTTP_202_ACCEPTED if job.status in (OutlineJob.PENDING, OutlineJob.RUNNING) else status.HTTP_200_OK
+    return Response(OutlineJobSerializer(job).data, status=code)
+
+
+def serialize_keys(request, keys):
+    # По умолчанию отдаем сохраненный снимок трафика без запросов к Outline,
+    # с ?fresh=1 обновляем только устаревшие ключи (один запрос на сервер)
+    keys = list(keys)
+    if fresh_requested(request):
+        refresh_stale_traffic(keys)
+    return VPNKeySerializer(keys, many=True).data
+
+
+def metrics(request):
+    """Метрики процесса в текстовом формате Prometheus"""
+    if not settings.METRICS_ENABLED:
+        return HttpResponse(status=404)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class CatalogView(APIView):
+    """Дерево страна → город → активные серверы для меню бота, с ETag и 304"""
+
+    def get(self, request):
+        body, etag = server_catalog.get()
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            if '*' in etags or etag in etags or f'W/{etag}' in etags:
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+
+        response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        # Клиент может хранить ответ, но обязан перепроверять его по ETag
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+class TrafficTopView(APIView):
+    """Top-N ключей, пользователей или серверов по трафику: ?by=user|key|server&limit=10"""
+
+    def get(self, request):
+        group_by = request.query_params.get('by', 'user')
+        try:
+            if group_by not in TOP_GROUPS:
+                raise ValueError('by must be one of: ' + ', '.join(TOP_GROUPS))
+            period, since, until = traffic_range(request)
+            limit = min(int(request.query_params.get('limit', 10)), 1000)
+            if limit < 1:
+                raise ValueError('limit must be a positive integer')
+        except ValueError as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'by': group_by,
+            'period': period,
+            'since': since,
+            'until': until,
+            'results': top_traffic(group_by, period, since, until, limit),
+        })
 
 
 class CountryViewSet(viewsets.ModelViewSet):
-    queryset = Country.objects.all()
+    queryset = Country.objects.order_by('id')
     serializer_class = CountrySerializer
 
 
 class CityViewSet(viewsets.ModelViewSet):
-    queryset = City.objects.all()
+    queryset = City.objects.select_related('country').order_by('id')
     serializer_class = CitySerializer
 
     def get_queryset(self):
-        queryset = City.objects.all()
+        queryset = City.objects.select_related('country').order_by('id')
         country_id = self.request.query_params.get('country_id', None)
         if country_id is not None:
             queryset = queryset.filter(country_id=country_id)
@@ -29,7 +206,7 @@ class CityViewSet(viewsets.ModelViewSet):
 
 
 class VPNServerViewSet(viewsets.ModelViewSet):
-    queryset = VPNServer.objects.all()
+    queryset = VPNServer.objects.select_related('city__country').order_by('id')
     serializer_class = VPNServerSerializer
 
     @action(detail=False, methods=['post'], serializer_class=VPNServerRegistrationSerializer)
@@ -43,16 +220,15 @@ class VPNServerViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'])
     def keys(self, request, pk=None):
         server = self.get_object()
-        keys = VPNKey.objects.filter(vpn_server=server)
-        serializer = VPNKeySerializer(keys, many=True)
-        return Response(serializer.data)
+        keys = VPNKey.objects.filter(vpn_server=server).select_related('vpn_server', 'user')
+        return Response(serialize_keys(request, keys))
 
     @action(detail=True, methods=['post'])
     def test_connection(self, request, pk=None):
         server = self.get_object()
         try:
-            # Создаем клиент Outline для тестирования соединения
-            client = OutlineVPNClient(api_url=server.api_url, cert_sha256=server.cert_sha)
+            # Берем клиент Outline из пула для тестирования соединения
+            client = get_client(server)
             server_info = client.get_server_information()
             return Response({
                 'status': 'success',
@@ -65,10 +241,85 @@ class VPNServerViewSet(viewsets.ModelViewSet):
                 'message': str(e)
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['post'])
+    def test_connections(self, request):
+        # Проверяем все активные серверы одновременно, а не по очереди
+        servers = self.get_queryset().filter(active=True)
+        results = run_across_servers(servers, lambda client, server: client.get_server_information())
+        return Response([
+            {
+                'server_id': result.server.id,
+                'server_name': result.server.server_name,
+                'status': 'error' if result.error else 'success',
+                'latency': round(result.elapsed, 3),
+                **({'message': str(result.error) or result.error.__class__.__name__}
+                   if result.error else {'server_info': result.result}),
+            }
+            for result in results
+        ])
+
+    @action(detail=False, methods=['get'])
+    def health(self, request):
+        # Результаты фонового пробника (manage.py probe_servers)
+        health = ServerHealth.objects.select_related('vpn_server')
+        return Response(ServerHealthSerializer(health, many=True).data)
+
+    @action(detail=False, methods=['get'])
+    def stats(self, request):
+        # Трафик и число ключей с трафиком всех активных серверов из кэша; устаревшие значения помечены stale
+        servers = VPNServer.objects.filter(active=True).order_by('id')
+        return Response(collect_server_stats(servers))
+
+    @action(detail=True, methods=['post'])
+    def sync_traffic(self, request, pk=None):
+        server = self.get_object()
+        try:
+            # Обновляем трафик всех ключей сервера одним запросом к Outline API
+            result = sync_server_traffic(server)
+            return Response({'status': 'success', **result})
+        except ServerUnavailable as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=True, methods=['post'])
+    def import_keys(self, request, pk=None):
+        # Заводит VPNKey для ключей, созданных в Outline в обход бэкенда; {"pattern": ..., "dry_run": true}
+        server = self.get_object()
+        try:
+            pattern = compile_pattern(request.data.get('pattern'))
+        except ValueError as e:
+            return Response({'status': 'error', 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        dry_run = request.data.get('dry_run') in (True, '1', 'true', 'yes')
+        try:
+            result = import_server_keys(server, pattern=pattern, dry_run=dry_run)
+            return Response({'status': 'success', 'dry_run': dry_run, **result})
+        except ServerUnavailable as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=True, methods=['get'])
+    def traffic(self, request, pk=None):
+        return traffic_response(request, vpn_server=self.get_object())
+
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    pagination_class = CreatedAtCursorPagination
 
     def get_queryset(self):
         queryset = User.objects.all()
@@ -77,78 +328,273 @@ class UserViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(telegram_id=telegram_id)
         return queryset
 
+    @action(detail=False, methods=['get'], url_path=r'by-telegram/(?P<telegram_id>-?\d+)')
+    def by_telegram(self, request, telegram_id=None):
+        # Быстрый поиск для бота: кэш в памяти процесса и Django cache, без пагинации
+        data = user_cache.get(telegram_id, load_user_summary)
+        if data is None:
+            return Response({
+                'status': 'error',
+                'message': 'User not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        return Response(data)
+
+    @action(detail=False, methods=['get'])
+    def cache_stats(self, request):
+        return Response(user_cache.stats())
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        return export_response(request, export_users_queryset, USER_EXPORT_FIELDS, 'users')
+
+    @action(detail=False, methods=['post'])
+    def bulk_upsert(self, request):
+        items = request.data.get('items') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list) or not items:
+            return Response({
+                'status': 'error',
+                'message': 'Expected a non-empty list of items'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.BULK_UPSERT_MAX_ITEMS:
+            return Response({
+                'status': 'error',
+                'message': f"At most {settings.BULK_UPSERT_MAX_ITEMS} items per request"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        # Невалидные позиции возвращаем с индексом, остальные записываем пачками.
+        # Один экземпляр сериализатора на все позиции: создание нового копирует поля
+        # и на 10k позиций стоит больше, чем сама запись в БД
+        validator = BulkUserItemSerializer()
+        valid, errors = [], []
+        for index, item in enumerate(items):
+            try:
+                valid.append(validator.run_validation(item))
+            except serializers.ValidationError as e:
+                errors.append({'index': index, 'errors': e.detail})
+
+        result = bulk_upsert_users(valid) if valid else {'created': 0, 'updated': 0, 'ids': {}}
+        result['failed'] = len(errors)
+        result['errors'] = errors
+        return Response(result, status=status.HTTP_207_MULTI_STATUS if errors else status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'])
+    def touch(self, request):
+        # Активность пишется в last_login не сразу, а пачкой из буфера процесса
+        telegram_ids = request.data.get('telegram_ids')
+        if telegram_ids is None:
+            telegram_ids = [request.data.get('telegram_id')]
+        try:
+            # Строку нельзя перебирать посимвольно: "56" — это не [5, 6]
+            if not isinstance(telegram_ids, list):
+                raise TypeError
+            telegram_ids = [int(telegram_id) for telegram_id in telegram_ids]
+        except (TypeError, ValueError):
+            return Response({
+                'status': 'error',
+                'message': 'telegram_id must be an integer or telegram_ids a list of integers'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        now = timezone.now()
+        for telegram_id in telegram_ids:
+            activity_buffer.touch(telegram_id, now)
+        return Response({'status': 'success', 'touched': len(telegram_ids)}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['get'])
+    def touch_stats(self, request):
+        return Response(activity_buffer.stats())
+
     @action(detail=True, methods=['get'])
     def keys(self, request, pk=None):
         user = self.get_object()
-        keys = VPNKey.objects.filter(user=user)
-        serializer = VPNKeySerializer(keys, many=True)
-        return Response(serializer.data)
+        keys = VPNKey.objects.filter(user=user).select_related('vpn_server', 'user')
+        return Response(serialize_keys(request, keys))
+
+    @action(detail=True, methods=['get'])
+    def traffic(self, request, pk=None):
+        return traffic_response(request, user=self.get_object())
 
 
 class VPNKeyViewSet(viewsets.ModelViewSet):
-    queryset = VPNKey.objects.all()
+    queryset = VPNKey.objects.select_related('vpn_server', 'user')
     serializer_class = VPNKeySerializer
+    pagination_class = CreatedAtCursorPagination
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serialize_keys(request, page))
+        return Response(serialize_keys(request, queryset))
+
+    def retrieve(self, request, *args, **kwargs):
+        vpn_key = self.get_object()
+        if fresh_requested(request):
+            refresh_stale_traffic([vpn_key])
+        return Response(self.get_serializer(vpn_key).data)
 
     @action(detail=False, methods=['post'])
     def create_key(self, request):
         user_id = request.data.get('user_id')
         server_id = request.data.get('server_id')
+        country_id = request.data.get('country_id')
+        city_id = request.data.get('city_id')
         name = request.data.get('name', 'VPN Key')
         traffic_limit = request.data.get('traffic_limit', 0)  # в байтах
         expiration_days = request.data.get('expiration_days')
 
+        request_key = idempotency_key(request)
+        if request_key:
+            job = OutlineJob.objects.filter(idempotency_key=request_key).first()
+            if job is not None:
+                return job_response(job)
+
         user = get_object_or_404(User, id=user_id)
-        server = get_object_or_404(VPNServer, id=server_id)
+        if server_id is not None:
+            server = get_object_or_404(VPNServer, id=server_id)
+        else:
+            # Сервер не указан — выбираем наименее загруженный здоровый сервер в стране/городе
+            try:
+                server = server_ranking.select(country_id=country_id, city_id=city_id)
+            except (TypeError, ValueError):
+                return Response({
+                    'status': 'error',
+                    'message': 'country_id and city_id must be integers'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            if server is None:
+                return Response({
+                    'status': 'error',
+                    'message': 'No available VPN server for the requested location'
+                }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
         try:
-            # Создаем ключ VPN с помощью Outline API
-            client = OutlineVPNClient(api_url=server.api_url, cert_sha256=server.cert_sha)
-
-            # Создаем имя для ключа в Outline
-            outline_key_name = f"{user.username or user.telegram_id} - {name}"
-
-            # Создаем ключ в Outline
-            key_data = client.create_key(name=outline_key_name)
-
-            # Если указан лимит трафика, устанавливаем его
-            if traffic_limit > 0:
-                client.add_data_limit(key_data.key_id, traffic_limit)
-
             # Рассчитываем дату истечения срока действия, если указано количество дней
             expiration_date = None
             if expiration_days:
-                from django.utils import timezone
-                import datetime
                 expiration_date = timezone.now() + datetime.timedelta(days=int(expiration_days))
 
-            # Создаем запись о ключе в нашей базе данных
-            vpn_key = VPNKey.objects.create(
-                user=user,
-                vpn_server=server,
-                outline_id=key_data.key_id,
-                access_url=key_data.access_url,
-                name=name,
-                expiration_date=expiration_date,
-                traffic_limit=traffic_limit
-            )
+            # Сначала пробуем выдать заранее созданный ключ из пула — без запросов к Outline
+            vpn_key = None
+            if settings.KEY_POOL_ENABLED:
+                vpn_key = claim_key(server, user, name, traffic_limit=traffic_limit,
+                                    expiration_date=expiration_date)
+
+            if vpn_key is None and settings.OUTLINE_JOBS_ENABLED:
+                # Пул пуст — ключ создаст воркер process_jobs, клиент опрашивает /jobs/{id}/
+                job, _ = enqueue_job(OutlineJob.CREATE_KEY, server, {
+                    'user_id': user.id,
+                    'name': name,
+                    'outline_name': outline_key_name(user, name),
+                    'traffic_limit': traffic_limit,
+                    'expiration_date': expiration_date.isoformat() if expiration_date else None,
+                }, idempotency_key=request_key)
+                server_ranking.record_key_created(server.id)
+                return job_response(job)
+
+            if vpn_key is None:
+                # Пул пуст — создаем ключ VPN с помощью Outline API
+                client = get_client(server)
+
+                # Создаем имя для ключа в Outline
+                outline_name = outline_key_name(user, name)
+
+                # Создаем ключ в Outline
+                key_data = client.create_key(name=outline_name)
+
+                # Если указан лимит трафика, устанавливаем его
+                if traffic_limit > 0:
+                    client.add_data_limit(key_data.key_id, traffic_limit)
+
+                # Создаем запись о ключе в нашей базе данных
+                vpn_key = VPNKey.objects.create(
+                    user=user,
+                    vpn_server=server,
+                    outline_id=key_data.key_id,
+                    access_url=key_data.access_url,
+                    name=name,
+                    expiration_date=expiration_date,
+                    traffic_limit=traffic_limit
+                )
+            server_ranking.record_key_created(server.id)
+            if request_key:
+                record_completed_job(OutlineJob.CREATE_KEY, server, vpn_key, request_key)
 
             serializer = VPNKeySerializer(vpn_key)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+        except ServerUnavailable as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
             return Response({
                 'status': 'error',
                 'message': str(e)
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['post'])
+    def bulk_create(self, request):
+        items = request.data.get('items') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list) or not items:
+            return Response({
+                'status': 'error',
+                'message': 'Expected a non-empty list of items'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.BULK_CREATE_MAX_ITEMS:
+            return Response({
+                'status': 'error',
+                'message': f"At most {settings.BULK_CREATE_MAX_ITEMS} items per request"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        # Невалидные позиции сразу попадают в результат, остальные создаются одним пакетом
+        results = [None] * len(items)
+        valid, positions = [], []
+        for index, item in enumerate(items):
+            serializer = BulkKeyItemSerializer(data=item)
+            if serializer.is_valid():
+                valid.append(serializer.validated_data)
+                positions.append(index)
+            else:
+                results[index] = {'index': index, 'status': 'error', 'errors': serializer.errors}
+
+        provisioned = bulk_provision_keys(valid)
+        created = [result for result in provisioned if result['status'] == 'created']
+        for result, data in zip(created, VPNKeySerializer([r['key'] for r in created], many=True).data):
+            result['key'] = data
+        for result in provisioned:
+            result['index'] = positions[result['index']]
+            results[result['index']] = result
+
+        failed = sum(1 for result in results if result['status'] != 'created')
+        return Response({
+            'created': len(results) - failed,
+            'failed': failed,
+            'results': results,
+        }, status=status.HTTP_201_CREATED if not failed else status.HTTP_207_MULTI_STATUS)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        # Для биллинга и аналитики: все строки одним потоком, без пагинации и запросов к Outline
+        return export_response(request, export_keys_queryset, KEY_EXPORT_FIELDS, 'keys')
+
+    @action(detail=False, methods=['get'])
+    def pool(self, request):
+        # Глубина пула заранее созданных ключей и скорость его пополнения по серверам
+        return Response(pool_stats())
+
     @action(detail=True, methods=['post'])
     def revoke(self, request, pk=None):
         vpn_key = self.get_object()
         server = vpn_key.vpn_server
 
+        if settings.OUTLINE_JOBS_ENABLED:
+            job, _ = enqueue_job(OutlineJob.REVOKE_KEY, server, {'outline_id': vpn_key.outline_id},
+                                 vpn_key=vpn_key, idempotency_key=idempotency_key(request))
+            return job_response(job)
+
         try:
             # Удаляем ключ через Outline API
-            client = OutlineVPNClient(api_url=server.api_url, cert_sha256=server.cert_sha)
+            client = get_client(server)
             client.delete_key(vpn_key.outline_id)
 
             # Обновляем статус ключа в нашей базе данных
@@ -157,6 +603,55 @@ class VPNKeyViewSet(viewsets.ModelViewSet):
 
             return Response({'status': 'success', 'message': 'Key revoked successfully'})
 
+        except ServerUnavailable as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=True, methods=['post'])
+    def set_limit(self, request, pk=None):
+        vpn_key = self.get_object()
+        server = vpn_key.vpn_server
+        try:
+            traffic_limit = int(request.data.get('traffic_limit'))  # в байтах, 0 — без лимита
+            if traffic_limit < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            return Response({
+                'status': 'error',
+                'message': 'traffic_limit must be a non-negative integer'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        if settings.OUTLINE_JOBS_ENABLED:
+            job, _ = enqueue_job(OutlineJob.SET_LIMIT, server,
+                                 {'outline_id': vpn_key.outline_id, 'traffic_limit': traffic_limit,
+                                  'outline_limit': outline_data_limit(traffic_limit, vpn_key.traffic_offset)},
+                                 vpn_key=vpn_key, idempotency_key=idempotency_key(request))
+            return job_response(job)
+
+        try:
+            client = get_client(server)
+            outline_limit = outline_data_limit(traffic_limit, vpn_key.traffic_offset)
+            if outline_limit is not None:
+                client.add_data_limit(vpn_key.outline_id, outline_limit)
+            else:
+                client.delete_data_limit(vpn_key.outline_id)
+
+            vpn_key.traffic_limit = traffic_limit
+            vpn_key.save()
+            return Response(VPNKeySerializer(vpn_key).data)
+
+        except ServerUnavailable as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
             return Response({
                 'status': 'error',
@@ -170,22 +665,42 @@ class VPNKeyViewSet(viewsets.ModelViewSet):
 
         try:
             # Получаем информацию о ключе через Outline API
-            client = OutlineVPNClient(api_url=server.api_url, cert_sha256=server.cert_sha)
+            client = get_client(server)
             key_info = client.get_key(vpn_key.outline_id)
 
-            # Обновляем данные о трафике
-            vpn_key.traffic_used = key_info.used_bytes
-            vpn_key.save()
+            # Обновляем данные о трафике и сохраняем прирост с прошлого снимка
+            store_keys_traffic([vpn_key], {vpn_key.outline_id: key_info.used_bytes or 0})
 
             serializer = VPNKeySerializer(vpn_key)
             return Response(serializer.data)
 
+        except ServerUnavailable as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
             return Response({
                 'status': 'error',
                 'message': str(e)
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=True, methods=['get'])
+    def traffic(self, request, pk=None):
+        return traffic_response(request, vpn_key=self.get_object())
+
+
+class OutlineJobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = OutlineJob.objects.all().order_by('-id')
+    serializer_class = OutlineJobSerializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        job_status = self.request.query_params.get('status')
+        if job_status:
+            queryset = queryset.filter(status=job_status)
+        return queryset
+
 
 class TelegramBotViewSet(viewsets.ModelViewSet):
     queryset = TelegramBot.objects.all()